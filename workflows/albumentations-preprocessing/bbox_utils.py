@@ -0,0 +1,44 @@
+import numpy as np
+
+# Box formats, all arrays of shape [N, 4]:
+#   coco:           [x_min, y_min, width, height] in pixels
+#   albumentations: [x_min, y_min, x_max, y_max] normalized to [0, 1]
+#   tfod:           [y_min, x_min, y_max, x_max] normalized to [0, 1]
+# height and width are either scalars, for boxes of a single image, or arrays
+# of shape [N] with the size of each box's image to convert a whole dataset.
+
+def as_boxes(bboxes) -> np.ndarray:
+    boxes = np.asarray(bboxes, dtype=np.float64)
+    if boxes.size == 0:
+        return boxes.reshape(0, 4)
+    if boxes.ndim != 2 or boxes.shape[1] != 4:
+        raise ValueError('Boxes must have shape [N, 4], got {}'.format(boxes.shape))
+    return boxes
+
+def image_scale(height, width) -> np.ndarray:
+    height = np.asarray(height, dtype=np.float64)
+    width = np.asarray(width, dtype=np.float64)
+    return np.stack(np.broadcast_arrays(width, height, width, height), axis=-1)
+
+def coco_to_albumentations(bboxes, height, width) -> np.ndarray:
+    boxes = as_boxes(bboxes).copy()
+    boxes[:, 2:] += boxes[:, :2]
+    return boxes / image_scale(height, width)
+
+def albumentations_to_coco(bboxes, height, width) -> np.ndarray:
+    boxes = as_boxes(bboxes) * image_scale(height, width)
+    boxes[:, 2:] -= boxes[:, :2]
+    return boxes
+
+def albumentations_to_tfod(bboxes) -> np.ndarray:
+    return as_boxes(bboxes)[:, [1, 0, 3, 2]]
+
+def tfod_to_albumentations(bboxes) -> np.ndarray:
+    # The permutation swaps x and y, so it is its own inverse
+    return as_boxes(bboxes)[:, [1, 0, 3, 2]]
+
+def coco_to_tfod(bboxes, height, width) -> np.ndarray:
+    return albumentations_to_tfod(coco_to_albumentations(bboxes, height, width))
+
+def tfod_to_coco(bboxes, height, width) -> np.ndarray:
+    return albumentations_to_coco(tfod_to_albumentations(bboxes), height, width)
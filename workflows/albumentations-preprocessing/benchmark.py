@@ -0,0 +1,212 @@
+import os
+import sys
+import json
+import time
+import random
+import shutil
+import argparse
+import tempfile
+import tracemalloc
+import numpy as np
+import bbox_utils
+import image_codec
+from val_split import split_dataset
+from data_augmentation import add_augmented_records, polygon2keypoint
+from coco_stream import CocoDatasetSink
+from utils import build_annotation_index, get_annotation_from_image_id, import_tfrecord_utils
+
+
+def create_synthetic_coco(path: str, num_images: int, annotations_per_image: int) -> None:
+    """Writes a COCO file plus empty image files under path."""
+    os.makedirs(os.path.join(path, 'annotations'), exist_ok=True)
+    os.makedirs(os.path.join(path, 'images'), exist_ok=True)
+    rng = random.Random(0)
+    images, annotations = [], []
+    for image_id in range(num_images):
+        file_name = 'frame_{:06d}.jpg'.format(image_id)
+        images.append({'id': image_id + 1, 'file_name': file_name, 'width': 1280, 'height': 720, 'license': 0, 'flickr_url': '', 'coco_url': '', 'date_captured': 0})
+        open(os.path.join(path, 'images', file_name), 'wb').close()
+        for _ in range(annotations_per_image):
+            x, y = rng.uniform(0, 1000), rng.uniform(0, 500)
+            polygon = [round(v, 2) for i in range(16) for v in (x + rng.uniform(0, 200), y + rng.uniform(0, 200))]
+            annotations.append({'id': len(annotations) + 1, 'image_id': image_id + 1, 'category_id': rng.randint(1, 5), 'segmentation': [polygon], 'area': 1000.0, 'bbox': [x, y, 200.0, 200.0], 'iscrowd': 0, 'attributes': {'occluded': False}})
+    categories = [{'id': i, 'name': 'class_{}'.format(i), 'supercategory': ''} for i in range(1, 6)]
+    with open(os.path.join(path, 'annotations/instances_default.json'), 'w') as f:
+        json.dump({'licenses': [], 'info': {}, 'categories': categories, 'images': images, 'annotations': annotations}, f)
+
+
+def benchmark_split(workdir: str, args: argparse.Namespace) -> None:
+    output_path = os.path.join(workdir, 'output/')
+    shutil.rmtree(output_path, ignore_errors=True)
+    split_dataset(val_split=20, input_path=os.path.join(workdir, 'input/'), output_path=output_path, link_mode='symlink', streaming=args.streaming)
+
+
+def benchmark_records(workdir: str, args: argparse.Namespace) -> None:
+    """Augmentation bookkeeping only, including the polygon/keypoint round
+    trip, with the transform replaced by identity."""
+    with open(os.path.join(workdir, 'input/annotations/instances_default.json')) as f:
+        dataset = json.load(f)
+    annotation_index = build_annotation_index(dataset)
+    aug_dataset = CocoDatasetSink(dict(dataset, images=list(dataset['images']), annotations=list(dataset['annotations'])))
+    for image_data in dataset['images']:
+        annotations = get_annotation_from_image_id(dataset, image_data['id'], annotation_index)
+        keypoints, part_offsets, annotation_offsets = polygon2keypoint(annotations)
+        result = {
+            'file_name': image_data['file_name'],
+            'height': image_data['height'],
+            'width': image_data['width'],
+            'bboxes': [annotation['bbox'] for annotation in annotations],
+            'keypoints': keypoints,
+            'part_offsets': part_offsets,
+            'annotation_offsets': annotation_offsets
+        }
+        add_augmented_records(aug_dataset, image_data, annotations, result)
+
+
+def crowded_image_segmentations(num_objects: int, height: int=1080, width: int=1920) -> list:
+    rng = random.Random(0)
+    segmentations = []
+    for _ in range(num_objects):
+        parts = []
+        for _ in range(rng.randint(1, 3)):
+            x, y = rng.uniform(0, width - 150), rng.uniform(0, height - 150)
+            parts.append([v for i in range(12) for v in (x + rng.uniform(0, 150), y + rng.uniform(0, 150))])
+        segmentations.append(parts)
+    return segmentations
+
+
+def benchmark_masks_legacy(workdir: str, args: argparse.Namespace) -> None:
+    """Per annotation decode and PIL encoding, as before batching."""
+    import io
+    from PIL import Image
+    from pycocotools import mask
+    segmentations = crowded_image_segmentations(args.objects_per_image)
+    for segmentation in segmentations:
+        binary_mask = np.amax(mask.decode(mask.frPyObjects(segmentation, 1080, 1920)), axis=2)
+        output_io = io.BytesIO()
+        Image.fromarray(binary_mask).save(output_io, format='PNG')
+
+
+def benchmark_masks(workdir: str, args: argparse.Namespace) -> None:
+    create_coco_tf_record = import_tfrecord_utils()
+    segmentations = crowded_image_segmentations(args.objects_per_image)
+    create_coco_tf_record.coco_segmentations_to_mask_pngs(segmentations, 1080, 1920, [0] * len(segmentations))
+
+
+def benchmark_bboxes_legacy(workdir: str, args: argparse.Namespace) -> None:
+    """Per box Python loop, as utils.bbox_coco2albumentations used to do."""
+    boxes = synthetic_boxes(args.num_boxes).tolist()
+    album_boxes = []
+    for x_min, y_min, width, height in boxes:
+        album_boxes.append([x_min / 1920, y_min / 1080, (x_min + width) / 1920, (y_min + height) / 1080])
+
+
+def benchmark_bboxes(workdir: str, args: argparse.Namespace) -> None:
+    bbox_utils.coco_to_albumentations(synthetic_boxes(args.num_boxes), 1080, 1920)
+
+
+def synthetic_boxes(num_boxes: int) -> 'np.ndarray':
+    rng = np.random.default_rng(0)
+    xy = rng.uniform(0, 1000, (num_boxes, 2))
+    return np.concatenate([xy, rng.uniform(1, 500, (num_boxes, 2))], axis=1)
+
+
+def sample_jpeg(workdir: str) -> str:
+    """A 1080p JPEG with some structure, so it does not compress to nothing."""
+    import cv2
+    path = os.path.join(workdir, 'codec/sample.jpg')
+    if not os.path.isfile(path):
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        rng = np.random.default_rng(0)
+        image = cv2.resize(rng.integers(0, 256, (135, 240, 3), dtype=np.uint8), (1920, 1080), interpolation=cv2.INTER_CUBIC)
+        image = np.clip(image.astype(np.int16) + rng.integers(-8, 9, image.shape), 0, 255).astype(np.uint8)
+        cv2.imwrite(path, image)
+    return path
+
+
+def benchmark_decode_skimage(workdir: str, args: argparse.Namespace) -> int:
+    """mrcnn.utils.Dataset.load_image before it used the codec fast path."""
+    import skimage.io
+    path = sample_jpeg(workdir)
+    for _ in range(args.codec_images):
+        skimage.io.imread(path)
+    return args.codec_images
+
+
+def codec_benchmark(backend: str, mode: str, scale: int=1):
+    def benchmark(workdir: str, args: argparse.Namespace) -> int:
+        codec = image_codec.ImageCodec(backend)
+        path = sample_jpeg(workdir)
+        if mode == 'decode':
+            for _ in range(args.codec_images):
+                codec.read(path, scale)
+        else:
+            image = codec.read(path)
+            for _ in range(args.codec_images):
+                codec.encode(image, 'jpg')
+        return args.codec_images
+    return benchmark
+
+
+BENCHMARKS = {
+    'split': benchmark_split,
+    'records': benchmark_records,
+    'masks_legacy': benchmark_masks_legacy,
+    'masks': benchmark_masks,
+    'bboxes_legacy': benchmark_bboxes_legacy,
+    'bboxes': benchmark_bboxes,
+    'decode_skimage': benchmark_decode_skimage,
+}
+for backend in image_codec.available_backends():
+    BENCHMARKS['decode_' + backend] = codec_benchmark(backend, 'decode')
+    BENCHMARKS['decode_{}_x4'.format(backend)] = codec_benchmark(backend, 'decode', scale=4)
+    BENCHMARKS['encode_' + backend] = codec_benchmark(backend, 'encode')
+
+
+def run(benchmark, workdir: str, args: argparse.Namespace) -> dict:
+    start = time.perf_counter()
+    num_images = benchmark(workdir, args)
+    seconds = time.perf_counter() - start
+    tracemalloc.start()
+    benchmark(workdir, args)
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    result = {'seconds': round(seconds, 3), 'peak_mb': round(peak / 2**20, 1)}
+    if num_images:
+        result['images_per_second'] = round(num_images / seconds, 1)
+    return result
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Preprocessing time/memory benchmark on a synthetic COCO dataset')
+    parser.add_argument('benchmarks', nargs='*', default=list(BENCHMARKS))
+    parser.add_argument('--num_images', default=100000, type=int)
+    parser.add_argument('--annotations_per_image', default=5, type=int)
+    parser.add_argument('--objects_per_image', default=200, type=int, help='Objects per image for the mask benchmarks')
+    parser.add_argument('--num_boxes', default=1000000, type=int, help='Boxes for the bbox benchmarks')
+    parser.add_argument('--codec_images', default=200, type=int, help='Images decoded or encoded by the codec benchmarks')
+    parser.add_argument('--streaming', action='store_true')
+    parser.add_argument('--workdir', default=None, help='Reuse a synthetic dataset between runs')
+    parser.add_argument('--max_seconds', default=None, type=float, help='Fail if any benchmark is slower')
+    parser.add_argument('--max_peak_mb', default=None, type=float, help='Fail if any benchmark uses more memory')
+    args = parser.parse_args()
+    unknown = [name for name in args.benchmarks if name not in BENCHMARKS]
+    if unknown:
+        parser.error('unknown benchmarks: {}, choose from: {}'.format(', '.join(unknown), ', '.join(BENCHMARKS)))
+
+    workdir = args.workdir or tempfile.mkdtemp()
+    needs_dataset = any(name in ('split', 'records') for name in args.benchmarks)
+    if needs_dataset and not os.path.isfile(os.path.join(workdir, 'input/annotations/instances_default.json')):
+        create_synthetic_coco(os.path.join(workdir, 'input/'), args.num_images, args.annotations_per_image)
+    failed = False
+    for name in args.benchmarks:
+        result = run(BENCHMARKS[name], workdir, args)
+        result['benchmark'] = name
+        print(json.dumps(result))
+        if args.max_seconds is not None and result['seconds'] > args.max_seconds:
+            failed = True
+        if args.max_peak_mb is not None and result['peak_mb'] > args.max_peak_mb:
+            failed = True
+    if args.workdir is None:
+        shutil.rmtree(workdir)
+    sys.exit(1 if failed else 0)
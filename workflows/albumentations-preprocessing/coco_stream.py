@@ -0,0 +1,231 @@
+import os
+import json
+import shutil
+import sqlite3
+import tempfile
+import collections
+
+CHUNK_SIZE = 1 << 20
+JSON_WHITESPACE = ' \t\n\r'
+LARGE_SECTIONS = ('images', 'annotations')
+
+class JsonStream:
+    """Minimal pull parser over a JSON file, decoding one value at a time
+    so only the current record and a read buffer are held in memory."""
+    def __init__(self, f):
+        self.file = f
+        self.buffer = ''
+        self.pos = 0
+        self.eof = False
+        self.decoder = json.JSONDecoder()
+
+    def fill(self) -> bool:
+        chunk = self.file.read(CHUNK_SIZE)
+        self.buffer = self.buffer[self.pos:] + chunk
+        self.pos = 0
+        if not chunk:
+            self.eof = True
+        return bool(chunk)
+
+    def peek(self) -> str:
+        while True:
+            while self.pos < len(self.buffer) and self.buffer[self.pos] in JSON_WHITESPACE:
+                self.pos += 1
+            if self.pos < len(self.buffer):
+                return self.buffer[self.pos]
+            if not self.fill():
+                raise ValueError('Unexpected end of COCO file')
+
+    def expect(self, char: str) -> None:
+        if self.peek() != char:
+            raise ValueError('Invalid COCO file: expected "{}" at offset {}'.format(char, self.pos))
+        self.pos += 1
+
+    def value(self):
+        self.peek()
+        while True:
+            try:
+                obj, end = self.decoder.raw_decode(self.buffer, self.pos)
+            except json.JSONDecodeError:
+                if not self.fill():
+                    raise
+                continue
+            # A number ending the buffer may continue in the next chunk
+            if end == len(self.buffer) and not self.eof:
+                self.fill()
+                continue
+            self.pos = end
+            return obj
+
+    def array(self):
+        self.expect('[')
+        if self.peek() == ']':
+            self.pos += 1
+            return
+        while True:
+            yield self.value()
+            if self.peek() == ',':
+                self.pos += 1
+            else:
+                self.expect(']')
+                return
+
+    def skip(self) -> None:
+        if self.peek() == '[':
+            for _ in self.array():
+                pass
+        else:
+            self.value()
+
+    def sections(self):
+        """Yields the top level keys, the caller must consume each value."""
+        self.expect('{')
+        while self.peek() != '}':
+            key = self.value()
+            self.expect(':')
+            yield key
+            if self.peek() == ',':
+                self.pos += 1
+
+def iter_coco_array(path: str, key: str):
+    with open(path) as f:
+        stream = JsonStream(f)
+        for section in stream.sections():
+            if section == key:
+                yield from stream.array()
+                return
+            stream.skip()
+
+def load_coco_header(path: str) -> dict:
+    """Loads every section except images and annotations, which are skipped
+    record by record."""
+    header = {}
+    with open(path) as f:
+        stream = JsonStream(f)
+        for section in stream.sections():
+            if section in LARGE_SECTIONS:
+                stream.skip()
+            else:
+                header[section] = stream.value()
+    return header
+
+class AnnotationIndex:
+    """On-disk index of the annotations of a COCO file by image ID, in a
+    temporary SQLite database next to it. Streaming mode looks up the
+    annotations of one image at a time here instead of holding all of them,
+    whatever their order in the file. Lookups return new dicts, in file
+    order, like a dict of annotation lists built with build_annotation_index.
+    category_counts and num_annotations are counted while indexing."""
+    def __init__(self, path: str):
+        self.file = tempfile.NamedTemporaryFile(suffix='.db', dir=os.path.dirname(os.path.abspath(path)))
+        # Pool task feeders look up annotations from their own thread
+        self.db = sqlite3.connect(self.file.name, check_same_thread=False)
+        self.db.execute('CREATE TABLE annotations (image_id, annotation TEXT)')
+        self.category_counts = collections.Counter()
+        self.num_annotations = 0
+        self.db.executemany('INSERT INTO annotations VALUES (?, ?)', self.rows(path))
+        self.db.execute('CREATE INDEX annotations_image_id ON annotations (image_id)')
+        self.db.commit()
+
+    def rows(self, path: str):
+        for annotation in iter_coco_array(path, 'annotations'):
+            self.category_counts[annotation['category_id']] += 1
+            self.num_annotations += 1
+            yield annotation['image_id'], json.dumps(annotation)
+
+    def get(self, image_id, default=None):
+        rows = self.db.execute('SELECT annotation FROM annotations WHERE image_id = ? ORDER BY rowid', (image_id,)).fetchall()
+        if not rows:
+            return default
+        return [json.loads(row[0]) for row in rows]
+
+    def close(self) -> None:
+        self.db.close()
+        self.file.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+class CocoSection:
+    """Re-iterable view over one array of a COCO file."""
+    def __init__(self, path: str, key: str):
+        self.path = path
+        self.key = key
+
+    def __iter__(self):
+        return iter_coco_array(self.path, self.key)
+
+class CocoWriter:
+    """Writes a COCO file incrementally. Annotations are spooled to a
+    temporary file so images and annotations can be added in any order, and
+    the file is only moved into place on close. The output is byte-identical
+    to json.dump of the equivalent dict."""
+    def __init__(self, path: str, header: dict):
+        self.path = path
+        self.header = {k: v for k, v in header.items() if k not in LARGE_SECTIONS}
+        self.tmp_path = path + '.tmp'
+        self.file = open(self.tmp_path, 'w')
+        self.file.write('{"images": [')
+        self.spool = tempfile.TemporaryFile('w+', dir=os.path.dirname(os.path.abspath(path)))
+        self.num_images = 0
+        self.num_annotations = 0
+
+    def add_image(self, image: dict) -> None:
+        if self.num_images:
+            self.file.write(', ')
+        self.file.write(json.dumps(image))
+        self.num_images += 1
+
+    def add_annotation(self, annotation: dict) -> None:
+        if self.num_annotations:
+            self.spool.write(', ')
+        self.spool.write(json.dumps(annotation))
+        self.num_annotations += 1
+
+    def close(self) -> None:
+        self.file.write('], "annotations": [')
+        self.spool.seek(0)
+        shutil.copyfileobj(self.spool, self.file)
+        self.spool.close()
+        self.file.write(']')
+        for key, value in self.header.items():
+            self.file.write(', {}: {}'.format(json.dumps(key), json.dumps(value)))
+        self.file.write('}')
+        self.file.close()
+        os.replace(self.tmp_path, self.path)
+
+    def abort(self) -> None:
+        self.spool.close()
+        self.file.close()
+        os.remove(self.tmp_path)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if exc_type is None:
+            self.close()
+        else:
+            self.abort()
+
+class CocoDatasetSink:
+    """In-memory counterpart of CocoWriter."""
+    def __init__(self, dataset: dict):
+        self.dataset = dataset
+
+    @property
+    def num_images(self) -> int:
+        return len(self.dataset['images'])
+
+    @property
+    def num_annotations(self) -> int:
+        return len(self.dataset['annotations'])
+
+    def add_image(self, image: dict) -> None:
+        self.dataset['images'].append(image)
+
+    def add_annotation(self, annotation: dict) -> None:
+        self.dataset['annotations'].append(annotation)
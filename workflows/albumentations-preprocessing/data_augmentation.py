@@ -1,61 +1,256 @@
 from albumentations.core.composition import Compose
+import os
 import json
 import yaml
-import copy
+import zlib
+import random
+import functools
+import image_codec
+import profiling
+import numpy as np
+import multiprocessing as mp
 import albumentations as A
 from tqdm import tqdm
 from yaml.loader import FullLoader
 from inspect import getmembers
-from utils import load_image, save_image, get_annotation_from_image_id
+from typing import Any
+from coco_stream import AnnotationIndex, CocoDatasetSink, CocoSection, CocoWriter, iter_coco_array, load_coco_header
+from image_pack import PackWriter
+from image_store import ImageStore
+from utils import load_image, save_image, encode_image, get_annotation_from_image_id, build_annotation_index, image_file_name
 
-def data_augmentation(aug_params: str, dataset: dict, data_folder: str='', aug_steps: int=1) -> None:
+def data_augmentation(aug_params: str, dataset: dict, data_folder: str='', aug_steps: int=1, num_workers: int=1, seed: int=None, streaming: bool=False, pack: bool=False, image_store: ImageStore=None) -> dict:
+    """Returns the augmented dataset, or the given one when no augmentation
+    is performed or in streaming mode, where records are only kept on disk.
+    With pack, augmented images are appended to pack files in the images
+    folder instead of one file each, see image_pack.PackWriter. With
+    image_store, augmented image files are moved to the store and linked."""
     if len(aug_params) > 1 and aug_steps >= 1:
         print('\n Performing Data Augmentation')
-        aug_dataset = copy.deepcopy(dataset)
-        transform = create_transformation(aug_params)
+        annotations_path = data_folder+'annotations/instances_default.json'
+        if streaming:
+            num_images = sum(1 for _ in iter_coco_array(annotations_path, 'images'))
+            name_bound = num_images * (aug_steps + 1)
+            images = WidenedImages(CocoSection(annotations_path, 'images'), data_folder, name_bound)
+            annotation_index = AnnotationIndex(annotations_path)
+            aug_dataset = CocoWriter(annotations_path, load_coco_header(annotations_path))
+        else:
+            num_images = len(dataset['images'])
+            name_bound = num_images * (aug_steps + 1)
+            images = list(WidenedImages(dataset['images'], data_folder, name_bound))
+            annotation_index = build_annotation_index(dataset)
+            aug_dataset = CocoDatasetSink(dict(dataset, images=list(images), annotations=list(dataset['annotations'])))
+        try:
+            if streaming:
+                for image_data in images:
+                    aug_dataset.add_image(image_data)
+                for annotation in iter_coco_array(annotations_path, 'annotations'):
+                    aug_dataset.add_annotation(annotation)
+            pack_writer = PackWriter(data_folder + 'images/') if pack else None
+            if num_workers > 1:
+                if seed is None:
+                    seed = random.randrange(2**32)
+                augment_parallel(aug_params, images, num_images, aug_dataset, annotation_index, data_folder, aug_steps, num_workers, seed, pack_writer, image_store)
+            else:
+                augment_serial(aug_params, images, num_images, aug_dataset, annotation_index, data_folder, aug_steps, seed, pack_writer, image_store)
+            if pack_writer is not None:
+                pack_writer.close()
+        except BaseException:
+            if streaming:
+                aug_dataset.abort()
+            raise
+        finally:
+            if streaming:
+                annotation_index.close()
+        profiling.add_images(aug_dataset.num_images - num_images)
+        with profiling.phase('json_save'):
+            profiling.add_images(aug_dataset.num_images)
+            if streaming:
+                aug_dataset.close()
+            else:
+                with open(annotations_path,'w') as f:
+                    json.dump(aug_dataset.dataset,f)
+        print('Done')
+        if not streaming:
+            return aug_dataset.dataset
+    return dataset
+
+def augment_serial(aug_params: str, images: list, num_images: int, aug_dataset: CocoDatasetSink, annotation_index: dict, data_folder: str, aug_steps: int, seed: int=None, pack_writer: PackWriter=None, image_store: ImageStore=None) -> None:
+    transform = create_transformation(aug_params)
+    name_bound = num_images * (aug_steps + 1)
+    for step in range(aug_steps):
+        print("Augmentation step: {}".format(step))
+        for image_idx, image_data in enumerate(tqdm(images, total=num_images)):
+            annotations = get_annotation_from_image_id(None, image_data['id'], annotation_index)
+            img_sufix = image_data['file_name'].split('/')[-1].split('.')[-1]
+            new_file_name = image_file_name(aug_dataset.num_images, img_sufix, name_bound)
+            new_path = data_folder + 'images/' + new_file_name
+            if image_store is not None and os.path.lexists(new_path):
+                # May be a link into the store from a previous run, never write through it
+                os.remove(new_path)
+            result = augment_image(transform, image_data, annotations, data_folder, new_file_name, sample_seed(seed, step, image_idx), pack_writer is not None)
+            if result is not None:
+                if pack_writer is not None:
+                    result['pack'] = pack_writer.write(result.pop('encoded'))
+                elif image_store is not None:
+                    image_store.store_output(new_path)
+                add_augmented_records(aug_dataset, image_data, annotations, result)
+
+def augment_parallel(aug_params: str, images: list, num_images: int, aug_dataset: CocoDatasetSink, annotation_index: dict, data_folder: str, aug_steps: int, num_workers: int, seed: int, pack_writer: PackWriter=None, image_store: ImageStore=None) -> None:
+    """Shards images across a process pool. Workers save to temporary files
+    which are renamed once the sample's ID is known, so IDs are assigned in
+    the same (step, image) order as augment_serial. When packing, workers
+    return the encoded image instead and this process appends it."""
+    def tasks(step):
+        for image_idx, image_data in enumerate(images):
+            annotations = get_annotation_from_image_id(None, image_data['id'], annotation_index)
+            img_sufix = image_data['file_name'].split('/')[-1].split('.')[-1]
+            tmp_file_name = '.aug_{}_{}.'.format(step, image_idx)+img_sufix
+            yield (image_data, annotations, data_folder, tmp_file_name, sample_seed(seed, step, image_idx), pack_writer is not None)
+
+    # Compiled before forking so workers inherit it from the cache
+    create_transformation(aug_params)
+    chunksize = max(1, min(64, num_images // (4 * num_workers)))
+    name_bound = num_images * (aug_steps + 1)
+    with mp.Pool(num_workers, initializer=init_augmentation_worker, initargs=(aug_params, image_codec.get_codec())) as pool:
         for step in range(aug_steps):
             print("Augmentation step: {}".format(step))
-            for image_data in tqdm(dataset['images']):
-                image_id = image_data['id']
-                annotations = get_annotation_from_image_id(dataset, image_id)
-                bboxes = [annotation['bbox'].copy() for annotation in annotations]
-                labels = [annotation['category_id'] for annotation in annotations]
-                keypoints, keypoint_map = polygon2keypoint(annotations)
-                img_path = data_folder + 'images/' + image_data['file_name'].split('/')[-1]
-                img_sufix = img_path.split('.')[-1]
-                img = load_image(img_path)
-                transformed = transform(image=img, bboxes=bboxes, class_labels=labels, keypoints=keypoints)
-                transformed_image = transformed['image']
-                transformed_bboxes = transformed['bboxes']
-                transformed_keypoints = transformed['keypoints']
-                if len(transformed_bboxes) == len(bboxes) and len(transformed_keypoints) == len(keypoints):
-                    h, w, _ = transformed_image.shape
-                    new_img = copy.deepcopy(image_data)
-                    new_img['id'] = len(aug_dataset['images'])
-                    new_img['file_name'] = '{:04d}.'.format(new_img['id'])+img_sufix
-                    new_img['height'] = h
-                    new_img['width'] = w
-                    aug_dataset['images'].append(new_img)
-                    for idx, annotation in enumerate(annotations):
-                        annotation['bbox'] = transformed_bboxes[idx]
-                        annotation['image_id'] = new_img['id']
-                        annotation['id'] = len(aug_dataset['annotations'])
-                        annotation['segmentation'] = keypoint2polygon(transformed_keypoints, keypoint_map, idx)
-                        aug_dataset['annotations'].append(annotation)
-                    new_img_path = data_folder + 'images/' + new_img['file_name']
-                    save_image(new_img_path, transformed_image)
-        with open(data_folder+'annotations/instances_default.json','w') as f:
-            json.dump(aug_dataset,f)
-        print('Done')
+            results = pool.imap(augment_image_worker, tasks(step), chunksize=chunksize)
+            for image_data, annotations, tmp_file_name, result in tqdm(results, total=num_images):
+                if result is None:
+                    continue
+                img_sufix = tmp_file_name.split('.')[-1]
+                result['file_name'] = image_file_name(aug_dataset.num_images, img_sufix, name_bound)
+                if pack_writer is not None:
+                    result['pack'] = pack_writer.write(result.pop('encoded'))
+                else:
+                    new_path = data_folder + 'images/' + result['file_name']
+                    os.replace(data_folder + 'images/' + tmp_file_name, new_path)
+                    if image_store is not None:
+                        image_store.store_output(new_path)
+                add_augmented_records(aug_dataset, image_data, annotations, result)
+
+_worker_transform = None
+
+def init_augmentation_worker(aug_params: str, codec: image_codec.ImageCodec) -> None:
+    global _worker_transform
+    image_codec.set_codec(codec)
+    _worker_transform = create_transformation(aug_params)
+
+def augment_image_worker(task: tuple) -> tuple:
+    image_data, annotations, data_folder, tmp_file_name, seed, pack = task
+    result = augment_image(_worker_transform, image_data, annotations, data_folder, tmp_file_name, seed, pack)
+    return image_data, annotations, tmp_file_name, result
+
+def sample_seed(seed: int, step: int, image_idx: int) -> int:
+    if seed is None:
+        return None
+    return zlib.crc32('{}-{}-{}'.format(seed, step, image_idx).encode())
+
+def augment_image(transform: Compose, image_data: dict, annotations: list, data_folder: str, new_file_name: str, seed: int=None, pack: bool=False) -> dict:
+    """Transforms one image and saves it as new_file_name, or returns it
+    encoded when pack is set. Returns None if the transformation dropped any
+    bbox or keypoint, as the sample is discarded."""
+    if seed is not None:
+        random.seed(seed)
+        np.random.seed(seed)
+    bboxes = [annotation['bbox'].copy() for annotation in annotations]
+    labels = [annotation['category_id'] for annotation in annotations]
+    keypoints, part_offsets, annotation_offsets = polygon2keypoint(annotations)
+    img_path = data_folder + 'images/' + image_data['file_name'].split('/')[-1]
+    img = load_image(img_path)
+    transformed = transform(image=img, bboxes=bboxes, class_labels=labels, keypoints=keypoints.tolist())
+    transformed_image = transformed['image']
+    transformed_bboxes = transformed['bboxes']
+    transformed_keypoints = transformed['keypoints']
+    if len(transformed_bboxes) != len(bboxes) or len(transformed_keypoints) != len(keypoints):
+        return None
+    h, w, _ = transformed_image.shape
+    result = {}
+    if pack:
+        result['encoded'] = encode_image(transformed_image, new_file_name.split('.')[-1])
+    else:
+        save_image(data_folder + 'images/' + new_file_name, transformed_image)
+    result.update({
+        'file_name': new_file_name,
+        'height': h,
+        'width': w,
+        'bboxes': transformed_bboxes,
+        'keypoints': np.asarray(transformed_keypoints, dtype=np.float64).reshape(-1, 2),
+        'part_offsets': part_offsets,
+        'annotation_offsets': annotation_offsets
+    })
+    return result
+
+class WidenedImages:
+    """Re-iterable view of the image records with file names padded for
+    name_bound images, renaming files named with a narrower width. Once the
+    augmented images push the IDs past the split's width, all names of the
+    folder keep sorting like their IDs."""
+    def __init__(self, images, data_folder: str, name_bound: int):
+        self.images = images
+        self.data_folder = data_folder
+        self.name_bound = name_bound
+
+    def __iter__(self):
+        for image_data in self.images:
+            stem, _, img_sufix = image_data['file_name'].rpartition('.')
+            file_name = image_file_name(image_data['id'], img_sufix, self.name_bound)
+            # Only names given by the split, i.e. the padded ID
+            if file_name == image_data['file_name'] or not stem.isdigit() or int(stem) != image_data['id']:
+                yield image_data
+                continue
+            old_path = self.data_folder + 'images/' + image_data['file_name']
+            if os.path.lexists(old_path):
+                os.replace(old_path, self.data_folder + 'images/' + file_name)
+            yield dict(image_data, file_name=file_name)
+
+def add_augmented_records(aug_dataset: CocoDatasetSink, image_data: dict, annotations: list, result: dict) -> None:
+    new_img = dict(image_data)
+    new_img['id'] = aug_dataset.num_images
+    new_img['file_name'] = result['file_name']
+    new_img['height'] = result['height']
+    new_img['width'] = result['width']
+    if 'pack' in result:
+        new_img['pack'] = result['pack']
+    aug_dataset.add_image(new_img)
+    for idx, annotation in enumerate(annotations):
+        annotation['bbox'] = result['bboxes'][idx]
+        annotation['image_id'] = new_img['id']
+        annotation['id'] = aug_dataset.num_annotations
+        annotation['segmentation'] = keypoint2polygon(result['keypoints'], result['part_offsets'], result['annotation_offsets'], idx)
+        aug_dataset.add_annotation(annotation)
+
+# Compiled pipelines by canonical parameters, and canonical parameters by
+# raw YAML string so repeated calls skip parsing too
+_compiled_transformations = {}
+_transformation_keys = {}
+
+@functools.lru_cache(maxsize=None)
+def transformation_registry() -> dict:
+    return {a:b for (a,b) in getmembers(A)}
+
+def canonical_params(params_dict: dict) -> str:
+    # Transformation order matters, only the parameters of each one are sorted
+    return json.dumps([[name, params] for name, params in params_dict.items()], sort_keys=True, default=repr)
 
 def create_transformation(aug_params: str) -> Compose:
-    try: 
-        params_dict = yaml.load(aug_params, Loader=FullLoader)
-    except:
-        raise ValueError('Parameters must have a valid YAML format')
-    if not isinstance(params_dict, dict):
-        raise TypeError('Parameters must have a valid YAML format')
-    members_dict = {a:b for (a,b) in getmembers(A)}
+    key = _transformation_keys.get(aug_params)
+    if key is None:
+        try: 
+            params_dict = yaml.load(aug_params, Loader=FullLoader)
+        except:
+            raise ValueError('Parameters must have a valid YAML format')
+        if not isinstance(params_dict, dict):
+            raise TypeError('Parameters must have a valid YAML format')
+        key = canonical_params(params_dict)
+        if key not in _compiled_transformations:
+            _compiled_transformations[key] = compile_transformation(params_dict)
+        _transformation_keys[aug_params] = key
+    return _compiled_transformations[key]
+
+def compile_transformation(params_dict: dict) -> Compose:
+    members_dict = transformation_registry()
     transformation_list = []
     for transformation in params_dict.keys():
         if transformation in members_dict:
@@ -69,27 +264,30 @@ def create_transformation(aug_params: str) -> Compose:
     )
     return transform
 
-def polygon2keypoint(segmentations: list) -> list:
-    keypoints = []
-    keypoints_map = []
-    counter = 0
-    for segmentation in segmentations:
-        keypoint_map = []
-        if len(segmentation['segmentation']) == 1:
-            for idx in range(len(segmentation['segmentation'][0])//2):
-                keypoints.append([segmentation['segmentation'][0][2*idx], segmentation['segmentation'][0][2*idx+1]])
-                keypoint_map.append(counter)
-                counter = counter + 1
-            keypoints_map.append(keypoint_map)
-    return keypoints, keypoints_map
-
-def keypoint2polygon(keypoints: list, keypoint_map: list, idx: int) -> list:
-    segmentation = []
-    if len(keypoint_map) > idx:
-        for map_idx in keypoint_map[idx]:
-            segmentation.append(keypoints[map_idx][0])
-            segmentation.append(keypoints[map_idx][1])
-    if len(segmentation) > 4:
-        return [segmentation]
+def polygon2keypoint(annotations: list) -> tuple:
+    """Flattens the polygons of all annotations into one [K, 2] keypoint array.
+    part_offsets[p]:part_offsets[p+1] are the keypoints of polygon part p and
+    annotation_offsets[a]:annotation_offsets[a+1] the parts of annotation a,
+    so multi-part polygons survive the round trip."""
+    parts = []
+    annotation_offsets = [0]
+    for annotation in annotations:
+        for polygon in annotation['segmentation']:
+            parts.append(np.asarray(polygon[:len(polygon)//2*2], dtype=np.float64))
+        annotation_offsets.append(len(parts))
+    part_lengths = [len(part)//2 for part in parts]
+    part_offsets = np.concatenate([[0], np.cumsum(part_lengths, dtype=np.int64)])
+    if parts:
+        keypoints = np.concatenate(parts).reshape(-1, 2)
     else:
-        return []
\ No newline at end of file
+        keypoints = np.zeros((0, 2), dtype=np.float64)
+    return keypoints, part_offsets, np.asarray(annotation_offsets, dtype=np.int64)
+
+def keypoint2polygon(keypoints: Any, part_offsets: Any, annotation_offsets: Any, idx: int) -> list:
+    keypoints = np.asarray(keypoints, dtype=np.float64).reshape(-1, 2)
+    segmentation = []
+    for part in range(annotation_offsets[idx], annotation_offsets[idx+1]):
+        polygon = keypoints[part_offsets[part]:part_offsets[part+1]].ravel()
+        if len(polygon) > 4:
+            segmentation.append(polygon.tolist())
+    return segmentation
@@ -0,0 +1,140 @@
+import io
+import os
+import cv2
+import numpy as np
+from PIL import Image
+
+try:
+    from turbojpeg import TurboJPEG, TJPF_RGB, TJSAMP_420
+    _turbojpeg = TurboJPEG()
+except (ImportError, OSError, RuntimeError):
+    # PyTurboJPEG missing, or installed without the libjpeg-turbo library.
+    # maskrcnn-training's mrcnn/utils.read_image has the same fallbacks.
+    _turbojpeg = None
+
+BACKENDS = ('auto', 'opencv', 'pil', 'turbojpeg')
+JPEG_EXTENSIONS = ('jpg', 'jpeg')
+# Scales supported by libjpeg DCT scaling, other formats are resized by OpenCV
+DECODE_SCALES = (1, 2, 4, 8)
+DEFAULT_JPEG_QUALITY = 95
+OPENCV_REDUCED_FLAGS = {
+    1: cv2.IMREAD_COLOR,
+    2: cv2.IMREAD_REDUCED_COLOR_2,
+    4: cv2.IMREAD_REDUCED_COLOR_4,
+    8: cv2.IMREAD_REDUCED_COLOR_8,
+}
+
+def available_backends() -> list:
+    backends = ['opencv', 'pil']
+    if _turbojpeg is not None:
+        backends.append('turbojpeg')
+    return backends
+
+def extension_of(path: str) -> str:
+    return os.path.splitext(path)[1][1:].lower()
+
+class ImageCodec:
+    """Decodes files to RGB uint8 arrays and encodes them back.
+
+    backend 'auto' uses TurboJPEG for JPEGs when it is installed and OpenCV
+    for everything else. 'pil' is also the Pillow-SIMD backend, as it installs
+    as a drop-in PIL. Non-JPEG formats always go through OpenCV.
+    scale decodes at 1/2, 1/4 or 1/8 of the size, for consumers that downscale
+    anyway: JPEGs skip most of the IDCT work, so this is much cheaper than a
+    full decode followed by a resize.
+    quality is the JPEG/WebP quality, OpenCV's default of 95 when None.
+    """
+    def __init__(self, backend: str='auto', quality: int=None):
+        if backend not in BACKENDS:
+            raise ValueError('Unknown image backend {}, choose from: {}'.format(backend, ', '.join(BACKENDS)))
+        if backend == 'turbojpeg' and _turbojpeg is None:
+            raise ValueError('The turbojpeg backend needs PyTurboJPEG and libjpeg-turbo')
+        if quality is not None and not 1 <= quality <= 100:
+            raise ValueError('Quality must be between 1 and 100, got {}'.format(quality))
+        self.backend = backend
+        self.quality = quality
+
+    def jpeg_backend(self) -> str:
+        if self.backend == 'auto':
+            return 'turbojpeg' if _turbojpeg is not None else 'opencv'
+        return self.backend
+
+    def backend_for(self, extension: str) -> str:
+        return self.jpeg_backend() if extension in JPEG_EXTENSIONS else 'opencv'
+
+    def read(self, path: str, scale: int=1) -> np.ndarray:
+        check_scale(scale)
+        if self.backend_for(extension_of(path)) == 'opencv':
+            # Let OpenCV read the file itself, saving a copy of the bytes
+            image = cv2.imread(path, OPENCV_REDUCED_FLAGS[scale])
+            if image is None:
+                raise ValueError('Failed to read image {}'.format(path))
+            return cv2.cvtColor(image, cv2.COLOR_BGR2RGB)
+        with open(path, 'rb') as f:
+            return self.decode(f.read(), extension_of(path), scale)
+
+    def decode(self, data: bytes, extension: str, scale: int=1) -> np.ndarray:
+        check_scale(scale)
+        backend = self.backend_for(extension)
+        if backend == 'turbojpeg':
+            return _turbojpeg.decode(data, pixel_format=TJPF_RGB, scaling_factor=(1, scale))
+        if backend == 'pil':
+            image = Image.open(io.BytesIO(data))
+            if scale > 1:
+                image.draft('RGB', (image.width // scale, image.height // scale))
+            return np.array(image.convert('RGB'))
+        image = cv2.imdecode(np.frombuffer(data, dtype=np.uint8), OPENCV_REDUCED_FLAGS[scale])
+        if image is None:
+            raise ValueError('Failed to decode {} image'.format(extension))
+        return cv2.cvtColor(image, cv2.COLOR_BGR2RGB)
+
+    def write(self, path: str, image: np.ndarray) -> None:
+        extension = extension_of(path)
+        if self.backend_for(extension) == 'opencv':
+            image = cv2.cvtColor(image, cv2.COLOR_RGB2BGR)
+            if not cv2.imwrite(path, image, self.opencv_params(extension)):
+                raise ValueError('Failed to write image {}'.format(path))
+            return
+        data = self.encode(image, extension)
+        with open(path, 'wb') as f:
+            f.write(data)
+
+    def encode(self, image: np.ndarray, extension: str) -> bytes:
+        extension = extension.lower()
+        backend = self.backend_for(extension)
+        quality = self.quality or DEFAULT_JPEG_QUALITY
+        if backend == 'turbojpeg':
+            # Same chroma subsampling as OpenCV, PyTurboJPEG defaults to 4:2:2
+            return _turbojpeg.encode(np.ascontiguousarray(image), quality=quality, pixel_format=TJPF_RGB, jpeg_subsample=TJSAMP_420)
+        if backend == 'pil':
+            output_io = io.BytesIO()
+            Image.fromarray(image).save(output_io, format='JPEG', quality=quality)
+            return output_io.getvalue()
+        image = cv2.cvtColor(image, cv2.COLOR_RGB2BGR)
+        success, encoded = cv2.imencode('.' + extension, image, self.opencv_params(extension))
+        if not success:
+            raise ValueError('Failed to encode image as {}'.format(extension))
+        return encoded.tobytes()
+
+    def opencv_params(self, extension: str) -> list:
+        if self.quality is None:
+            return []
+        if extension in JPEG_EXTENSIONS:
+            return [cv2.IMWRITE_JPEG_QUALITY, self.quality]
+        if extension == 'webp':
+            return [cv2.IMWRITE_WEBP_QUALITY, self.quality]
+        return []
+
+def check_scale(scale: int) -> None:
+    if scale not in DECODE_SCALES:
+        raise ValueError('Decode scale must be one of {}, got {}'.format(DECODE_SCALES, scale))
+
+_codec = ImageCodec()
+
+def get_codec() -> ImageCodec:
+    return _codec
+
+def set_codec(codec: ImageCodec) -> None:
+    """Sets the codec used by utils.load_image/save_image/encode_image."""
+    global _codec
+    _codec = codec
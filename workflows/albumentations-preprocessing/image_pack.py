@@ -0,0 +1,44 @@
+import os
+
+# Roll over to a new pack file past this size
+MAX_PACK_BYTES = 1 << 30
+
+class PackWriter:
+    """Appends encoded images to numbered pack files in a directory.
+
+    A pack is the plain concatenation of encoded images, the COCO image
+    record indexes it with a 'pack' entry: {"file", "offset", "length"}.
+    This replaces one small file per augmented image with a few large ones.
+    """
+    def __init__(self, directory: str, prefix: str='augmented', max_pack_bytes: int=MAX_PACK_BYTES):
+        self.directory = directory
+        self.prefix = prefix
+        self.max_pack_bytes = max_pack_bytes
+        self.pack_idx = -1
+        self.file = None
+        self.file_name = None
+        self.offset = 0
+
+    def pack_name(self, pack_idx: int) -> str:
+        return '{}-{:05d}.pack'.format(self.prefix, pack_idx)
+
+    def open_next(self) -> None:
+        if self.file is not None:
+            self.file.close()
+        self.pack_idx += 1
+        self.file_name = self.pack_name(self.pack_idx)
+        self.file = open(os.path.join(self.directory, self.file_name), 'wb')
+        self.offset = 0
+
+    def write(self, data: bytes) -> dict:
+        if self.file is None or (self.offset and self.offset + len(data) > self.max_pack_bytes):
+            self.open_next()
+        self.file.write(data)
+        pack = {'file': self.file_name, 'offset': self.offset, 'length': len(data)}
+        self.offset += len(data)
+        return pack
+
+    def close(self) -> None:
+        if self.file is not None:
+            self.file.close()
+            self.file = None
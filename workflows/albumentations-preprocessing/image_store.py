@@ -0,0 +1,114 @@
+import os
+import json
+import shutil
+import hashlib
+import tempfile
+import threading
+import functools
+from concurrent.futures import ThreadPoolExecutor
+from utils import transfer_file
+
+INDEX_FILE_NAME = 'index.json'
+
+class ImageStore:
+    """Content-addressed image store shared between runs.
+
+    Each distinct image is kept once as objects/<2 hex>/<sha256>.<ext> and
+    dataset folders link to it, so re-runs and sibling experiments over the
+    same export share storage and skip the copy. The digests of source files
+    are cached by path, size and mtime in index.json, so unchanged sources are
+    not read again either. Objects are never modified in place: datasets can
+    hardlink or reflink them, which needs the store on the output filesystem,
+    otherwise files are copied out of it.
+    """
+    def __init__(self, root: str, link_mode: str='hardlink'):
+        self.root = root
+        # Copying out of the store would defeat its purpose
+        self.link_mode = 'hardlink' if link_mode == 'copy' else link_mode
+        self.lock = threading.Lock()
+        os.makedirs(os.path.join(root, 'objects'), exist_ok=True)
+        self.index_path = os.path.join(root, INDEX_FILE_NAME)
+        self.index = {}
+        if os.path.isfile(self.index_path):
+            with open(self.index_path) as f:
+                self.index = json.load(f)
+
+    def file_digest(self, path: str, cache: bool=True) -> str:
+        path = os.path.abspath(path)
+        stat = os.stat(path)
+        with self.lock:
+            cached = self.index.get(path)
+        if cached and cached[0] == stat.st_size and cached[1] == stat.st_mtime_ns:
+            return cached[2]
+        digest = hashlib.sha256()
+        with open(path, 'rb') as f:
+            for chunk in iter(functools.partial(f.read, 1 << 20), b''):
+                digest.update(chunk)
+        if cache:
+            with self.lock:
+                self.index[path] = [stat.st_size, stat.st_mtime_ns, digest.hexdigest()]
+        return digest.hexdigest()
+
+    def object_path(self, digest: str, extension: str) -> str:
+        return os.path.join(self.root, 'objects', digest[:2], '{}.{}'.format(digest, extension.lower()))
+
+    def add(self, path: str, move: bool=False) -> str:
+        """Stores the file if its content is new and returns the object path.
+        With move, the file is consumed, for outputs that are not kept."""
+        extension = path.split('.')[-1]
+        # Consumed files are not worth caching
+        object_path = self.object_path(self.file_digest(path, cache=not move), extension)
+        if os.path.exists(object_path):
+            if move:
+                os.remove(path)
+            return object_path
+        os.makedirs(os.path.dirname(object_path), exist_ok=True)
+        if move:
+            try:
+                os.replace(path, object_path)
+                return object_path
+            except OSError:
+                # Different filesystem, copy then remove
+                pass
+        # Copy under a temporary name, so concurrent runs never see a partial object
+        fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(object_path), suffix='.tmp')
+        os.close(fd)
+        try:
+            shutil.copyfile(path, tmp_path)
+            os.replace(tmp_path, object_path)
+        except BaseException:
+            os.remove(tmp_path)
+            raise
+        if move:
+            os.remove(path)
+        return object_path
+
+    def checkout(self, object_path: str, dst: str) -> None:
+        transfer_file(object_path, dst, self.link_mode)
+
+    def transfer_file(self, src: str, dst: str) -> None:
+        self.checkout(self.add(src), dst)
+
+    def store_output(self, path: str) -> None:
+        """Moves a generated file into the store and links it back."""
+        self.checkout(self.add(path, move=True), path)
+
+    def transfer_files(self, file_transfers: list, num_workers: int=1) -> None:
+        if num_workers <= 1:
+            for src, dst in file_transfers:
+                self.transfer_file(src, dst)
+        else:
+            with ThreadPoolExecutor(max_workers=num_workers) as executor:
+                futures = [executor.submit(self.transfer_file, src, dst) for src, dst in file_transfers]
+                for future in futures:
+                    future.result()
+        self.save()
+
+    def save(self) -> None:
+        with self.lock:
+            # Drop sources that no longer exist so the index does not grow forever
+            self.index = {path: entry for path, entry in self.index.items() if os.path.exists(path)}
+            tmp_path = self.index_path + '.{}.tmp'.format(os.getpid())
+            with open(tmp_path, 'w') as f:
+                json.dump(self.index, f)
+            os.replace(tmp_path, self.index_path)
@@ -2,26 +2,52 @@ import os
 import argparse
 from val_split import split_dataset
 from data_augmentation import data_augmentation
+from image_codec import BACKENDS, ImageCodec, set_codec
+from image_store import ImageStore
+from profiling import PROFILE_FILE_NAME, enable_profiling, phase
 from utils import export_dataset
 
             
 def main(args: argparse.Namespace) -> int:
 
-    train_set, val_set = split_dataset(
-        dataset_name=args.annotations_filename, 
-        val_split=args.val_split, 
-        input_path=args.input_folder, 
-        output_path=args.output_folder
-    )
+    set_codec(ImageCodec(args.image_backend, args.image_quality))
+    profiler = enable_profiling() if args.profile else None
+    image_store = ImageStore(args.image_store, args.link_mode) if args.image_store else None
 
-    data_augmentation(
-        args.data_aug_params, 
-        train_set, 
-        data_folder=os.path.join(args.output_folder, 'train_set/'),
-        aug_steps= args.aug_steps
-    )
+    with phase('split'):
+        train_set, val_set = split_dataset(
+            dataset_name=args.annotations_filename, 
+            val_split=args.val_split, 
+            input_path=args.input_folder, 
+            output_path=args.output_folder,
+            num_workers=args.num_workers,
+            link_mode=args.link_mode,
+            streaming=args.streaming,
+            image_store=image_store,
+            stratify=args.stratify
+        )
 
-    export_dataset(train_set, args.format, args.output_folder)
+    with phase('augmentation'):
+        train_set = data_augmentation(
+            args.data_aug_params, 
+            train_set, 
+            data_folder=os.path.join(args.output_folder, 'train_set/'),
+            aug_steps= args.aug_steps,
+            num_workers=args.num_workers,
+            seed=args.aug_seed,
+            streaming=args.streaming,
+            pack=args.pack_augmented,
+            image_store=image_store
+        )
+
+    with phase('export') as export_phase:
+        export_dataset(train_set, args.format, args.output_folder, val_set=None if args.streaming else val_set, num_workers=args.export_workers, include_masks=args.include_masks)
+        if args.format and not args.streaming:
+            # Streaming runs only hold the dataset headers
+            export_phase.add_images(len(train_set['images']) + len(val_set['images']))
+
+    if profiler is not None:
+        profiler.save(os.path.join(args.output_folder, PROFILE_FILE_NAME))
     
     return 0
 
@@ -34,5 +60,17 @@ if __name__ == "__main__":
     parser.add_argument('--aug_steps', default=1, type=int)
     parser.add_argument('--data_aug_params', default='')
     parser.add_argument('--format', default=None)
+    parser.add_argument('--include_masks', action='store_true', help='Write the instance masks to the TFRecords, needed to train Mask R-CNN on them')
+    parser.add_argument('--stratify', action='store_true', help='Split the images of each rarest-category stratum at val_split instead of drawing them at random')
+    parser.add_argument('--num_workers', default=1, type=int)
+    parser.add_argument('--aug_seed', default=None, type=int)
+    parser.add_argument('--export_workers', default=None, type=int, help='Processes shared by the train and eval exports, one per CPU by default')
+    parser.add_argument('--streaming', action='store_true')
+    parser.add_argument('--pack_augmented', action='store_true', help='Write augmented images to pack files instead of one file each')
+    parser.add_argument('--image_backend', default='auto', choices=BACKENDS, help='JPEG codec, auto uses TurboJPEG when installed')
+    parser.add_argument('--image_quality', default=None, type=int, help='JPEG/WebP quality of augmented images, 95 when unset')
+    parser.add_argument('--profile', action='store_true', help='Save time, I/O, images/s and peak memory per phase to {} in the output folder'.format(PROFILE_FILE_NAME))
+    parser.add_argument('--image_store', default=None, help='Content-addressed image store shared between runs, best on the output filesystem so images can be linked')
+    parser.add_argument('--link_mode', default='copy', choices=['copy', 'hardlink', 'reflink', 'symlink'])
     args = parser.parse_args()
     main(args)
\ No newline at end of file
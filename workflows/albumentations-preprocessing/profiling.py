@@ -0,0 +1,136 @@
+import json
+import time
+import resource
+import contextlib
+
+PROFILE_FILE_NAME = 'preprocessing_profile.json'
+
+def read_io_counters() -> tuple:
+    """Bytes read and written through syscalls by this process. Linux adds
+    the counters of reaped children, so pool workers and subprocesses are
+    included once they have exited. (0, 0) where /proc is not available."""
+    counters = {}
+    try:
+        with open('/proc/self/io') as f:
+            for line in f:
+                key, value = line.split(':')
+                counters[key] = int(value)
+    except OSError:
+        pass
+    return counters.get('rchar', 0), counters.get('wchar', 0)
+
+def reset_peak_rss() -> None:
+    # Resets VmHWM so it measures the phase only, needs Linux >= 4.0
+    try:
+        with open('/proc/self/clear_refs', 'w') as f:
+            f.write('5')
+    except OSError:
+        pass
+
+def read_peak_rss() -> int:
+    """Peak resident set size in bytes since the last reset_peak_rss."""
+    try:
+        with open('/proc/self/status') as f:
+            for line in f:
+                if line.startswith('VmHWM:'):
+                    return int(line.split()[1]) * 1024
+    except OSError:
+        pass
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+
+def children_peak_rss() -> int:
+    return resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss * 1024
+
+class Phase:
+    def __init__(self, name: str):
+        self.name = name
+        self.seconds = 0.0
+        self.bytes_read = 0
+        self.bytes_written = 0
+        self.peak_rss = 0
+        self.images = None
+        # Totals of the phases nested in this one
+        self.nested = [0.0, 0, 0]
+
+    def add_images(self, num_images: int) -> None:
+        self.images = (self.images or 0) + num_images
+
+class Profiler:
+    """Records wall time, bytes read/written, images per second and peak RSS
+    per pipeline phase. Phases may nest, e.g. the JSON save inside the split:
+    the time, I/O and peak RSS of a nested phase are not counted again in its
+    parent, so the phases add up to the whole run. A phase entered several
+    times accumulates."""
+    def __init__(self):
+        self.phases = {}
+        self.stack = []
+
+    @contextlib.contextmanager
+    def phase(self, name: str):
+        phase = self.phases.setdefault(name, Phase(name))
+        parent = self.stack[-1] if self.stack else None
+        if parent is not None:
+            parent.peak_rss = max(parent.peak_rss, read_peak_rss())
+        reset_peak_rss()
+        children_rss = children_peak_rss()
+        start_nested = list(phase.nested)
+        start_read, start_written = read_io_counters()
+        start = time.perf_counter()
+        self.stack.append(phase)
+        try:
+            yield phase
+        finally:
+            self.stack.pop()
+            total = [time.perf_counter() - start]
+            end_read, end_written = read_io_counters()
+            total += [end_read - start_read, end_written - start_written]
+            own = [value - (nested - start_value) for value, nested, start_value in zip(total, phase.nested, start_nested)]
+            phase.seconds += own[0]
+            phase.bytes_read += own[1]
+            phase.bytes_written += own[2]
+            peak_rss = read_peak_rss()
+            if children_peak_rss() > children_rss:
+                peak_rss = max(peak_rss, children_peak_rss())
+            phase.peak_rss = max(phase.peak_rss, peak_rss)
+            if parent is not None:
+                parent.nested = [nested + value for nested, value in zip(parent.nested, total)]
+                reset_peak_rss()
+
+    def metrics(self) -> list:
+        """Metrics in the [{"name", "value"}] format of the metrics-writer task."""
+        metrics = []
+        for phase in self.phases.values():
+            metrics.append({'name': phase.name + '_seconds', 'value': round(phase.seconds, 3)})
+            metrics.append({'name': phase.name + '_bytes_read', 'value': phase.bytes_read})
+            metrics.append({'name': phase.name + '_bytes_written', 'value': phase.bytes_written})
+            metrics.append({'name': phase.name + '_peak_rss_mb', 'value': round(phase.peak_rss / 2**20, 1)})
+            if phase.images is not None:
+                metrics.append({'name': phase.name + '_images', 'value': phase.images})
+                if phase.seconds > 0:
+                    metrics.append({'name': phase.name + '_images_per_second', 'value': round(phase.images / phase.seconds, 1)})
+        return metrics
+
+    def save(self, path: str) -> None:
+        with open(path, 'w') as f:
+            json.dump(self.metrics(), f, indent=2)
+
+_profiler = None
+
+def enable_profiling() -> Profiler:
+    global _profiler
+    _profiler = Profiler()
+    return _profiler
+
+@contextlib.contextmanager
+def phase(name: str):
+    """Profiles the block as the named phase when profiling is enabled."""
+    if _profiler is None:
+        yield Phase(name)
+    else:
+        with _profiler.phase(name) as profiled_phase:
+            yield profiled_phase
+
+def add_images(num_images: int) -> None:
+    """Counts images processed by the innermost running phase."""
+    if _profiler is not None and _profiler.stack:
+        _profiler.stack[-1].add_images(num_images)
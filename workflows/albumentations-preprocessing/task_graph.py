@@ -0,0 +1,54 @@
+import time
+import threading
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+
+def run_task_graph(tasks: dict, max_concurrency: int) -> None:
+    """Runs tasks as soon as their dependencies are done, at most
+    max_concurrency at once. tasks maps names to (func, dependencies), func
+    is called with a threading.Event which is set to ask it to stop early.
+
+    Fails fast: on the first error no new task starts, the running ones are
+    cancelled through the event and the error is raised once they returned.
+    """
+    for name, (_, dependencies) in tasks.items():
+        unknown = [dependency for dependency in dependencies if dependency not in tasks]
+        if unknown:
+            raise ValueError('Task {} depends on unknown tasks: {}'.format(name, ', '.join(unknown)))
+    cancel_event = threading.Event()
+    pending = dict(tasks)
+    done = set()
+    running = {}
+    error = None
+
+    def run(name, func):
+        start = time.perf_counter()
+        func(cancel_event)
+        return time.perf_counter() - start
+
+    with ThreadPoolExecutor(max_workers=max_concurrency) as executor:
+        while pending or running:
+            if error is None:
+                ready = [name for name, (_, dependencies) in pending.items() if done.issuperset(dependencies)]
+                for name in ready[:max_concurrency - len(running)]:
+                    func, _ = pending.pop(name)
+                    print('Started {}'.format(name))
+                    running[executor.submit(run, name, func)] = name
+                if not running:
+                    raise ValueError('Circular dependencies between tasks: {}'.format(', '.join(pending)))
+            elif not running:
+                break
+            finished, _ = wait(running, return_when=FIRST_COMPLETED)
+            for future in finished:
+                name = running.pop(future)
+                try:
+                    seconds = future.result()
+                except Exception as e:
+                    if error is None:
+                        error = e
+                        print('Failed {}, cancelling {}'.format(name, ', '.join(running.values()) or 'nothing'))
+                        cancel_event.set()
+                    continue
+                done.add(name)
+                print('Finished {} in {:.1f}s ({}/{} tasks)'.format(name, seconds, len(done), len(tasks)))
+    if error is not None:
+        raise error
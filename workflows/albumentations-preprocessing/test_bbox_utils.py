@@ -0,0 +1,86 @@
+import numpy as np
+import pytest
+
+import bbox_utils
+
+SEEDS = range(20)
+
+def random_coco_boxes(rng: np.random.Generator, num_boxes: int, height, width) -> np.ndarray:
+    """Boxes inside images of the given sizes, scalars or one per box."""
+    height = np.broadcast_to(height, (num_boxes,))
+    width = np.broadcast_to(width, (num_boxes,))
+    box_width = rng.uniform(1, width)
+    box_height = rng.uniform(1, height)
+    x_min = rng.uniform(0, width - box_width)
+    y_min = rng.uniform(0, height - box_height)
+    return np.stack([x_min, y_min, box_width, box_height], axis=1)
+
+def random_sizes(rng: np.random.Generator, num_boxes: int) -> tuple:
+    return rng.integers(16, 4000, num_boxes), rng.integers(16, 4000, num_boxes)
+
+def test_known_values():
+    coco = [[10, 20, 30, 40]]
+    albumentations = bbox_utils.coco_to_albumentations(coco, 100, 200)
+    np.testing.assert_allclose(albumentations, [[0.05, 0.2, 0.2, 0.6]])
+    np.testing.assert_allclose(bbox_utils.coco_to_tfod(coco, 100, 200), [[0.2, 0.05, 0.6, 0.2]])
+    np.testing.assert_allclose(bbox_utils.albumentations_to_coco(albumentations, 100, 200), coco)
+
+def test_albumentations_to_coco_height():
+    # Heights used to come out as y_max - y_max, always zero
+    coco = bbox_utils.albumentations_to_coco([[0.1, 0.25, 0.5, 0.75]], 200, 100)
+    np.testing.assert_allclose(coco, [[10, 50, 40, 100]])
+
+@pytest.mark.parametrize('seed', SEEDS)
+def test_coco_albumentations_round_trip(seed):
+    rng = np.random.default_rng(seed)
+    coco = random_coco_boxes(rng, 50, 480, 640)
+    albumentations = bbox_utils.coco_to_albumentations(coco, 480, 640)
+    assert np.all((albumentations >= 0) & (albumentations <= 1))
+    assert np.all(albumentations[:, 2:] > albumentations[:, :2])
+    np.testing.assert_allclose(bbox_utils.albumentations_to_coco(albumentations, 480, 640), coco)
+
+@pytest.mark.parametrize('seed', SEEDS)
+def test_albumentations_tfod_round_trip(seed):
+    rng = np.random.default_rng(seed)
+    albumentations = bbox_utils.coco_to_albumentations(random_coco_boxes(rng, 50, 1, 1), 1, 1)
+    tfod = bbox_utils.albumentations_to_tfod(albumentations)
+    np.testing.assert_array_equal(tfod[:, [0, 2]], albumentations[:, [1, 3]])
+    np.testing.assert_array_equal(tfod[:, [1, 3]], albumentations[:, [0, 2]])
+    np.testing.assert_array_equal(bbox_utils.tfod_to_albumentations(tfod), albumentations)
+
+@pytest.mark.parametrize('seed', SEEDS)
+def test_coco_tfod_round_trip(seed):
+    rng = np.random.default_rng(seed)
+    coco = random_coco_boxes(rng, 50, 1080, 1920)
+    tfod = bbox_utils.coco_to_tfod(coco, 1080, 1920)
+    np.testing.assert_allclose(bbox_utils.tfod_to_coco(tfod, 1080, 1920), coco)
+    # Same as going through albumentations
+    np.testing.assert_array_equal(
+        tfod, bbox_utils.albumentations_to_tfod(bbox_utils.coco_to_albumentations(coco, 1080, 1920)))
+
+@pytest.mark.parametrize('seed', SEEDS)
+def test_per_box_image_sizes(seed):
+    """Converting a dataset at once, with each box's image size, gives the
+    boxes of converting every image on its own."""
+    rng = np.random.default_rng(seed)
+    heights, widths = random_sizes(rng, 40)
+    coco = random_coco_boxes(rng, 40, heights, widths)
+    albumentations = bbox_utils.coco_to_albumentations(coco, heights, widths)
+    tfod = bbox_utils.coco_to_tfod(coco, heights, widths)
+    for k in range(len(coco)):
+        np.testing.assert_array_equal(
+            albumentations[k:k + 1], bbox_utils.coco_to_albumentations(coco[k:k + 1], heights[k], widths[k]))
+        np.testing.assert_array_equal(
+            tfod[k:k + 1], bbox_utils.coco_to_tfod(coco[k:k + 1], heights[k], widths[k]))
+    np.testing.assert_allclose(bbox_utils.albumentations_to_coco(albumentations, heights, widths), coco)
+    np.testing.assert_allclose(bbox_utils.tfod_to_coco(tfod, heights, widths), coco)
+
+def test_empty_boxes():
+    for convert in (bbox_utils.coco_to_albumentations, bbox_utils.albumentations_to_coco,
+                    bbox_utils.coco_to_tfod, bbox_utils.tfod_to_coco):
+        assert convert([], 100, 200).shape == (0, 4)
+    assert bbox_utils.albumentations_to_tfod([]).shape == (0, 4)
+
+def test_bad_shape():
+    with pytest.raises(ValueError):
+        bbox_utils.coco_to_albumentations([[1, 2, 3]], 100, 200)
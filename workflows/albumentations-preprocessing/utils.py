@@ -1,78 +1,207 @@
 import os
+import sys
 import json
-import copy
-import cv2
+import fcntl
+import shutil
 import subprocess
+import collections
+import multiprocessing as mp
+import bbox_utils
+import image_codec
+import profiling
+from task_graph import run_task_graph
+from concurrent.futures import ThreadPoolExecutor
 from typing import Any
 
 from cv2 import data
 
+LINK_MODES = ('copy', 'hardlink', 'reflink', 'symlink')
+# ioctl request number of FICLONE on Linux (btrfs, xfs, ...)
+FICLONE = 0x40049409
+# Image files are named after their ID, zero padded to at least this width
+FILE_NAME_MIN_WIDTH = 4
+TFRECORD_UTILS_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'utils')
+
 def save_datasets(output_path, train_set, val_set):
-    with open(
-        os.path.join(output_path, 'train_set/annotations/instances_default.json'),
-        'w'
-    ) as f:
-        json.dump(train_set,f)
-    with open(
-        os.path.join(output_path, 'eval_set/annotations/instances_default.json'),
-        'w'
-    ) as f:
-        json.dump(val_set,f)
-
-def get_annotation_from_image_id(dataset: dict, image_id: int) -> dict:
-    annotations = []
+    with profiling.phase('json_save'):
+        with open(
+            os.path.join(output_path, 'train_set/annotations/instances_default.json'),
+            'w'
+        ) as f:
+            json.dump(train_set,f)
+        with open(
+            os.path.join(output_path, 'eval_set/annotations/instances_default.json'),
+            'w'
+        ) as f:
+            json.dump(val_set,f)
+        profiling.add_images(len(train_set['images']) + len(val_set['images']))
+
+def build_annotation_index(dataset: dict) -> dict:
+    annotation_index = collections.defaultdict(list)
     for annotation in dataset['annotations']:
-        if annotation['image_id'] == image_id:
-            annotations.append(copy.deepcopy(annotation))
+        annotation_index[annotation['image_id']].append(annotation)
+    return annotation_index
+
+def get_annotation_from_image_id(dataset: dict, image_id: int, annotation_index: dict=None) -> list:
+    """Returns shallow copies of the image annotations. Callers may reassign
+    top level fields (id, image_id, bbox, segmentation), nested values are
+    shared with the source dataset and must not be modified in place."""
+    if annotation_index is None:
+        annotation_index = build_annotation_index(dataset)
+    annotations = []
+    for annotation in annotation_index.get(image_id, []):
+        annotations.append(dict(annotation))
     return annotations
 
-def load_image(path: str) -> Any:
-    image = cv2.imread(path)
-    image = cv2.cvtColor(image, cv2.COLOR_BGR2RGB)
-    return image
+def load_image(path: str, scale: int=1) -> Any:
+    return image_codec.get_codec().read(path, scale)
 
 def save_image(path: str, image: Any) -> None:
-    image = cv2.cvtColor(image, cv2.COLOR_RGB2BGR)
-    cv2.imwrite(path, image)
+    image_codec.get_codec().write(path, image)
+
+def encode_image(image: Any, extension: str) -> bytes:
+    return image_codec.get_codec().encode(image, extension)
+
+def image_file_name(image_id: int, suffix: str, num_images: int) -> str:
+    """Pads IDs to the width of the largest ID of the folder, so file names
+    sort like IDs past 10k images too."""
+    width = max(FILE_NAME_MIN_WIDTH, len(str(max(num_images - 1, 0))))
+    return '{:0{}d}.{}'.format(image_id, width, suffix)
+
+def same_filesystem(src: str, dst: str) -> bool:
+    return os.stat(src).st_dev == os.stat(os.path.dirname(os.path.abspath(dst))).st_dev
+
+def reflink_file(src: str, dst: str) -> None:
+    with open(src, 'rb') as src_file, open(dst, 'wb') as dst_file:
+        fcntl.ioctl(dst_file.fileno(), FICLONE, src_file.fileno())
+
+def transfer_file(src: str, dst: str, link_mode: str='copy') -> None:
+    """Copies src to dst, or links it when link_mode allows and both paths
+    share a filesystem. Falls back to a plain copy if linking fails. An
+    existing dst is replaced rather than written through, as it may be a
+    link into an image store or the source folder."""
+    if os.path.lexists(dst):
+        os.remove(dst)
+    if link_mode != 'copy' and same_filesystem(src, dst):
+        try:
+            if link_mode == 'hardlink':
+                os.link(src, dst)
+            elif link_mode == 'symlink':
+                os.symlink(os.path.abspath(src), dst)
+            elif link_mode == 'reflink':
+                reflink_file(src, dst)
+            return
+        except OSError:
+            if os.path.lexists(dst):
+                os.remove(dst)
+    shutil.copyfile(src, dst)
+
+def transfer_files(file_transfers: list, link_mode: str='copy', num_workers: int=1) -> None:
+    if num_workers <= 1:
+        for src, dst in file_transfers:
+            transfer_file(src, dst, link_mode)
+        return
+    with ThreadPoolExecutor(max_workers=num_workers) as executor:
+        futures = [executor.submit(transfer_file, src, dst, link_mode) for src, dst in file_transfers]
+        for future in futures:
+            future.result()
 
 def bbox_coco2albumentations(bboxes: list, img: Any) -> list:
-    album_boxes = []
     h, w, _ = img.shape
-    for bbox in bboxes:
-        x_min, y_min, width, height = bbox
-        x_max = x_min + width
-        y_max = y_min + height
-        x_min, x_max = x_min / w, x_max / w
-        y_min, y_max = y_min / h, y_max / h
-        album_boxes.append([x_min, y_min, x_max, y_max])
-    return album_boxes
+    return bbox_utils.coco_to_albumentations(bboxes, h, w).tolist()
 
 def bbox_albumentations2coco(bboxes:list, img: Any) ->list:
-    coco_boxes = []
     h, w, _ = img.shape
-    for bbox in bboxes:
-        x_min, y_min, x_max, y_max = bbox
-        x_min, x_max = x_min * w, x_max * w
-        y_min, y_max = y_min * h, y_max * h
-        width = x_max - x_min
-        height = y_max - y_max
-        coco_boxes.append([x_min, y_min, width, height])
-    return coco_boxes
-
-def export_dataset(dataset: dict, format: str=None, output_folder: str='') -> None:
-    if format == 'tfrecord':
-        export_to_tfrecord(output_folder, 'train')
-        export_to_tfrecord(output_folder, 'eval')
-        export_label_map(output_folder, dataset)
-
-def export_to_tfrecord(output_folder: str, mode: str) -> None:
-    return_value = subprocess.call([
+    return bbox_utils.albumentations_to_coco(bboxes, h, w).tolist()
+
+def export_dataset(dataset: dict, format: str=None, output_folder: str='', val_set: dict=None, num_workers: int=None, include_masks: bool=False) -> None:
+    """Exports the train and eval sets and the label map concurrently.
+    num_workers is the global limit of conversion processes, None for one
+    per CPU. In-process exports (val_set given) share one pool, subprocess
+    exports each get their share of it. include_masks adds the PNG instance
+    masks that Mask R-CNN trains on."""
+    if format != 'tfrecord':
+        return
+    num_workers = num_workers or os.cpu_count()
+    pool = None
+    if val_set is not None:
+        # Workers unpickle tasks of the tfrecord utils, which must be
+        # importable before they are forked
+        import_tfrecord_utils()
+        pool = mp.Pool(num_workers)
+    sets = {'train': dataset, 'eval': val_set}
+    def export_task(mode):
+        def task(cancel_event):
+            if pool is not None:
+                export_to_tfrecord(output_folder, mode, sets[mode], pool=pool, cancel_event=cancel_event, num_processes=num_workers, include_masks=include_masks)
+            else:
+                export_to_tfrecord(output_folder, mode, cancel_event=cancel_event, num_processes=max(1, num_workers // 2), include_masks=include_masks)
+        return task
+    tasks = {
+        'train': (export_task('train'), []),
+        'eval': (export_task('eval'), []),
+        'label_map': (lambda cancel_event: export_label_map(output_folder, dataset), []),
+    }
+    try:
+        run_task_graph(tasks, max_concurrency=len(tasks))
+    except BaseException:
+        if pool is not None:
+            pool.terminate()
+        raise
+    finally:
+        if pool is not None:
+            pool.close()
+            pool.join()
+            # The workers had the annotation stores open until they exited
+            import_tfrecord_utils().annotation_store.remove_deferred_stores()
+
+def import_tfrecord_utils() -> Any:
+    # utils/ is not a package (this module shadows it), import it as scripts do
+    if TFRECORD_UTILS_DIR not in sys.path:
+        sys.path.append(TFRECORD_UTILS_DIR)
+    import create_coco_tf_record
+    return create_coco_tf_record
+
+def export_to_tfrecord(output_folder: str, mode: str, dataset: dict=None, pool: Any=None, cancel_event: Any=None, num_processes: int=None, include_masks: bool=False) -> None:
+    """Converts one set, in this process when dataset is given, otherwise by
+    running create_coco_tf_record.py on its saved annotations. Stops early
+    when cancel_event is set, the subprocess is terminated. num_processes is
+    the number of processes of pool when given."""
+    if dataset is not None:
+        create_coco_tf_record = import_tfrecord_utils()
+        num_images = len(dataset['images'])
+        create_coco_tf_record.create_tf_record_from_dataset(
+            dataset,
+            image_dir=os.path.join(output_folder, '{}_set/images/'.format(mode)),
+            output_path=os.path.join(output_folder, 'tfrecord/{}.tfrecord'.format(mode)),
+            pool=pool,
+            num_processes=num_processes,
+            include_masks=include_masks,
+            cancel_event=cancel_event,
+            progress_fn=lambda num_written: print('Exported {}/{} {} images'.format(num_written, num_images, mode))
+        )
+        return
+    command = [
         'python',
         'utils/create_coco_tf_record.py',
         '--image_dir={}'.format(os.path.join(output_folder, '{}_set/images/'.format(mode))),
         '--object_annotations_file={}'.format(os.path.join(output_folder, '{}_set/annotations/instances_default.json'.format(mode))),
         '--output_file_prefix={}'.format(os.path.join(output_folder, 'tfrecord/{}.tfrecord'.format(mode)))
-    ])
+    ]
+    if num_processes is not None:
+        command.append('--num_processes={}'.format(num_processes))
+    if include_masks:
+        command.append('--include_masks')
+    process = subprocess.Popen(command)
+    while True:
+        try:
+            return_value = process.wait(timeout=1)
+            break
+        except subprocess.TimeoutExpired:
+            if cancel_event is not None and cancel_event.is_set():
+                process.terminate()
+                process.wait()
+                raise RuntimeError('Cancelled {} dataset export'.format(mode))
     if return_value != 0:
         raise RuntimeError('Failed to save {} dataset'.format(mode))
 
@@ -0,0 +1,163 @@
+"""Columnar COCO object annotations shared with worker processes.
+
+Converting a dataset sends each worker process one task per image. With
+annotation dicts, every task pickles the image's annotations and the whole
+category name map. ColumnarAnnotations instead writes the annotations once
+as NumPy arrays, one row per annotation and grouped by image, which workers
+memory-map read-only. A task then only carries the image record and its row
+in the store.
+"""
+
+import json
+import os
+import shutil
+import tempfile
+
+import numpy as np
+
+# Shared memory when available, so the arrays never touch the disk.
+STORE_PARENT_DIR = '/dev/shm' if os.path.isdir('/dev/shm') else None
+# Largest fraction of the free space of STORE_PARENT_DIR a store may take,
+# leaving room for concurrent conversions. Containers often get a 64 MB
+# /dev/shm, larger stores go to the temporary directory instead.
+MAX_SHM_FRACTION = 0.5
+ARRAYS = ('image_offsets', 'bboxes', 'category_ids', 'areas', 'is_crowd',
+          'annotation_polygons', 'polygon_offsets', 'polygon_coords')
+
+# Stores opened by this process, by directory.
+_open_stores = {}
+# Stores left to remove_deferred_stores, by remove_store(deferred=True).
+_deferred_stores = []
+
+
+def is_polygon(segmentation):
+  return isinstance(segmentation, list)
+
+
+class ColumnarAnnotations(object):
+  """Read-only view over a store written by write_store.
+
+  Annotations of the image at index i of the store are the rows
+  image_offsets[i]:image_offsets[i + 1]. Polygon segmentations are flat:
+  annotation j has polygons annotation_polygons[j]:annotation_polygons[j + 1]
+  and polygon k has coordinates polygon_offsets[k]:polygon_offsets[k + 1].
+  """
+
+  def __init__(self, directory):
+    self.directory = directory
+    for name in ARRAYS:
+      setattr(self, name, np.load(os.path.join(directory, name + '.npy'),
+                                  mmap_mode='r'))
+    with open(os.path.join(directory, 'categories.json')) as f:
+      categories = json.load(f)
+    self.id_to_name_map = dict(zip(categories['ids'], categories['names']))
+
+  def rows(self, image_index):
+    return slice(self.image_offsets[image_index],
+                 self.image_offsets[image_index + 1])
+
+  def segmentations(self, rows):
+    """Polygon segmentations of the rows, as nested lists."""
+    segmentations = []
+    for row in range(rows.start, rows.stop):
+      polygons = []
+      for polygon in range(self.annotation_polygons[row],
+                           self.annotation_polygons[row + 1]):
+        polygons.append(self.polygon_coords[
+            self.polygon_offsets[polygon]:
+            self.polygon_offsets[polygon + 1]].tolist())
+      segmentations.append(polygons)
+    return segmentations
+
+
+def supports(annotations, include_masks):
+  """Whether the store can hold these annotations. Masks are only stored as
+  polygons, crowd RLE segmentations need the annotation dicts."""
+  if not include_masks:
+    return True
+  return all(is_polygon(annotation['segmentation'])
+             for annotation in annotations)
+
+
+def store_parent_dir(num_bytes):
+  """STORE_PARENT_DIR if a store of num_bytes fits there, else None for the
+  temporary directory."""
+  if STORE_PARENT_DIR is None:
+    return None
+  if num_bytes > shutil.disk_usage(STORE_PARENT_DIR).free * MAX_SHM_FRACTION:
+    return None
+  return STORE_PARENT_DIR
+
+
+def write_store(images, img_to_obj_annotation, id_to_name_map,
+                include_masks=False):
+  """Writes the annotations of images, in that order, to a new store.
+  Args:
+    images: list of COCO image dicts.
+    img_to_obj_annotation: dict of annotation lists by image id.
+    id_to_name_map: a dict mapping category IDs to string names.
+    include_masks: Whether to store polygon segmentations.
+  Returns:
+    The store directory, to be removed with remove_store.
+  """
+  image_offsets = [0]
+  bboxes, category_ids, areas, is_crowd = [], [], [], []
+  annotation_polygons, polygon_offsets, polygon_coords = [0], [0], []
+  for image in images:
+    annotations = img_to_obj_annotation.get(image['id'], ())
+    for annotation in annotations:
+      bboxes.append(annotation['bbox'])
+      category_ids.append(int(annotation['category_id']))
+      areas.append(annotation['area'])
+      is_crowd.append(annotation['iscrowd'])
+      if include_masks:
+        for polygon in annotation['segmentation']:
+          polygon_coords.extend(polygon)
+          polygon_offsets.append(len(polygon_coords))
+      annotation_polygons.append(len(polygon_offsets) - 1)
+    image_offsets.append(image_offsets[-1] + len(annotations))
+
+  arrays = {
+      'image_offsets': np.array(image_offsets, dtype=np.int64),
+      'bboxes': np.array(bboxes, dtype=np.float64).reshape(-1, 4),
+      'category_ids': np.array(category_ids, dtype=np.int64),
+      # Keeps ints as ints, the feature type follows the value type.
+      'areas': np.array(areas),
+      'is_crowd': np.array(is_crowd),
+      'annotation_polygons': np.array(annotation_polygons, dtype=np.int64),
+      'polygon_offsets': np.array(polygon_offsets, dtype=np.int64),
+      'polygon_coords': np.array(polygon_coords, dtype=np.float64),
+  }
+  directory = tempfile.mkdtemp(
+      prefix='annotations-',
+      dir=store_parent_dir(sum(array.nbytes for array in arrays.values())))
+  for name, array in arrays.items():
+    np.save(os.path.join(directory, name + '.npy'), array)
+  with open(os.path.join(directory, 'categories.json'), 'w') as f:
+    json.dump({'ids': list(id_to_name_map),
+               'names': list(id_to_name_map.values())}, f)
+  return directory
+
+
+def open_store(directory):
+  """Opens a store once per process."""
+  if directory not in _open_stores:
+    _open_stores[directory] = ColumnarAnnotations(directory)
+  return _open_stores[directory]
+
+
+def remove_store(directory, deferred=False):
+  """Removes a store. Worker processes that opened it keep its files mapped
+  until they exit, so with a pool that outlives the conversion, unlinking
+  them would not free the shared memory. deferred leaves the store to
+  remove_deferred_stores, to be called once that pool is joined."""
+  _open_stores.pop(directory, None)
+  if deferred:
+    _deferred_stores.append(directory)
+  else:
+    shutil.rmtree(directory, ignore_errors=True)
+
+
+def remove_deferred_stores():
+  while _deferred_stores:
+    shutil.rmtree(_deferred_stores.pop(), ignore_errors=True)
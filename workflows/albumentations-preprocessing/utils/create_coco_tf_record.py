@@ -26,9 +26,12 @@ Example usage:
 """
 
 import collections
+import hashlib
+import itertools
 import json
 import logging
 import os
+import sys
 
 from absl import app  # pylint:disable=unused-import
 from absl import flags
@@ -38,8 +41,13 @@ from pycocotools import mask
 import tensorflow as tf
 
 import multiprocessing as mp
+import annotation_store
 import tfrecord_lib
 
+# bbox_utils is in the workflow directory, the parent of this script's
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import bbox_utils  # pylint:disable=g-import-not-at-top
+
 
 flags.DEFINE_boolean(
     'include_masks', False, 'Whether to include instance segmentations masks '
@@ -58,6 +66,20 @@ flags.DEFINE_string('caption_annotations_file', '', 'File containing image '
                     'captions.')
 flags.DEFINE_string('output_file_prefix', '/tmp/train', 'Path to output file')
 flags.DEFINE_integer('num_shards', 32, 'Number of shards for output file.')
+flags.DEFINE_integer('chunksize', 8, 'Number of images sent to a worker '
+                     'process at once.')
+flags.DEFINE_integer('max_in_flight', None, 'Maximum number of images being '
+                     'converted or waiting to be written. Bounds memory use, '
+                     'defaults to 4 chunks per worker process.')
+flags.DEFINE_boolean('incremental', False, 'Whether to only rebuild the '
+                     'shards whose images or annotations changed since the '
+                     'last run, and resume an interrupted conversion. Uses a '
+                     'manifest saved next to the output.')
+flags.DEFINE_integer('num_processes', None, 'Number of worker processes, '
+                     'defaults to one per CPU.')
+flags.DEFINE_boolean('parallel_writers', False, 'Whether each worker process '
+                     'writes its own set of shards. Also saves the number of '
+                     'records per shard in a manifest next to the output.')
 
 FLAGS = flags.FLAGS
 
@@ -75,15 +97,62 @@ def coco_segmentation_to_mask_png(segmentation, height, width, is_crowd):
   return tfrecord_lib.encode_binary_mask_as_png(binary_mask)
 
 
+# Upper bound on the decoded masks held at once by the batched mask path.
+MAX_MASK_BATCH_BYTES = 1 << 28
+
+
+def coco_segmentations_to_mask_pngs(segmentations, height, width, is_crowds):
+  """Encode all COCO mask segmentations of an image as PNG strings.
+  Polygon segmentations are rasterized in batches, one frPyObjects/decode
+  call each, and their parts merged with a single reduceat. Crowd (RLE)
+  segmentations go through coco_segmentation_to_mask_png.
+  """
+  encoded_pngs = [None] * len(segmentations)
+  batch, batch_parts = [], 0
+  max_batch_parts = max(1, MAX_MASK_BATCH_BYTES // (height * width))
+
+  def encode_batch(batch):
+    polygons = [polygon for idx in batch for polygon in segmentations[idx]]
+    offsets = np.cumsum([0] + [len(segmentations[idx]) for idx in batch[:-1]])
+    binary_masks = mask.decode(mask.frPyObjects(polygons, height, width))
+    binary_masks = np.maximum.reduceat(binary_masks, offsets, axis=2)
+    for k, idx in enumerate(batch):
+      encoded_pngs[idx] = tfrecord_lib.encode_binary_mask_as_png(
+          binary_masks[:, :, k])
+
+  for idx, (segmentation, is_crowd) in enumerate(zip(segmentations,
+                                                     is_crowds)):
+    if is_crowd or not isinstance(segmentation, list) or not segmentation:
+      encoded_pngs[idx] = coco_segmentation_to_mask_png(
+          segmentation, height, width, is_crowd)
+      continue
+    if batch and batch_parts + len(segmentation) > max_batch_parts:
+      encode_batch(batch)
+      batch, batch_parts = [], 0
+    batch.append(idx)
+    batch_parts += len(segmentation)
+  if batch:
+    encode_batch(batch)
+
+  return encoded_pngs
+
+
+def tfod_box_lists(bboxes, image_height, image_width):
+  """Normalized box coordinate lists of COCO [x, y, width, height] boxes."""
+  ymin, xmin, ymax, xmax = bbox_utils.coco_to_tfod(
+      bboxes, image_height, image_width).T
+  return {'xmin': xmin.tolist(), 'xmax': xmax.tolist(),
+          'ymin': ymin.tolist(), 'ymax': ymax.tolist()}
+
+
 def coco_annotations_to_lists(bbox_annotations, id_to_name_map,
                               image_height, image_width, include_masks):
   """Convert COCO annotations to feature lists."""
 
   data = dict((k, list()) for k in
-              ['xmin', 'xmax', 'ymin', 'ymax', 'is_crowd',
-               'category_id', 'category_names', 'area'])
-  if include_masks:
-    data['encoded_mask_png'] = []
+              ['is_crowd', 'category_id', 'category_names', 'area'])
+  bboxes = []
+  segmentations = []
 
   num_annotations_skipped = 0
 
@@ -96,10 +165,7 @@ def coco_annotations_to_lists(bbox_annotations, id_to_name_map,
     if x + width > image_width or y + height > image_height:
       num_annotations_skipped += 1
       continue
-    data['xmin'].append(float(x) / image_width)
-    data['xmax'].append(float(x + width) / image_width)
-    data['ymin'].append(float(y) / image_height)
-    data['ymax'].append(float(y + height) / image_height)
+    bboxes.append(object_annotations['bbox'])
     data['is_crowd'].append(object_annotations['iscrowd'])
     category_id = int(object_annotations['category_id'])
     data['category_id'].append(category_id)
@@ -107,15 +173,43 @@ def coco_annotations_to_lists(bbox_annotations, id_to_name_map,
     data['area'].append(object_annotations['area'])
 
     if include_masks:
-      data['encoded_mask_png'].append(
-          coco_segmentation_to_mask_png(object_annotations['segmentation'],
-                                        image_height, image_width,
-                                        object_annotations['iscrowd'])
-      )
+      segmentations.append(object_annotations['segmentation'])
+
+  data.update(tfod_box_lists(bboxes, image_height, image_width))
+  if include_masks:
+    data['encoded_mask_png'] = coco_segmentations_to_mask_pngs(
+        segmentations, image_height, image_width, data['is_crowd'])
 
   return data, num_annotations_skipped
 
 
+def columnar_annotations_to_lists(store, rows, image_height, image_width,
+                                 include_masks):
+  """coco_annotations_to_lists over rows of an annotation_store, vectorized.
+  Gives the same lists for annotations of a consistent type."""
+  x, y, width, height = store.bboxes[rows].T
+  skipped = ((width <= 0) | (height <= 0) |
+             (x + width > image_width) | (y + height > image_height))
+  valid = ~skipped
+  category_ids = store.category_ids[rows][valid].tolist()
+  data = tfod_box_lists(store.bboxes[rows][valid], image_height, image_width)
+  data.update({
+      'is_crowd': store.is_crowd[rows][valid].tolist(),
+      'category_id': category_ids,
+      'category_names': [store.id_to_name_map[category_id].encode('utf8')
+                         for category_id in category_ids],
+      'area': store.areas[rows][valid].tolist(),
+  })
+  if include_masks:
+    segmentations = store.segmentations(rows)
+    segmentations = [segmentation for segmentation, keep
+                     in zip(segmentations, valid) if keep]
+    data['encoded_mask_png'] = coco_segmentations_to_mask_pngs(
+        segmentations, image_height, image_width, data['is_crowd'])
+
+  return data, int(skipped.sum())
+
+
 def bbox_annotations_to_feature_dict(
     bbox_annotations, image_height, image_width, id_to_name_map, include_masks):
   """Convert COCO annotations to an encoded feature dict."""
@@ -123,6 +217,11 @@ def bbox_annotations_to_feature_dict(
   data, num_skipped = coco_annotations_to_lists(
       bbox_annotations, id_to_name_map, image_height, image_width,
       include_masks)
+  return lists_to_feature_dict(data, include_masks), num_skipped
+
+
+def lists_to_feature_dict(data, include_masks):
+  """Encodes the feature lists of coco_annotations_to_lists."""
   feature_dict = {
       'image/object/bbox/xmin':
           tfrecord_lib.convert_to_feature(data['xmin']),
@@ -145,7 +244,7 @@ def bbox_annotations_to_feature_dict(
     feature_dict['image/object/mask'] = (
         tfrecord_lib.convert_to_feature(data['encoded_mask_png']))
 
-  return feature_dict, num_skipped
+  return feature_dict
 
 
 def encode_caption_annotations(caption_annotations):
@@ -156,6 +255,30 @@ def encode_caption_annotations(caption_annotations):
   return captions
 
 
+def image_source_path(image, image_dir):
+  """Path of the file holding the image, its pack file if it was packed."""
+  if 'pack' in image:
+    return os.path.join(image_dir, image['pack']['file'])
+  return os.path.join(image_dir, image['file_name'])
+
+
+def read_image_bytes(image, image_dir):
+  """Reads the encoded image, from its byte range in a pack file if the image
+  record has a 'pack' entry (see image_pack.PackWriter).
+
+  Args:
+    image: COCO image dict.
+    image_dir: directory containing the image and pack files.
+  Returns:
+    The encoded image bytes.
+  """
+  with tf.io.gfile.GFile(image_source_path(image, image_dir), 'rb') as fid:
+    if 'pack' in image:
+      fid.seek(image['pack']['offset'])
+      return fid.read(image['pack']['length'])
+    return fid.read()
+
+
 def create_tf_example(image,
                       image_dir,
                       bbox_annotations=None,
@@ -192,9 +315,7 @@ def create_tf_example(image,
   filename = image['file_name']
   image_id = image['id']
 
-  full_path = os.path.join(image_dir, filename)
-  with tf.io.gfile.GFile(full_path, 'rb') as fid:
-    encoded_jpg = fid.read()
+  encoded_jpg = read_image_bytes(image, image_dir)
 
   feature_dict = tfrecord_lib.image_info_to_feature_dict(
       image_height, image_width, filename, image_id, encoded_jpg, 'jpg')
@@ -216,11 +337,45 @@ def create_tf_example(image,
   return example, num_annotations_skipped
 
 
+def create_tf_example_from_store(image, image_dir, store_dir, image_index,
+                                 include_masks=False):
+  """create_tf_example for the annotations of an annotation_store.
+  Args:
+    image: COCO image dict.
+    image_dir: directory containing the image files.
+    store_dir: directory of the store, opened once per process.
+    image_index: index of the image in the store.
+    include_masks: Whether to include instance segmentations masks.
+  Returns:
+    example: The converted tf.Example
+    num_annotations_skipped: Number of (invalid) annotations that were ignored.
+  """
+  store = annotation_store.open_store(store_dir)
+  rows = store.rows(image_index)
+  feature_dict = tfrecord_lib.image_info_to_feature_dict(
+      image['height'], image['width'], image['file_name'], image['id'],
+      read_image_bytes(image, image_dir), 'jpg')
+
+  num_annotations_skipped = 0
+  if rows.stop > rows.start:
+    data, num_annotations_skipped = columnar_annotations_to_lists(
+        store, rows, image['height'], image['width'], include_masks)
+    feature_dict.update(lists_to_feature_dict(data, include_masks))
+
+  example = tf.train.Example(features=tf.train.Features(feature=feature_dict))
+  return example, num_annotations_skipped
+
+
 def _load_object_annotations(object_annotations_file):
   """Loads object annotation JSON file."""
   with tf.io.gfile.GFile(object_annotations_file, 'r') as fid:
     obj_annotations = json.load(fid)
 
+  return _index_object_annotations(obj_annotations)
+
+
+def _index_object_annotations(obj_annotations):
+  """Groups the annotations of a COCO dict by image id."""
   images = obj_annotations['images']
   id_to_name_map = dict((element['id'], element['name']) for element in
                         obj_annotations['categories'])
@@ -290,13 +445,82 @@ def generate_annotations(images, image_dir,
            caption_annotation, include_masks)
 
 
+def generate_store_annotations(images, image_dir, store_dir, include_masks):
+  """Generator for create_tf_example_from_store arguments."""
+  for image_index, image in enumerate(images):
+    yield image, image_dir, store_dir, image_index, include_masks
+
+
+def generate_keyed_annotations(coco_annotations_iter, manifest):
+  """Adds the (key, digest) pair used by incremental conversion.
+  The digest covers the image file content, its info and annotations and the
+  conversion options, so any change to them rebuilds the image's shard."""
+  for args in coco_annotations_iter:
+    image, image_dir = args[0], args[1]
+    full_path = image_source_path(image, image_dir)
+    digest = hashlib.sha256(manifest.file_digest(full_path).encode('utf8'))
+    digest.update(json.dumps(
+        [image, args[2], args[4], args[5]], sort_keys=True).encode('utf8'))
+    yield image['file_name'], digest.hexdigest(), args
+
+
+def _write_coco_annotations(output_path, coco_annotations_iter, num_shards,
+                            incremental=False, **kwargs):
+  if incremental:
+    manifest = tfrecord_lib.IncrementalManifest(
+        output_path + '-incremental.json', num_shards)
+    return tfrecord_lib.write_tf_record_dataset_incremental(
+        output_path,
+        generate_keyed_annotations(coco_annotations_iter, manifest),
+        create_tf_example, num_shards, manifest)
+  return tfrecord_lib.write_tf_record_dataset(
+      output_path, coco_annotations_iter, create_tf_example, num_shards,
+      **kwargs)
+
+
+def _write_object_annotations(output_path, images, image_dir,
+                              img_to_obj_annotation, id_to_name_map,
+                              num_shards, include_masks=False,
+                              incremental=False, **kwargs):
+  """Writes the examples of images with object annotations. Workers read the
+  annotations from a shared annotation_store instead of receiving them with
+  each image, except for incremental conversion which digests them and for
+  crowd RLE masks which the store does not hold."""
+  annotations = itertools.chain.from_iterable(img_to_obj_annotation.values())
+  if incremental or not annotation_store.supports(annotations, include_masks):
+    coco_annotations_iter = generate_annotations(
+        images, image_dir, img_to_obj_annotation,
+        id_to_name_map=id_to_name_map, include_masks=include_masks)
+    return _write_coco_annotations(
+        output_path, coco_annotations_iter, num_shards, incremental, **kwargs)
+
+  store_dir = annotation_store.write_store(
+      images, img_to_obj_annotation, id_to_name_map, include_masks)
+  try:
+    return tfrecord_lib.write_tf_record_dataset(
+        output_path,
+        generate_store_annotations(images, image_dir, store_dir,
+                                   include_masks),
+        create_tf_example_from_store, num_shards, **kwargs)
+  finally:
+    # Workers of a shared pool keep the store open, its owner removes it
+    # with annotation_store.remove_deferred_stores once the pool is joined.
+    annotation_store.remove_store(store_dir,
+                                  deferred=kwargs.get('pool') is not None)
+
+
 def _create_tf_record_from_coco_annotations(images_info_file,
                                             image_dir,
                                             output_path,
                                             num_shards,
                                             object_annotations_file=None,
                                             caption_annotations_file=None,
-                                            include_masks=False):
+                                            include_masks=False,
+                                            chunksize=8,
+                                            max_in_flight=None,
+                                            parallel_writers=False,
+                                            incremental=False,
+                                            num_processes=None):
   """Loads COCO annotation json files and converts to tf.Record format.
   Args:
     images_info_file: JSON file containing image info. The number of tf.Examples
@@ -312,6 +536,12 @@ def _create_tf_record_from_coco_annotations(images_info_file,
     caption_annotations_file: JSON file containing caption annotations.
     include_masks: Whether to include instance segmentations masks
       (PNG encoded) in the result. default: False.
+    chunksize: Number of images sent to a worker process at once.
+    max_in_flight: Maximum number of images being converted or waiting to be
+      written.
+    parallel_writers: Whether each worker process writes its own shards.
+    incremental: Whether to only rebuild shards whose inputs changed.
+    num_processes: Number of worker processes, defaults to one per CPU.
   """
 
   logging.info('writing to output path: %s', output_path)
@@ -328,14 +558,62 @@ def _create_tf_record_from_coco_annotations(images_info_file,
     img_to_caption_annotation = (
         _load_caption_annotations(caption_annotations_file))
 
-  coco_annotations_iter = generate_annotations(
-      images, image_dir, img_to_obj_annotation, img_to_caption_annotation,
-      id_to_name_map=id_to_name_map, include_masks=include_masks)
+  write_kwargs = dict(chunksize=chunksize, max_in_flight=max_in_flight,
+                      parallel_writers=parallel_writers,
+                      num_processes=num_processes)
+  if img_to_obj_annotation is not None and img_to_caption_annotation is None:
+    num_skipped = _write_object_annotations(
+        output_path, images, image_dir, img_to_obj_annotation, id_to_name_map,
+        num_shards, include_masks, incremental, **write_kwargs)
+  else:
+    coco_annotations_iter = generate_annotations(
+        images, image_dir, img_to_obj_annotation, img_to_caption_annotation,
+        id_to_name_map=id_to_name_map, include_masks=include_masks)
+    num_skipped = _write_coco_annotations(
+        output_path, coco_annotations_iter, num_shards, incremental,
+        **write_kwargs)
+
+  logging.info('Finished writing, skipped %d annotations.', num_skipped)
+
+
+def create_tf_record_from_dataset(dataset,
+                                  image_dir,
+                                  output_path,
+                                  num_shards=32,
+                                  include_masks=False,
+                                  incremental=False,
+                                  **kwargs):
+  """Converts an in-memory COCO dataset to sharded tf.Record files.
+  Same output as running this script on the dataset saved as JSON, without
+  the interpreter start and the JSON parse.
+  Args:
+    dataset: COCO dict with 'images', 'annotations' and 'categories'.
+    image_dir: Directory containing the image files.
+    output_path: Path to output tf.Record file.
+    num_shards: Number of output files to create.
+    include_masks: Whether to include instance segmentations masks
+      (PNG encoded) in the result. default: False.
+    incremental: Whether to only rebuild shards whose inputs changed.
+    **kwargs: pool, num_processes, cancel_event and progress_fn, passed to
+      tfrecord_lib.write_tf_record_dataset. Not used when incremental. The
+      caller of a shared pool removes the annotation stores with
+      annotation_store.remove_deferred_stores after joining it.
+  Returns:
+    num_skipped: The total number of skipped annotations.
+  """
+  logging.info('writing to output path: %s', output_path)
+
+  directory = os.path.dirname(output_path)
+  if not tf.io.gfile.isdir(directory):
+    tf.io.gfile.makedirs(directory)
 
-  num_skipped = tfrecord_lib.write_tf_record_dataset(
-      output_path, coco_annotations_iter, create_tf_example, num_shards)
+  img_to_obj_annotation, id_to_name_map = _index_object_annotations(dataset)
+  num_skipped = _write_object_annotations(
+      output_path, dataset['images'], image_dir, img_to_obj_annotation,
+      id_to_name_map, num_shards, include_masks, incremental, **kwargs)
 
   logging.info('Finished writing, skipped %d annotations.', num_skipped)
+  return num_skipped
 
 
 def main(_):
@@ -359,7 +637,12 @@ def main(_):
                                           FLAGS.num_shards,
                                           FLAGS.object_annotations_file,
                                           FLAGS.caption_annotations_file,
-                                          FLAGS.include_masks)
+                                          FLAGS.include_masks,
+                                          FLAGS.chunksize,
+                                          FLAGS.max_in_flight,
+                                          FLAGS.parallel_writers,
+                                          FLAGS.incremental,
+                                          FLAGS.num_processes)
 
 
 if __name__ == '__main__':
@@ -14,16 +14,31 @@
 # ==============================================================================
 """Helper functions for creating TFRecord datasets."""
 
+import collections
+import functools
 import hashlib
 import io
 import itertools
+import json
+import os
+import queue
+import threading
 
 from absl import logging
+import numpy as np
 from PIL import Image
 import tensorflow as tf
 
 import multiprocessing as mp
 
+try:
+  import cv2  # pylint:disable=g-import-not-at-top
+except ImportError:
+  cv2 = None
+
+# Binary masks compress well even at low levels, favour encoding speed.
+PNG_COMPRESSION = 1
+
 
 def convert_to_feature(value, value_type=None):
   """Converts the given python object to a tf.train.Feature.
@@ -96,14 +111,173 @@ def image_info_to_feature_dict(height, width, filename, image_id,
 
 
 def encode_binary_mask_as_png(binary_mask):
+  """PNG encodes a 2D uint8 mask, with OpenCV when available (faster)."""
+  if cv2 is not None:
+    success, encoded = cv2.imencode(
+        '.png', np.ascontiguousarray(binary_mask),
+        [cv2.IMWRITE_PNG_COMPRESSION, PNG_COMPRESSION])
+    if success:
+      return encoded.tobytes()
   pil_image = Image.fromarray(binary_mask)
   output_io = io.BytesIO()
   pil_image.save(output_io, format='PNG')
   return output_io.getvalue()
 
 
+def _apply_star(process_func, args):
+  return process_func(*args)
+
+
+def _throttle(iterator, window, stop_event):
+  """Yields from iterator while holding one window slot per element."""
+  for item in iterator:
+    window.acquire()
+    if stop_event.is_set():
+      return
+    yield item
+
+
+def _windowed_apply(pool, func, iterator, window):
+  """Like pool.imap(func, iterator), keeping at most window tasks in the
+  pool. Tasks are submitted one by one, so callers sharing a pool from
+  several threads interleave instead of queueing behind each other's whole
+  iterator, as imap would."""
+  pending = collections.deque()
+  for args in iterator:
+    pending.append(pool.apply_async(func, (args,)))
+    if len(pending) >= window:
+      yield pending.popleft().get()
+  while pending:
+    yield pending.popleft().get()
+
+
+class ConversionCancelledError(Exception):
+  """Raised by write_tf_record_dataset when its cancel_event is set."""
+
+
+def shard_path(output_path, shard, num_shards):
+  return output_path + '-%05d-of-%05d.tfrecord' % (shard, num_shards)
+
+
+def _shard_writer_worker(output_path, shards, num_shards, process_func,
+                         task_queue, result_queue):
+  """Converts the elements of its queue and writes them to its own shards."""
+  writers = {shard: tf.io.TFRecordWriter(
+      shard_path(output_path, shard, num_shards)) for shard in shards}
+  num_records = dict((shard, 0) for shard in shards)
+  num_skipped = 0
+  try:
+    for shard, args in iter(task_queue.get, None):
+      tf_example, num_annotations_skipped = process_func(*args)
+      num_skipped += num_annotations_skipped
+      writers[shard].write(tf_example.SerializeToString())
+      num_records[shard] += 1
+  except Exception as e:  # pylint:disable=broad-except
+    result_queue.put((None, None, '{}: {}'.format(type(e).__name__, e)))
+    return
+  finally:
+    for writer in writers.values():
+      writer.close()
+  result_queue.put((num_records, num_skipped, None))
+
+
+def _put_task(task_queue, task, process, result_queue):
+  while True:
+    try:
+      task_queue.put(task, timeout=1)
+      return
+    except queue.Full:
+      if not process.is_alive():
+        errors = []
+        try:
+          while True:
+            errors.append(result_queue.get(timeout=1)[2])
+        except queue.Empty:
+          pass
+        raise RuntimeError('Failed to write TFRecords: {}'.format(
+            '; '.join(error for error in errors if error) or
+            'writer process exited with code {}'.format(process.exitcode)))
+
+
+def _get_result(result_queue, processes):
+  """Waits for the next worker result, failing if a worker process died
+  without reporting one, e.g. when it was killed for running out of memory."""
+  while True:
+    try:
+      return result_queue.get(timeout=1)
+    except queue.Empty:
+      for process in processes:
+        # Workers report failures themselves and exit with code 0.
+        if process.exitcode:
+          raise RuntimeError('Failed to write TFRecords: writer process '
+                             'exited with code {}'.format(process.exitcode))
+
+
+def _write_tf_record_dataset_in_workers(output_path, annotation_iterator,
+                                        process_func, num_shards,
+                                        num_workers=None, queue_size=16):
+  """Worker processes own disjoint sets of shards and write them directly.
+  Element i goes to shard i % num_shards as in write_tf_record_dataset, and
+  each worker handles its elements in order, so shard contents are the same.
+  Returns:
+    num_skipped: The total number of skipped annotations.
+    manifest: dict with the number of records written to each shard file.
+  """
+  num_workers = min(num_workers or mp.cpu_count(), num_shards)
+  result_queue = mp.Queue()
+  task_queues = [mp.Queue(queue_size) for _ in range(num_workers)]
+  processes = []
+  for worker in range(num_workers):
+    shards = range(worker, num_shards, num_workers)
+    process = mp.Process(
+        target=_shard_writer_worker,
+        args=(output_path, shards, num_shards, process_func,
+              task_queues[worker], result_queue))
+    process.start()
+    processes.append(process)
+
+  try:
+    for idx, args in enumerate(annotation_iterator):
+      if idx % 100 == 0:
+        logging.info('On image %d', idx)
+      shard = idx % num_shards
+      worker = shard % num_workers
+      _put_task(task_queues[worker], (shard, args), processes[worker],
+                result_queue)
+    for worker in range(num_workers):
+      _put_task(task_queues[worker], None, processes[worker], result_queue)
+
+    manifest = {}
+    total_num_annotations_skipped = 0
+    errors = []
+    for _ in range(num_workers):
+      num_records, num_skipped, error = _get_result(result_queue, processes)
+      if error:
+        errors.append(error)
+        continue
+      total_num_annotations_skipped += num_skipped
+      for shard, count in num_records.items():
+        manifest[os.path.basename(
+            shard_path(output_path, shard, num_shards))] = count
+    for process in processes:
+      process.join()
+  except BaseException:
+    for process in processes:
+      process.terminate()
+    raise
+  if errors:
+    raise RuntimeError('Failed to write TFRecords: {}'.format(
+        '; '.join(errors)))
+
+  return total_num_annotations_skipped, dict(sorted(manifest.items()))
+
+
 def write_tf_record_dataset(output_path, annotation_iterator, process_func,
-                            num_shards, use_multiprocessing=True):
+                            num_shards, use_multiprocessing=True,
+                            chunksize=8, max_in_flight=None, ordered=True,
+                            parallel_writers=False, pool=None,
+                            cancel_event=None, progress_fn=None,
+                            num_processes=None):
   """Iterates over annotations, processes them and writes into TFRecords.
   Args:
     output_path: The prefix path to create TF record files.
@@ -115,39 +289,245 @@ def write_tf_record_dataset(output_path, annotation_iterator, process_func,
     num_shards: int, the number of shards to write for the dataset.
     use_multiprocessing:
       Whether or not to use multiple processes to write TF Records.
+    chunksize: Number of elements sent to a worker process at once.
+    max_in_flight: Maximum number of elements read from annotation_iterator
+      but not yet written, which bounds the memory used by pending examples.
+      Defaults to 4 chunks per worker process.
+    ordered: Whether examples are written in annotation_iterator order. When
+      False, they are written as soon as any worker finishes them, so shard
+      assignment is no longer deterministic.
+    parallel_writers: Whether each worker process writes its own shards
+      instead of sending examples back to this process. The number of records
+      per shard is saved to output_path + '-manifest.json'.
+    pool: A multiprocessing pool shared with other conversions, which is
+      left open. Examples are written in order and chunksize is ignored.
+      num_processes must then be its number of processes.
+    cancel_event: A threading.Event which stops the conversion with
+      ConversionCancelledError when set.
+    progress_fn: Called with the number of examples written so far, every
+      100 examples and at the end.
+    num_processes: Number of worker processes, defaults to one per CPU.
   Returns:
     num_skipped: The total number of skipped annotations.
   """
 
+  if use_multiprocessing and parallel_writers:
+    total_num_annotations_skipped, manifest = (
+        _write_tf_record_dataset_in_workers(
+            output_path, annotation_iterator, process_func, num_shards,
+            num_workers=num_processes))
+    with tf.io.gfile.GFile(output_path + '-manifest.json', 'w') as f:
+      json.dump({'num_skipped': total_num_annotations_skipped,
+                 'shards': manifest}, f, indent=2)
+    logging.info('Finished writing, skipped %d annotations.',
+                 total_num_annotations_skipped)
+    return total_num_annotations_skipped
+
   writers = [
-      tf.io.TFRecordWriter(
-          output_path + '-%05d-of-%05d.tfrecord' % (i, num_shards))
+      tf.io.TFRecordWriter(shard_path(output_path, i, num_shards))
       for i in range(num_shards)
   ]
 
   total_num_annotations_skipped = 0
-
-  if use_multiprocessing:
-    pool = mp.Pool()
-    tf_example_iterator = pool.starmap(process_func, annotation_iterator)
+  shared_pool = pool is not None
+
+  if shared_pool:
+    if max_in_flight is None:
+      max_in_flight = 4 * (num_processes or os.cpu_count())
+    tf_example_iterator = _windowed_apply(
+        pool, functools.partial(_apply_star, process_func),
+        annotation_iterator, max_in_flight)
+  elif use_multiprocessing:
+    num_processes = num_processes or os.cpu_count()
+    pool = mp.Pool(num_processes)
+    if max_in_flight is None:
+      max_in_flight = 4 * num_processes * chunksize
+    # The pool feeds whole chunks, the window must fit at least one.
+    max_in_flight = max(max_in_flight, chunksize)
+    window = threading.Semaphore(max_in_flight)
+    stop_event = threading.Event()
+    imap = pool.imap if ordered else pool.imap_unordered
+    tf_example_iterator = imap(
+        functools.partial(_apply_star, process_func),
+        _throttle(annotation_iterator, window, stop_event),
+        chunksize=chunksize)
   else:
     tf_example_iterator = itertools.starmap(process_func, annotation_iterator)
 
-  for idx, (tf_example, num_annotations_skipped) in enumerate(
-      tf_example_iterator):
-    if idx % 100 == 0:
-      logging.info('On image %d', idx)
-
-    total_num_annotations_skipped += num_annotations_skipped
-    writers[idx % num_shards].write(tf_example.SerializeToString())
-
-  if use_multiprocessing:
-    pool.close()
-    pool.join()
+  num_written = 0
+  try:
+    for idx, (tf_example, num_annotations_skipped) in enumerate(
+        tf_example_iterator):
+      if use_multiprocessing and not shared_pool:
+        window.release()
+      if cancel_event is not None and cancel_event.is_set():
+        raise ConversionCancelledError(output_path)
+      if idx % 100 == 0:
+        logging.info('On image %d', idx)
+        if progress_fn is not None:
+          progress_fn(idx)
+
+      total_num_annotations_skipped += num_annotations_skipped
+      writers[idx % num_shards].write(tf_example.SerializeToString())
+      num_written = idx + 1
+  finally:
+    if use_multiprocessing and not shared_pool:
+      # Unblock the task feeder so the pool can shut down.
+      stop_event.set()
+      for _ in range(max_in_flight):
+        window.release()
+      pool.close()
+      pool.join()
 
   for writer in writers:
     writer.close()
+  if progress_fn is not None:
+    progress_fn(num_written)
 
   logging.info('Finished writing, skipped %d annotations.',
                total_num_annotations_skipped)
-  return total_num_annotations_skipped
\ No newline at end of file
+  return total_num_annotations_skipped
+
+
+class IncrementalManifest(object):
+  """Tracks the inputs of every shard so unchanged shards can be reused.
+  Saved after each shard is written, so a killed conversion resumes with the
+  shards that were not finished yet."""
+
+  VERSION = 1
+
+  def __init__(self, path, num_shards):
+    self.path = path
+    self.data = None
+    if tf.io.gfile.exists(path):
+      with tf.io.gfile.GFile(path, 'r') as f:
+        data = json.load(f)
+      if (data.get('version') == self.VERSION and
+          data.get('num_shards') == num_shards):
+        self.data = data
+      else:
+        logging.info('Manifest %s does not match, rebuilding all shards.',
+                     path)
+    if self.data is None:
+      self.data = {'version': self.VERSION, 'num_shards': num_shards,
+                   'files': {}, 'shards': {}}
+    self.seen_files = set()
+
+  def file_digest(self, path):
+    """sha256 of a file, only read again when its size or mtime changed."""
+    self.seen_files.add(path)
+    stat = tf.io.gfile.stat(path)
+    cached = self.data['files'].get(path)
+    if cached and cached[0] == stat.length and cached[1] == stat.mtime_nsec:
+      return cached[2]
+    digest = hashlib.sha256()
+    with tf.io.gfile.GFile(path, 'rb') as f:
+      for chunk in iter(functools.partial(f.read, 1 << 20), b''):
+        digest.update(chunk)
+    self.data['files'][path] = [stat.length, stat.mtime_nsec,
+                                digest.hexdigest()]
+    return digest.hexdigest()
+
+  def prune_files(self):
+    """Forgets files that were not hashed during this run."""
+    self.data['files'] = dict(
+        (path, value) for path, value in self.data['files'].items()
+        if path in self.seen_files)
+
+  def shard(self, shard):
+    return self.data['shards'].get(str(shard))
+
+  def set_shard(self, shard, digest, num_records, num_skipped):
+    self.data['shards'][str(shard)] = {
+        'digest': digest, 'num_records': num_records,
+        'num_skipped': num_skipped}
+
+  def save(self):
+    tmp_path = self.path + '.tmp'
+    with tf.io.gfile.GFile(tmp_path, 'w') as f:
+      json.dump(self.data, f)
+    tf.io.gfile.rename(tmp_path, self.path, overwrite=True)
+
+
+def _write_shard(output_path, shard, num_shards, process_func, elements):
+  """Writes one complete shard, only replacing the old one once finished."""
+  path = shard_path(output_path, shard, num_shards)
+  tmp_path = path + '.tmp'
+  num_skipped = 0
+  try:
+    with tf.io.TFRecordWriter(tmp_path) as writer:
+      for args in elements:
+        tf_example, num_annotations_skipped = process_func(*args)
+        num_skipped += num_annotations_skipped
+        writer.write(tf_example.SerializeToString())
+  except Exception:
+    tf.io.gfile.remove(tmp_path)
+    raise
+  tf.io.gfile.rename(tmp_path, path, overwrite=True)
+  return shard, len(elements), num_skipped
+
+
+def write_tf_record_dataset_incremental(output_path, keyed_iterator,
+                                        process_func, num_shards, manifest,
+                                        use_multiprocessing=True):
+  """Rebuilds only the shards whose inputs changed since the last run.
+  Elements are assigned to shards by a hash of their key instead of their
+  position, so adding or removing an image only touches its own shard.
+  Args:
+    output_path: The prefix path to create TF record files.
+    keyed_iterator: An iterator of (key, digest, args) tuples. key identifies
+      the element (e.g. the image file name), digest changes whenever its
+      content does and args are passed to process_func.
+    process_func: Same as in write_tf_record_dataset.
+    num_shards: int, the number of shards to write for the dataset.
+    manifest: IncrementalManifest describing the previous run.
+    use_multiprocessing:
+      Whether or not to write shards in multiple processes.
+  Returns:
+    num_skipped: The total number of skipped annotations, reused shards
+      included.
+  """
+  shard_elements = [[] for _ in range(num_shards)]
+  shard_digests = [hashlib.sha256() for _ in range(num_shards)]
+  for key, digest, args in keyed_iterator:
+    shard = int(hashlib.sha256(key.encode('utf8')).hexdigest(), 16) % num_shards
+    shard_elements[shard].append(args)
+    shard_digests[shard].update('{}\0{}\0'.format(key, digest).encode('utf8'))
+  shard_digests = [digest.hexdigest() for digest in shard_digests]
+
+  stale_shards = []
+  for shard in range(num_shards):
+    previous = manifest.shard(shard)
+    if (previous is None or previous['digest'] != shard_digests[shard] or
+        not tf.io.gfile.exists(shard_path(output_path, shard, num_shards))):
+      stale_shards.append(shard)
+  logging.info('Rebuilding %d of %d shards.', len(stale_shards), num_shards)
+  # Save file digests now so a killed run doesn't hash the images again.
+  manifest.prune_files()
+  manifest.save()
+
+  tasks = [(output_path, shard, num_shards, process_func, shard_elements[shard])
+           for shard in stale_shards]
+  if use_multiprocessing and tasks:
+    pool = mp.Pool()
+    results = pool.imap_unordered(
+        functools.partial(_apply_star, _write_shard), tasks)
+  else:
+    pool = None
+    results = itertools.starmap(_write_shard, tasks)
+
+  try:
+    for shard, num_records, num_skipped in results:
+      manifest.set_shard(shard, shard_digests[shard], num_records, num_skipped)
+      manifest.save()
+      logging.info('Finished shard %d', shard)
+  finally:
+    if pool is not None:
+      pool.close()
+      pool.join()
+
+  total_num_annotations_skipped = sum(
+      manifest.shard(shard)['num_skipped'] for shard in range(num_shards))
+  logging.info('Finished writing, skipped %d annotations.',
+               total_num_annotations_skipped)
+  return total_num_annotations_skipped
@@ -1,9 +1,15 @@
 import os
-import copy
 import json
-import shutil
+import math
 import random
-from utils import save_datasets, get_annotation_from_image_id
+import collections
+import profiling
+from image_store import ImageStore
+from coco_stream import AnnotationIndex, CocoWriter, iter_coco_array, load_coco_header
+from utils import save_datasets, get_annotation_from_image_id, build_annotation_index, transfer_files, image_file_name, LINK_MODES
+
+# Images transferred at once in streaming mode, bounding the pending transfers
+TRANSFER_BATCH_SIZE = 10000
 
 def read_dataset(path: str='annotations/instances_default.json') -> dict:
     with open(path) as f:
@@ -15,58 +21,52 @@ def create_empty_datasets(categories: list) -> tuple:
     val_set={"images": [], "annotations": [], "info": {"url": "", "year": "", "version": "", "contributor": "", "date_created": "", "description": ""}, "licenses": [{"name": "", "id": 0, "url": ""}], "categories": categories}
     return (train_set, val_set)
 
-def split_dataset(dataset_name: str='instances_default.json', val_split: float=0.2, input_path: str='', output_path: str='') -> tuple:
+def split_dataset(dataset_name: str='instances_default.json', val_split: float=0.2, input_path: str='', output_path: str='', num_workers: int=1, link_mode: str='copy', streaming: bool=False, image_store: ImageStore=None, stratify: bool=False) -> tuple:
+    """With image_store, images are added to the content-addressed store and
+    linked into the split folders instead of being copied. With stratify,
+    see StratifiedSplitter, otherwise each image is drawn at random."""
     val_split /= 100
     if val_split > 1 or val_split < 0:
         raise ValueError('val_split should be between [0:100]')
+    if link_mode not in LINK_MODES:
+        raise ValueError('link_mode should be one of: {}'.format(', '.join(LINK_MODES)))
     create_split_folders(output_path) 
+    if streaming:
+        return stream_split_dataset(input_path + 'annotations/' + dataset_name, val_split, input_path, output_path, num_workers, link_mode, image_store, stratify)
     dataset = read_dataset(input_path + 'annotations/' + dataset_name)
     train_set, val_set = create_empty_datasets(dataset['categories'])
     print('Splitting dataset:')
     print('Total images: {}'.format(len(dataset['images'])))
     print('Total annotations: {}'.format(len(dataset['annotations'])))
+    annotation_index = build_annotation_index(dataset)
+    splitter = None
+    if stratify:
+        splitter = StratifiedSplitter(val_split, collections.Counter(annotation['category_id'] for annotation in dataset['annotations']))
+    file_transfers = []
     random.seed(99)
     for image in dataset['images']:
-        rand = random.random()
-        new_image = copy.deepcopy(image)
-        new_annotations = get_annotation_from_image_id(dataset, new_image['id'])
-        if rand < val_split:
-            image_id = len(val_set['images'])
-            new_image['id'] = image_id
-            for new_annotation in new_annotations:
-                annotation_id = len(val_set['annotations'])
-                new_annotation['id'] = annotation_id
-                new_annotation['image_id'] = image_id
-                segmentations = new_annotation['segmentation']
-                new_annotation['segmentation'] = []
-                for segmentation in segmentations:
-                    if len(segmentation) > 4 and len(segmentation) % 2 == 0:
-                        new_annotation['segmentation'].append(segmentation)
-                val_set['annotations'].append(new_annotation)
-            old_filename = new_image['file_name'].split('/')[-1]
-            img_sufix = old_filename.split('.')[-1]
-            new_image['file_name'] = '{:04d}.'.format(image_id)+img_sufix
-            val_set['images'].append(new_image)
-            shutil.copyfile(input_path+'images/'+old_filename,output_path+'eval_set/images/'+new_image['file_name'])
+        if splitter is not None:
+            to_val = splitter.assign(splitter.rarest(annotation['category_id'] for annotation in annotation_index.get(image['id'], [])))
+        else:
+            to_val = random.random() < val_split
+        if to_val:
+            target_set, target_folder = val_set, 'eval_set/'
         else:
-            image_id = len(train_set['images'])
-            new_image['id'] = image_id
-            for new_annotation in new_annotations:
-                annotation_id = len(train_set['annotations'])
-                new_annotation['id'] = annotation_id
-                new_annotation['image_id'] = image_id
-                segmentations = new_annotation['segmentation']
-                new_annotation['segmentation'] = []
-                for segmentation in segmentations:
-                    if len(segmentation) > 4 and len(segmentation) % 2 == 0:
-                        new_annotation['segmentation'].append(segmentation)
-                train_set['annotations'].append(new_annotation)
-            old_filename = new_image['file_name'].split('/')[-1]
-            img_sufix = old_filename.split('.')[-1]
-            new_image['file_name'] = '{:04d}.'.format(image_id)+img_sufix
-            train_set['images'].append(new_image)
-            shutil.copyfile(input_path+'images/'+old_filename,output_path+'train_set/images/'+new_image['file_name'])
+            target_set, target_folder = train_set, 'train_set/'
+        new_image = dict(image)
+        new_annotations = get_annotation_from_image_id(dataset, new_image['id'], annotation_index)
+        image_id = len(target_set['images'])
+        new_image['id'] = image_id
+        for new_annotation in new_annotations:
+            remap_annotation(new_annotation, len(target_set['annotations']), image_id)
+            target_set['annotations'].append(new_annotation)
+        old_filename = new_image['file_name'].split('/')[-1]
+        new_image['file_name'] = split_file_name(old_filename, image_id, len(dataset['images']))
+        target_set['images'].append(new_image)
+        file_transfers.append((input_path+'images/'+old_filename, output_path+target_folder+'images/'+new_image['file_name']))
 
+    run_file_transfers(file_transfers, link_mode, num_workers, image_store)
+    profiling.add_images(len(dataset['images']))
     save_datasets(output_path, train_set, val_set)
 
     print('\nSplitting done!')
@@ -77,6 +77,122 @@ def split_dataset(dataset_name: str='instances_default.json', val_split: float=0
 
     return train_set, val_set
 
+def stream_split_dataset(dataset_path: str, val_split: float, input_path: str, output_path: str, num_workers: int=1, link_mode: str='copy', image_store: ImageStore=None, stratify: bool=False) -> tuple:
+    """Same split and output as split_dataset, streamed image by image: the
+    annotations of each image are looked up in an on-disk AnnotationIndex
+    and images are transferred in batches of TRANSFER_BATCH_SIZE, so memory
+    doesn't grow with the dataset. The returned sets only carry the header
+    sections, images and annotations stay on disk."""
+    header = load_coco_header(dataset_path)
+    train_set, val_set = create_empty_datasets(header['categories'])
+    num_images = sum(1 for _ in iter_coco_array(dataset_path, 'images'))
+    writers = {
+        'train_set/': CocoWriter(os.path.join(output_path, 'train_set/annotations/instances_default.json'), train_set),
+        'eval_set/': CocoWriter(os.path.join(output_path, 'eval_set/annotations/instances_default.json'), val_set)
+    }
+    try:
+        with AnnotationIndex(dataset_path) as annotation_index:
+            print('Splitting dataset:')
+            print('Total images: {}'.format(num_images))
+            print('Total annotations: {}'.format(annotation_index.num_annotations))
+            splitter = None
+            if stratify:
+                splitter = StratifiedSplitter(val_split, annotation_index.category_counts)
+            file_transfers = []
+            random.seed(99)
+            for image in iter_coco_array(dataset_path, 'images'):
+                annotations = get_annotation_from_image_id(None, image['id'], annotation_index)
+                if splitter is not None:
+                    to_val = splitter.assign(splitter.rarest(annotation['category_id'] for annotation in annotations))
+                else:
+                    to_val = random.random() < val_split
+                target_folder = 'eval_set/' if to_val else 'train_set/'
+                writer = writers[target_folder]
+                image_id = writer.num_images
+                image['id'] = image_id
+                for annotation in annotations:
+                    remap_annotation(annotation, writer.num_annotations, image_id)
+                    writer.add_annotation(annotation)
+                old_filename = image['file_name'].split('/')[-1]
+                image['file_name'] = split_file_name(old_filename, image_id, num_images)
+                writer.add_image(image)
+                file_transfers.append((input_path+'images/'+old_filename, output_path+target_folder+'images/'+image['file_name']))
+                if len(file_transfers) == TRANSFER_BATCH_SIZE:
+                    run_file_transfers(file_transfers, link_mode, num_workers, image_store)
+                    file_transfers = []
+            run_file_transfers(file_transfers, link_mode, num_workers, image_store)
+        profiling.add_images(num_images)
+    except BaseException:
+        for writer in writers.values():
+            writer.abort()
+        raise
+
+    with profiling.phase('json_save'):
+        for writer in writers.values():
+            writer.close()
+            profiling.add_images(writer.num_images)
+
+    print('\nSplitting done!')
+    print('Train images: {}'.format(writers['train_set/'].num_images))
+    print('Train annotations: {}'.format(writers['train_set/'].num_annotations))
+    print('Eval images: {}'.format(writers['eval_set/'].num_images))
+    print('Eval annotations: {}'.format(writers['eval_set/'].num_annotations))
+
+    return train_set, val_set
+
+class StratifiedSplitter:
+    """Assigns images to the eval set in a single pass so every stratum gets
+    exactly floor(n * val_split + u) of its first n images, i.e. its ratio to
+    within one image at any point of the pass, where u is a random offset
+    drawn per stratum. An image's stratum is its rarest category, so rare
+    classes get their share of eval images instead of following common ones,
+    and images without annotations form their own stratum. A stratum of n
+    images still has no eval image with probability 1 - n * val_split when
+    that is positive, so classes that rare can end up in one set only. The
+    ratio is only exact per rarest-category stratum: the other categories of
+    multi-label images follow them and are split approximately. Memory is
+    one counter per category, the images are not held."""
+    def __init__(self, val_split: float, category_counts: collections.Counter, seed: int=99):
+        self.val_split = val_split
+        self.category_counts = category_counts
+        self.random = random.Random(seed)
+        self.offsets = {}
+        self.num_images = collections.Counter()
+        self.num_val_images = collections.Counter()
+
+    def rarest(self, category_ids) -> int:
+        return min(category_ids, key=lambda category_id: (self.category_counts[category_id], category_id), default=None)
+
+    def assign(self, stratum: int) -> bool:
+        """Returns whether the next image of the stratum goes to the eval set."""
+        if stratum not in self.offsets:
+            self.offsets[stratum] = self.random.random()
+        self.num_images[stratum] += 1
+        target = math.floor(self.num_images[stratum] * self.val_split + self.offsets[stratum])
+        if target > self.num_val_images[stratum]:
+            self.num_val_images[stratum] += 1
+            return True
+        return False
+
+def remap_annotation(annotation: dict, annotation_id: int, image_id: int) -> None:
+    annotation['id'] = annotation_id
+    annotation['image_id'] = image_id
+    segmentations = annotation['segmentation']
+    annotation['segmentation'] = []
+    for segmentation in segmentations:
+        if len(segmentation) > 4 and len(segmentation) % 2 == 0:
+            annotation['segmentation'].append(segmentation)
+
+def split_file_name(old_filename: str, image_id: int, num_images: int=0) -> str:
+    img_sufix = old_filename.split('.')[-1]
+    return image_file_name(image_id, img_sufix, num_images)
+
+def run_file_transfers(file_transfers: list, link_mode: str, num_workers: int, image_store: ImageStore=None) -> None:
+    if image_store is not None:
+        image_store.transfer_files(file_transfers, num_workers=num_workers)
+    else:
+        transfer_files(file_transfers, link_mode=link_mode, num_workers=num_workers)
+
 def create_split_folders(output_path: str) -> None:
     directories = [
         'train_set/images/',
@@ -0,0 +1,220 @@
+"""
+Mask R-CNN
+Per-image microbenchmarks of the training data pipeline.
+
+Usage:
+
+    # All benchmarks, for 1 to 100 GT boxes per image
+    python3 benchmark.py
+
+    # RPN targets only, checking they match the previous implementation
+    python3 benchmark.py rpn_targets_legacy rpn_targets --gt_counts=7,50 --check
+"""
+
+import sys
+import json
+import time
+import argparse
+import tracemalloc
+import numpy as np
+
+from mrcnn.config import Config
+from mrcnn import model as modellib, utils
+
+
+class BenchmarkConfig(Config):
+    NAME = "benchmark"
+    IMAGES_PER_GPU = 1
+    NUM_CLASSES = 1 + 80
+
+
+def synthetic_gt(num_gt, image_shape, num_crowds=0, seed=0):
+    """COCO-like GT boxes: sizes from a few pixels to most of the image,
+    in integer pixel coordinates as extract_bboxes() returns them."""
+    rng = np.random.RandomState(seed)
+    height, width = image_shape[:2]
+    sizes = np.exp(rng.uniform(np.log(8), np.log(min(height, width) * 0.8),
+                               (num_gt + num_crowds, 2)))
+    y1 = rng.uniform(0, height - sizes[:, 0])
+    x1 = rng.uniform(0, width - sizes[:, 1])
+    gt_boxes = np.stack([y1, x1, y1 + sizes[:, 0], x1 + sizes[:, 1]],
+                        axis=1).astype(np.int32)
+    gt_class_ids = rng.randint(1, 81, num_gt + num_crowds).astype(np.int32)
+    gt_class_ids[num_gt:] *= -1
+    return gt_class_ids, gt_boxes
+
+
+def build_rpn_targets_legacy(image_shape, anchors, gt_class_ids, gt_boxes, config):
+    """modellib.build_rpn_targets() with full overlaps and a per anchor
+    refinement loop, as it was before vectorizing."""
+    rpn_match = np.zeros([anchors.shape[0]], dtype=np.int32)
+    rpn_bbox = np.zeros((config.RPN_TRAIN_ANCHORS_PER_IMAGE, 4))
+    crowd_ix = np.where(gt_class_ids < 0)[0]
+    if crowd_ix.shape[0] > 0:
+        non_crowd_ix = np.where(gt_class_ids > 0)[0]
+        crowd_boxes = gt_boxes[crowd_ix]
+        gt_class_ids = gt_class_ids[non_crowd_ix]
+        gt_boxes = gt_boxes[non_crowd_ix]
+        crowd_overlaps = utils.compute_overlaps(anchors, crowd_boxes)
+        crowd_iou_max = np.amax(crowd_overlaps, axis=1)
+        no_crowd_bool = (crowd_iou_max < 0.001)
+    else:
+        no_crowd_bool = np.ones([anchors.shape[0]], dtype=bool)
+    overlaps = utils.compute_overlaps(anchors, gt_boxes)
+    anchor_iou_argmax = np.argmax(overlaps, axis=1)
+    anchor_iou_max = overlaps[np.arange(overlaps.shape[0]), anchor_iou_argmax]
+    rpn_match[(anchor_iou_max < 0.3) & (no_crowd_bool)] = -1
+    gt_iou_argmax = np.argwhere(overlaps == np.max(overlaps, axis=0))[:, 0]
+    rpn_match[gt_iou_argmax] = 1
+    rpn_match[anchor_iou_max >= 0.7] = 1
+    ids = np.where(rpn_match == 1)[0]
+    extra = len(ids) - (config.RPN_TRAIN_ANCHORS_PER_IMAGE // 2)
+    if extra > 0:
+        ids = np.random.choice(ids, extra, replace=False)
+        rpn_match[ids] = 0
+    ids = np.where(rpn_match == -1)[0]
+    extra = len(ids) - (config.RPN_TRAIN_ANCHORS_PER_IMAGE -
+                        np.sum(rpn_match == 1))
+    if extra > 0:
+        ids = np.random.choice(ids, extra, replace=False)
+        rpn_match[ids] = 0
+    ids = np.where(rpn_match == 1)[0]
+    ix = 0
+    for i, a in zip(ids, anchors[ids]):
+        gt = gt_boxes[anchor_iou_argmax[i]]
+        gt_h = gt[2] - gt[0]
+        gt_w = gt[3] - gt[1]
+        gt_center_y = gt[0] + 0.5 * gt_h
+        gt_center_x = gt[1] + 0.5 * gt_w
+        a_h = a[2] - a[0]
+        a_w = a[3] - a[1]
+        a_center_y = a[0] + 0.5 * a_h
+        a_center_x = a[1] + 0.5 * a_w
+        rpn_bbox[ix] = [
+            (gt_center_y - a_center_y) / a_h,
+            (gt_center_x - a_center_x) / a_w,
+            np.log(gt_h / a_h),
+            np.log(gt_w / a_w),
+        ]
+        rpn_bbox[ix] /= config.RPN_BBOX_STD_DEV
+        ix += 1
+    return rpn_match, rpn_bbox
+
+
+def compute_recall_legacy(pred_boxes, gt_boxes, iou):
+    """utils.compute_recall() with full overlaps, as it was before the
+    spatial index."""
+    overlaps = utils.compute_overlaps(pred_boxes, gt_boxes)
+    iou_max = np.max(overlaps, axis=1)
+    iou_argmax = np.argmax(overlaps, axis=1)
+    positive_ids = np.where(iou_max >= iou)[0]
+    matched_gt_boxes = iou_argmax[positive_ids]
+    recall = len(set(matched_gt_boxes)) / gt_boxes.shape[0]
+    return recall, positive_ids
+
+
+def benchmark_rpn_targets_legacy(inputs, config):
+    return build_rpn_targets_legacy(config.IMAGE_SHAPE, inputs['anchors'],
+                                    inputs['gt_class_ids'], inputs['gt_boxes'],
+                                    config)
+
+
+def benchmark_rpn_targets(inputs, config):
+    """With the anchor index built once, as DataGenerator does."""
+    return modellib.build_rpn_targets(config.IMAGE_SHAPE, inputs['anchors'],
+                                      inputs['gt_class_ids'], inputs['gt_boxes'],
+                                      config, anchor_index=inputs['anchor_index'])
+
+
+def benchmark_recall_legacy(inputs, config):
+    recall, positive_ids = compute_recall_legacy(inputs['proposals'],
+                                                 inputs['gt_boxes'], 0.5)
+    return np.array([recall]), positive_ids
+
+
+def benchmark_recall(inputs, config):
+    recall, positive_ids = utils.compute_recall(inputs['proposals'],
+                                                inputs['gt_boxes'], 0.5)
+    return np.array([recall]), positive_ids
+
+
+BENCHMARKS = {
+    'rpn_targets_legacy': benchmark_rpn_targets_legacy,
+    'rpn_targets': benchmark_rpn_targets,
+    'recall_legacy': benchmark_recall_legacy,
+    'recall': benchmark_recall,
+}
+
+
+def run(benchmark, inputs, config, args):
+    """Returns milliseconds per image, the peak of memory allocated while
+    building the targets of one image and the last targets. The random
+    subsampling is seeded the same for every implementation."""
+    np.random.seed(0)
+    start = time.perf_counter()
+    for _ in range(args.repeats):
+        targets = benchmark(inputs, config)
+    seconds = time.perf_counter() - start
+    np.random.seed(0)
+    tracemalloc.start()
+    benchmark(inputs, config)
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    return seconds * 1000 / args.repeats, peak / 2**20, targets
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(
+        description='Per-image time and memory of the Mask R-CNN target builders')
+    parser.add_argument('benchmarks', nargs='*', default=list(BENCHMARKS))
+    parser.add_argument('--gt_counts', default='1,7,20,50,100',
+                        help='Comma separated GT boxes per image, COCO '
+                             'averages 7 and goes past 50')
+    parser.add_argument('--crowds', default=1, type=int,
+                        help='Crowd boxes added to each image')
+    parser.add_argument('--proposals', default=2000, type=int,
+                        help='Proposal boxes for the recall benchmarks')
+    parser.add_argument('--repeats', default=20, type=int)
+    parser.add_argument('--check', action='store_true',
+                        help='Fail if the targets differ between benchmarks')
+    args = parser.parse_args()
+    unknown = [name for name in args.benchmarks if name not in BENCHMARKS]
+    if unknown:
+        parser.error('unknown benchmarks: {}, choose from: {}'.format(
+            ', '.join(unknown), ', '.join(BENCHMARKS)))
+
+    config = BenchmarkConfig()
+    backbone_shapes = modellib.compute_backbone_shapes(config, config.IMAGE_SHAPE)
+    anchors = utils.generate_pyramid_anchors(config.RPN_ANCHOR_SCALES,
+                                             config.RPN_ANCHOR_RATIOS,
+                                             backbone_shapes,
+                                             config.BACKBONE_STRIDES,
+                                             config.RPN_ANCHOR_STRIDE)
+    anchor_index = utils.BoxIndex(anchors)
+    failed = False
+    for num_gt in [int(count) for count in args.gt_counts.split(',')]:
+        gt_class_ids, gt_boxes = synthetic_gt(num_gt, config.IMAGE_SHAPE,
+                                              args.crowds)
+        # Proposals scattered like RPN output, some close to GT boxes
+        _, proposals = synthetic_gt(args.proposals, config.IMAGE_SHAPE, seed=1)
+        inputs = {'anchors': anchors, 'anchor_index': anchor_index,
+                  'gt_class_ids': gt_class_ids, 'gt_boxes': gt_boxes,
+                  'proposals': np.concatenate([gt_boxes[:num_gt] + 2, proposals])}
+        references = {}
+        for name in args.benchmarks:
+            ms, peak_mb, targets = run(BENCHMARKS[name], inputs, config, args)
+            result = {'benchmark': name, 'gt_boxes': num_gt,
+                      'anchors': anchors.shape[0], 'ms_per_image': round(ms, 2),
+                      'peak_mb': round(peak_mb, 1)}
+            if args.check:
+                # Compare with the legacy version of the same targets
+                kind = name.replace('_legacy', '')
+                if kind not in references:
+                    references[kind] = targets
+                else:
+                    result['identical'] = all(
+                        a.dtype == b.dtype and a.tobytes() == b.tobytes()
+                        for a, b in zip(references[kind], targets))
+                    failed = failed or not result['identical']
+            print(json.dumps(result))
+    sys.exit(1 if failed else 0)
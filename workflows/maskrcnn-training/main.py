@@ -18,6 +18,10 @@ Usage: import the module (see Jupyter notebooks for examples), or run from
     # Continue training a model that you had trained earlier using workflows
     python3 main.py train --dataset=/path/to/coco/ --model=workflow_maskrcnn --num_classes=2 --extras="parameters string()" --logs=/path/to/output --ref_model_path="reference name"
 
+    # Train from the TFRecords of create_coco_tf_record.py --include_masks, the
+    # dataset still provides the classes
+    python3 main.py train --dataset=/path/to/coco/ --model=workflow_maskrcnn --num_classes=2 --extras="train_tfrecords: /path/to/tfrecord/train.tfrecord-*" --logs=/path/to/output
+
     # Run COCO evaluation on the last model you trained
     python3 main.py evaluate --dataset=/path/to/coco/ --model=last
 
@@ -26,6 +30,7 @@ Usage: import the module (see Jupyter notebooks for examples), or run from
 import os
 import time
 import json
+import hashlib
 import csv
 import shutil
 import yaml
@@ -42,7 +47,7 @@ import shutil
 
 # Import Mask RCNN
 from mrcnn.config import Config
-from mrcnn import model as modellib, utils
+from mrcnn import model as modellib, utils, tfrecord_data
 
 ############################################################
 #  Configurations
@@ -100,9 +105,17 @@ class OnepanelDataset(utils.Dataset):
 
         # Add images
         for i in image_ids:
+            # Images packed by the preprocessing workflow (--pack_augmented)
+            # are read from a byte range of their pack file
+            pack = coco.imgs[i].get("pack")
+            if pack is not None:
+                path = os.path.join(image_dir, pack["file"])
+            else:
+                path = os.path.join(image_dir, os.path.basename(coco.imgs[i]['file_name']))
             self.add_image(
                 "coco", image_id=i,
-                path=os.path.join(image_dir, os.path.basename(coco.imgs[i]['file_name'])),
+                path=path,
+                pack=pack,
                 width=coco.imgs[i]["width"],
                 height=coco.imgs[i]["height"],
                 annotations=coco.loadAnns(coco.getAnnIds(
@@ -161,6 +174,21 @@ class OnepanelDataset(utils.Dataset):
             # Call super class to return an empty mask
             return super(OnepanelDataset, self).load_mask(image_id)
 
+    def target_cache_key(self, image_id):
+        """Key of the cached training targets of the image: a hash of its COCO
+        ID, the file and the annotations, so editing either invalidates them.
+        Computed the first time the cache asks for it, then kept."""
+        image_info = self.image_info[image_id]
+        if image_info["source"] != "coco":
+            return super(OnepanelDataset, self).target_cache_key(image_id)
+        if "target_cache_key" not in image_info:
+            stat = os.stat(image_info["path"])
+            key = json.dumps([image_info["id"], image_info["path"], image_info["pack"],
+                              stat.st_size, stat.st_mtime_ns, image_info["annotations"]],
+                             sort_keys=True)
+            image_info["target_cache_key"] = hashlib.sha1(key.encode("utf8")).hexdigest()
+        return image_info["target_cache_key"]
+
     # The following two functions are from pycocotools with a few changes.
 
     def annToRLE(self, ann, height, width):
@@ -306,8 +334,25 @@ def train(params, model, config, train_dataset, val_dataset, output_folder, use_
     else:
         dataset_val = dataset_train
 
-    # Image Augmentation
+    # Image Augmentation. The default right/left flips are applied by the
+    # data generator, after the cached targets when TARGET_CACHE_DIR is set
     augmentation = get_augmentations(params)
+    flip = 0.5 if augmentation is None else 0
+
+    # Batches built by a tf.data pipeline from TFRecords, which flips images
+    # in place of the imgaug augmentation
+    if params.get('train_tfrecords'):
+        if 'augmentations' in params:
+            raise ValueError('train_tfrecords only supports left/right flips, remove augmentations from the parameters')
+        class_map = tfrecord_data.class_map(dataset_train)
+        if use_validation and params.get('val_tfrecords'):
+            dataset_val = tfrecord_data.build_dataset(params['val_tfrecords'], config,
+                                                      class_map, tfrecord_data.image_map(dataset_val))
+        dataset_train = tfrecord_data.build_dataset(params['train_tfrecords'], config,
+                                                    class_map, tfrecord_data.image_map(dataset_train),
+                                                    flip=0.5)
+        augmentation = None
+        flip = 0
 
     # *** Training schedule ***
 
@@ -318,7 +363,8 @@ def train(params, model, config, train_dataset, val_dataset, output_folder, use_
                     learning_rate=config.LEARNING_RATE,
                     epochs=params['stage_1_epochs'],
                     layers='heads',
-                    augmentation=augmentation)
+                    augmentation=augmentation,
+                    flip=flip)
     else:
         print("First stage skipped, {} sent as num of first stage epochs".format(params['stage_1_epochs']))
 
@@ -330,7 +376,8 @@ def train(params, model, config, train_dataset, val_dataset, output_folder, use_
                     learning_rate=config.LEARNING_RATE,
                     epochs=params['stage_2_epochs'],
                     layers='4+',
-                    augmentation=augmentation)
+                    augmentation=augmentation,
+                    flip=flip)
     else:
         print("Second stage skipped, {} sent as num of second stage epochs".format(params['stage_2_epochs']))
 
@@ -342,7 +389,8 @@ def train(params, model, config, train_dataset, val_dataset, output_folder, use_
                     learning_rate=config.LEARNING_RATE / 10,
                     epochs=params['stage_3_epochs'],
                     layers='all',
-                    augmentation=augmentation)
+                    augmentation=augmentation,
+                    flip=flip)
     else:
         print("Third stage skipped, {} sent as num of third stage epochs".format(params['stage_3_epochs']))
 
@@ -485,8 +533,8 @@ def get_augmentations(params):
         ## TODO: implement augmentation parsing
         augmentation = imgaug.augmenters.Fliplr(0.5)
     else:
-        # Right/Left flip 50% of the time
-        augmentation = imgaug.augmenters.Fliplr(0.5)
+        # Right/Left flips are done by the data generator, see train()
+        augmentation = None
     return augmentation
 
 def create_output_folders(output_dir):
@@ -52,6 +52,19 @@ class Config(object):
     # down the training.
     VALIDATION_STEPS = 50
 
+    # Processes that build training batches into shared memory, ahead of the
+    # model. 0 builds them in the training process. None uses one per CPU
+    # but one, up to 8. The workers are forked from the training process,
+    # so datasets must not use TensorFlow to load images. Only for the
+    # "square" and "crop" resize modes, where all batches have the same shape.
+    DATA_WORKERS = 0
+    # Batches that workers can build ahead of the one being trained on. Each
+    # takes BATCH_SIZE images, anchors and masks of shared memory. None picks
+    # enough to keep every worker busy.
+    DATA_QUEUE_SIZE = None
+    # Log the training batches per second every this many batches. 0 disables.
+    DATA_LOG_STEPS = 500
+
     # Backbone network architecture
     # Supported values are: resnet50, resnet101.
     # You can also provide a callable that should have the signature
@@ -136,6 +149,12 @@ class Config(object):
     # the width and height, or more, even if MIN_IMAGE_DIM doesn't require it.
     # However, in 'square' mode, it can be overruled by IMAGE_MAX_DIM.
     IMAGE_MIN_SCALE = 0
+    # Directory to cache resized images, bounding boxes and masks of training
+    # images in, so that later epochs skip decoding them. Only used without
+    # imgaug augmentation (the flip option of train() is applied after it)
+    # and with datasets that implement target_cache_key(). Not available in
+    # "crop" mode. None disables the cache.
+    TARGET_CACHE_DIR = None
     # Number of color channels per image. RGB = 3, grayscale = 1, RGB-D = 4
     # Changing this requires other changes in the code. See the WIKI for more
     # details: https://github.com/matterport/Mask_RCNN/wiki
@@ -10,11 +10,18 @@ import warnings
 warnings.filterwarnings("ignore")
 
 import os
+import shutil
 import datetime
 import re
 import math
+import time
+import queue
+import random
+import traceback
+import collections
 from collections import OrderedDict
 import multiprocessing
+from multiprocessing import shared_memory
 import numpy as np
 import tensorflow as tf
 import tensorflow.keras as keras
@@ -1215,12 +1222,15 @@ def mrcnn_mask_loss_graph(target_masks, target_class_ids, pred_masks):
 #  Data Generator
 ############################################################
 
-def load_image_gt(dataset, config, image_id, augmentation=None):
+def load_image_gt(dataset, config, image_id, augmentation=None,
+                  target_cache=None):
     """Load and return ground truth data for an image (image, mask, bounding boxes).
 
     augmentation: Optional. An imgaug (https://github.com/aleju/imgaug) augmentation.
         For example, passing imgaug.augmenters.Fliplr(0.5) flips images
         right/left 50% of the time.
+    target_cache: Optional. A utils.TargetCache to load the targets from and
+        save them to. Only used without augmentation.
 
     Returns:
     image: [height, width, 3]
@@ -1231,6 +1241,19 @@ def load_image_gt(dataset, config, image_id, augmentation=None):
         of the image unless use_mini_mask is True, in which case they are
         defined in MINI_MASK_SHAPE.
     """
+    if augmentation:
+        target_cache = None
+    cached = target_cache.load(image_id) if target_cache else None
+    if cached:
+        active_class_ids = np.zeros([dataset.num_classes], dtype=np.int32)
+        source_class_ids = dataset.source_class_ids[dataset.image_info[image_id]["source"]]
+        active_class_ids[source_class_ids] = 1
+        image_meta = compose_image_meta(image_id, cached["original_shape"],
+                                        cached["image"].shape, cached["window"],
+                                        cached["scale"], active_class_ids)
+        return (cached["image"], image_meta, cached["class_ids"],
+                cached["bbox"], cached["mask"])
+
     # Load image and mask
     image = dataset.load_image(image_id)
     mask, class_ids = dataset.load_mask(image_id)
@@ -1295,6 +1318,10 @@ def load_image_gt(dataset, config, image_id, augmentation=None):
     if config.USE_MINI_MASK:
         mask = utils.minimize_mask(bbox, mask, config.MINI_MASK_SHAPE)
 
+    if target_cache:
+        target_cache.save(image_id, image, original_shape, window, scale,
+                          class_ids, bbox, mask)
+
     # Image meta data
     image_meta = compose_image_meta(image_id, original_shape, image.shape,
                                     window, scale, active_class_ids)
@@ -1302,6 +1329,16 @@ def load_image_gt(dataset, config, image_id, augmentation=None):
     return image, image_meta, class_ids, bbox, mask
 
 
+def flip_image_gt(image, bbox, mask):
+    """Flips the image, bounding boxes and masks of load_image_gt() left/right.
+    Mini masks are flipped within their boxes, so this works for both kinds.
+    The window of the image meta is kept, as with a Fliplr augmentation.
+    """
+    bbox = bbox.copy()
+    bbox[:, [1, 3]] = image.shape[1] - bbox[:, [3, 1]]
+    return image[:, ::-1], bbox, mask[:, ::-1]
+
+
 def build_detection_targets(rpn_rois, gt_class_ids, gt_boxes, gt_masks, config):
     """Generate targets for training Stage 2 classifier and mask heads.
     This is not used in normal training. It's useful for debugging or to train
@@ -1340,18 +1377,9 @@ def build_detection_targets(rpn_rois, gt_class_ids, gt_boxes, gt_masks, config):
     gt_boxes = gt_boxes[instance_ids]
     gt_masks = gt_masks[:, :, instance_ids]
 
-    # Compute areas of ROIs and ground truth boxes.
-    rpn_roi_area = (rpn_rois[:, 2] - rpn_rois[:, 0]) * \
-        (rpn_rois[:, 3] - rpn_rois[:, 1])
-    gt_box_area = (gt_boxes[:, 2] - gt_boxes[:, 0]) * \
-        (gt_boxes[:, 3] - gt_boxes[:, 1])
-
-    # Compute overlaps [rpn_rois, gt_boxes]
-    overlaps = np.zeros((rpn_rois.shape[0], gt_boxes.shape[0]))
-    for i in range(overlaps.shape[1]):
-        gt = gt_boxes[i]
-        overlaps[:, i] = utils.compute_iou(
-            gt, rpn_rois, gt_box_area[i], rpn_roi_area)
+    # Compute overlaps [rpn_rois, gt_boxes]. There are few enough ROIs that
+    # computing all of them is cheaper than finding candidate pairs.
+    overlaps = utils.compute_overlaps(rpn_rois, gt_boxes)
 
     # Assign ROIs to GT boxes
     rpn_roi_iou_argmax = np.argmax(overlaps, axis=1)
@@ -1458,19 +1486,24 @@ def build_detection_targets(rpn_rois, gt_class_ids, gt_boxes, gt_masks, config):
     return rois, roi_gt_class_ids, bboxes, masks
 
 
-def build_rpn_targets(image_shape, anchors, gt_class_ids, gt_boxes, config):
+def build_rpn_targets(image_shape, anchors, gt_class_ids, gt_boxes, config,
+                      anchor_index=None):
     """Given the anchors and GT boxes, compute overlaps and identify positive
     anchors and deltas to refine them to match their corresponding GT boxes.
 
     anchors: [num_anchors, (y1, x1, y2, x2)]
     gt_class_ids: [num_gt_boxes] Integer class IDs.
     gt_boxes: [num_gt_boxes, (y1, x1, y2, x2)]
+    anchor_index: Optional utils.BoxIndex of the anchors. Pass it when
+        calling with the same anchors for many images.
 
     Returns:
     rpn_match: [N] (int32) matches between anchors and GT boxes.
                1 = positive anchor, -1 = negative anchor, 0 = neutral
     rpn_bbox: [N, (dy, dx, log(dh), log(dw))] Anchor bbox deltas.
     """
+    if anchor_index is None:
+        anchor_index = utils.BoxIndex(anchors)
     # RPN Match: 1 = positive anchor, -1 = negative anchor, 0 = neutral
     rpn_match = np.zeros([anchors.shape[0]], dtype=np.int32)
     # RPN bounding boxes: [max anchors per image, (dy, dx, log(dh), log(dw))]
@@ -1486,16 +1519,23 @@ def build_rpn_targets(image_shape, anchors, gt_class_ids, gt_boxes, config):
         crowd_boxes = gt_boxes[crowd_ix]
         gt_class_ids = gt_class_ids[non_crowd_ix]
         gt_boxes = gt_boxes[non_crowd_ix]
-        # Compute overlaps with crowd boxes [anchors, crowds]
-        crowd_overlaps = utils.compute_overlaps(anchors, crowd_boxes)
-        crowd_iou_max = np.amax(crowd_overlaps, axis=1)
-        no_crowd_bool = (crowd_iou_max < 0.001)
+        # Anchors that overlap a crowd box. Only those that intersect one
+        # can have an IoU >= 0.001.
+        crowd_anchor_ix, _, crowd_overlaps = utils.compute_candidate_overlaps(
+            anchors, crowd_boxes, 0.001, index=anchor_index)
+        no_crowd_bool = np.ones([anchors.shape[0]], dtype=bool)
+        no_crowd_bool[crowd_anchor_ix[crowd_overlaps >= 0.001]] = False
     else:
         # All anchors don't intersect a crowd
         no_crowd_bool = np.ones([anchors.shape[0]], dtype=bool)
 
-    # Compute overlaps [num_anchors, num_gt_boxes]
-    overlaps = utils.compute_overlaps(anchors, gt_boxes)
+    # Compute overlaps of (anchor, GT box) pairs, only for the pairs that can
+    # have an IoU >= 0.3. The IoU of other pairs is below 0.3, it can't make
+    # an anchor positive or its own GT box the closest one.
+    anchor_ix, gt_ix, pair_overlaps = utils.compute_candidate_overlaps(
+        anchors, gt_boxes, 0.3, index=anchor_index)
+    # Pairs of GT box i are pairs[gt_starts[i]:gt_starts[i + 1]]
+    gt_starts = np.searchsorted(gt_ix, np.arange(gt_boxes.shape[0] + 1))
 
     # Match anchors to GT Boxes
     # If an anchor overlaps a GT box with IoU >= 0.7 then it's positive.
@@ -1507,13 +1547,38 @@ def build_rpn_targets(image_shape, anchors, gt_class_ids, gt_boxes, config):
     #
     # 1. Set negative anchors first. They get overwritten below if a GT box is
     # matched to them. Skip boxes in crowd areas.
-    anchor_iou_argmax = np.argmax(overlaps, axis=1)
-    anchor_iou_max = overlaps[np.arange(overlaps.shape[0]), anchor_iou_argmax]
+    # Closest GT box of each anchor, the first one on ties like np.argmax()
+    anchor_iou_argmax = np.zeros([anchors.shape[0]], dtype=np.int64)
+    anchor_iou_max = np.zeros([anchors.shape[0]])
+    for i in range(gt_boxes.shape[0]):
+        ix = anchor_ix[gt_starts[i]:gt_starts[i + 1]]
+        iou = pair_overlaps[gt_starts[i]:gt_starts[i + 1]]
+        closer = iou > anchor_iou_max[ix]
+        anchor_iou_max[ix[closer]] = iou[closer]
+        anchor_iou_argmax[ix[closer]] = i
     rpn_match[(anchor_iou_max < 0.3) & (no_crowd_bool)] = -1
     # 2. Set an anchor for each GT box (regardless of IoU value).
     # If multiple anchors have the same IoU match all of them
-    gt_iou_argmax = np.argwhere(overlaps == np.max(overlaps, axis=0))[:,0]
-    rpn_match[gt_iou_argmax] = 1
+    low_ix = []
+    for i in range(gt_boxes.shape[0]):
+        ix = anchor_ix[gt_starts[i]:gt_starts[i + 1]]
+        iou = pair_overlaps[gt_starts[i]:gt_starts[i + 1]]
+        if iou.shape[0] > 0 and iou.max() >= 0.3:
+            rpn_match[ix[iou == iou.max()]] = 1
+        else:
+            low_ix.append(i)
+    # GT boxes that no anchor overlaps with IoU >= 0.3: the closest anchors
+    # are among the ones that intersect them, or all anchors if none does.
+    if low_ix:
+        anchor_ix, gt_ix, pair_overlaps = utils.compute_candidate_overlaps(
+            anchors, gt_boxes[low_ix], index=anchor_index)
+        for i in range(len(low_ix)):
+            iou = pair_overlaps[gt_ix == i]
+            if iou.shape[0] > 0 and iou.max() > 0:
+                rpn_match[anchor_ix[gt_ix == i][iou == iou.max()]] = 1
+            else:
+                # All anchors tie at 0
+                rpn_match[:] = 1
     # 3. Set anchors with high overlap as positive.
     rpn_match[anchor_iou_max >= 0.7] = 1
 
@@ -1535,36 +1600,18 @@ def build_rpn_targets(image_shape, anchors, gt_class_ids, gt_boxes, config):
         rpn_match[ids] = 0
 
     # For positive anchors, compute shift and scale needed to transform them
-    # to match the corresponding GT boxes.
+    # to match the corresponding GT boxes (closest GT box, it might have
+    # IoU < 0.7). In float64 like anchors, then normalize.
     ids = np.where(rpn_match == 1)[0]
-    ix = 0  # index into rpn_bbox
-    # TODO: use box_refinement() rather than duplicating the code here
-    for i, a in zip(ids, anchors[ids]):
-        # Closest gt box (it might have IoU < 0.7)
-        gt = gt_boxes[anchor_iou_argmax[i]]
-
-        # Convert coordinates to center plus width/height.
-        # GT Box
-        gt_h = gt[2] - gt[0]
-        gt_w = gt[3] - gt[1]
-        gt_center_y = gt[0] + 0.5 * gt_h
-        gt_center_x = gt[1] + 0.5 * gt_w
-        # Anchor
-        a_h = a[2] - a[0]
-        a_w = a[3] - a[1]
-        a_center_y = a[0] + 0.5 * a_h
-        a_center_x = a[1] + 0.5 * a_w
-
-        # Compute the bbox refinement that the RPN should predict.
-        rpn_bbox[ix] = [
-            (gt_center_y - a_center_y) / a_h,
-            (gt_center_x - a_center_x) / a_w,
-            np.log(gt_h / a_h),
-            np.log(gt_w / a_w),
-        ]
-        # Normalize
-        rpn_bbox[ix] /= config.RPN_BBOX_STD_DEV
-        ix += 1
+    # Anchors matched to a GT box with IoU < 0.3 only: their closest GT box
+    # may be one the candidate overlaps skipped, compare with all of them.
+    low_ids = ids[anchor_iou_max[ids] < 0.3]
+    if low_ids.shape[0] > 0:
+        anchor_iou_argmax[low_ids] = np.argmax(
+            utils.compute_overlaps(anchors[low_ids], gt_boxes), axis=1)
+    rpn_bbox[:len(ids)] = utils.box_refinement(
+        anchors[ids], gt_boxes[anchor_iou_argmax[ids]],
+        dtype=np.float64) / config.RPN_BBOX_STD_DEV
 
     return rpn_match, rpn_bbox
 
@@ -1654,6 +1701,9 @@ class DataGenerator():
         augmentation: Optional. An imgaug (https://github.com/aleju/imgaug) augmentation.
             For example, passing imgaug.augmenters.Fliplr(0.5) flips images
             right/left 50% of the time.
+        flip: Probability of flipping images right/left. Unlike a Fliplr
+            augmentation, it's applied after loading the targets, so they
+            can still come from the TARGET_CACHE_DIR cache.
         random_rois: If > 0 then generate proposals to be used to train the
                      network classifier and mask heads. Useful if training
                      the Mask RCNN part without the RPN.
@@ -1681,7 +1731,7 @@ class DataGenerator():
         """
 
     def __init__(self, dataset, config, shuffle=True, augmentation=None,
-                 random_rois=0, detection_targets=False):
+                 random_rois=0, detection_targets=False, flip=0):
 
         self.image_ids = np.copy(dataset.image_ids)
         self.dataset = dataset
@@ -1695,9 +1745,19 @@ class DataGenerator():
                                                       self.backbone_shapes,
                                                       config.BACKBONE_STRIDES,
                                                       config.RPN_ANCHOR_STRIDE)
+        # Spatial index of the anchors, to match them with GT boxes
+        self.anchor_index = utils.BoxIndex(self.anchors)
+
+        # Training targets cached on disk, without augmentation only
+        self.target_cache = None
+        if (config.TARGET_CACHE_DIR and not augmentation and
+                config.IMAGE_RESIZE_MODE != "crop"):
+            self.target_cache = utils.TargetCache(config.TARGET_CACHE_DIR,
+                                                  config, dataset)
 
         self.shuffle = shuffle
         self.augmentation = augmentation
+        self.flip = flip
         self.random_rois = random_rois
         self.batch_size = self.config.BATCH_SIZE
         self.detection_targets = detection_targets
@@ -1706,6 +1766,52 @@ class DataGenerator():
     def __len__(self):
         return int(np.ceil(len(self.image_ids) / float(self.batch_size)))
 
+    def load_sample(self, image_id):
+        """Loads the training targets of one image.
+
+        Returns None if the image has no instances. Otherwise:
+        image, image_meta, rpn_match, rpn_bbox, gt_class_ids, gt_boxes and
+        gt_masks, sub-sampled to at most MAX_GT_INSTANCES instances.
+        """
+        # Get GT bounding boxes and masks for image.
+        image, image_meta, gt_class_ids, gt_boxes, gt_masks = \
+            load_image_gt(self.dataset, self.config, image_id,
+                          augmentation=self.augmentation,
+                          target_cache=self.target_cache)
+        if self.flip and np.random.random() < self.flip:
+            image, gt_boxes, gt_masks = flip_image_gt(image, gt_boxes, gt_masks)
+
+        # Skip images that have no instances. This can happen in cases
+        # where we train on a subset of classes and the image doesn't
+        # have any of the classes we care about.
+        if not np.any(gt_class_ids > 0):
+            return None
+
+        # RPN Targets
+        rpn_match, rpn_bbox = build_rpn_targets(image.shape, self.anchors,
+                                                gt_class_ids, gt_boxes, self.config,
+                                                anchor_index=self.anchor_index)
+
+        # Mask R-CNN Targets
+        if self.random_rois:
+            rpn_rois = generate_random_rois(
+                image.shape, self.random_rois, gt_class_ids, gt_boxes)
+            if self.detection_targets:
+                rois, mrcnn_class_ids, mrcnn_bbox, mrcnn_mask = \
+                    build_detection_targets(
+                        rpn_rois, gt_class_ids, gt_boxes, gt_masks, self.config)
+
+        # If more instances than fits in the array, sub-sample from them.
+        if gt_boxes.shape[0] > self.config.MAX_GT_INSTANCES:
+            ids = np.random.choice(
+                np.arange(gt_boxes.shape[0]), self.config.MAX_GT_INSTANCES, replace=False)
+            gt_class_ids = gt_class_ids[ids]
+            gt_boxes = gt_boxes[ids]
+            gt_masks = gt_masks[:, :, ids]
+
+        return (image, image_meta, rpn_match, rpn_bbox,
+                gt_class_ids, gt_boxes, gt_masks)
+
     def __getitem__(self, idx):
         b = 0
         image_index = idx * self.batch_size - 1
@@ -1716,30 +1822,10 @@ class DataGenerator():
             if self.shuffle and image_index == 0:
                 np.random.shuffle(self.image_ids)
 
-            # Get GT bounding boxes and masks for image.
-            image_id = self.image_ids[image_index]
-            image, image_meta, gt_class_ids, gt_boxes, gt_masks = \
-                load_image_gt(self.dataset, self.config, image_id,
-                              augmentation=self.augmentation)
-
-            # Skip images that have no instances. This can happen in cases
-            # where we train on a subset of classes and the image doesn't
-            # have any of the classes we care about.
-            if not np.any(gt_class_ids > 0):
+            sample = self.load_sample(self.image_ids[image_index])
+            if sample is None:
                 continue
-
-            # RPN Targets
-            rpn_match, rpn_bbox = build_rpn_targets(image.shape, self.anchors,
-                                                    gt_class_ids, gt_boxes, self.config)
-
-            # Mask R-CNN Targets
-            if self.random_rois:
-                rpn_rois = generate_random_rois(
-                    image.shape, self.random_rois, gt_class_ids, gt_boxes)
-                if self.detection_targets:
-                    rois, mrcnn_class_ids, mrcnn_bbox, mrcnn_mask = \
-                        build_detection_targets(
-                            rpn_rois, gt_class_ids, gt_boxes, gt_masks, self.config)
+            image, image_meta, rpn_match, rpn_bbox, gt_class_ids, gt_boxes, gt_masks = sample
 
             # Init batch arrays
             if b == 0:
@@ -1759,14 +1845,6 @@ class DataGenerator():
                     (self.batch_size, gt_masks.shape[0], gt_masks.shape[1],
                      self.config.MAX_GT_INSTANCES), dtype=gt_masks.dtype)
 
-            # If more instances than fits in the array, sub-sample from them.
-            if gt_boxes.shape[0] > self.config.MAX_GT_INSTANCES:
-                ids = np.random.choice(
-                    np.arange(gt_boxes.shape[0]), self.config.MAX_GT_INSTANCES, replace=False)
-                gt_class_ids = gt_class_ids[ids]
-                gt_boxes = gt_boxes[ids]
-                gt_masks = gt_masks[:, :, ids]
-
             # Add to batch
             batch_image_meta[b] = image_meta
             batch_rpn_match[b] = rpn_match[:, np.newaxis]
@@ -1792,6 +1870,272 @@ class DataGenerator():
     def __next__(self):
         self.idx += 1
         return self[self.idx]
+
+
+def default_data_workers():
+    """Number of data workers for DATA_WORKERS = None: one per CPU but one,
+    left to the training process, and no more than 8.
+    """
+    return max(1, min(multiprocessing.cpu_count() - 1, 8))
+
+
+def _data_worker(generator, slots, tasks, results, seed):
+    """Process loop of ParallelDataGenerator. Builds the images it's sent
+    into rows of the shared memory slots and replies with their status
+    only, so that no array goes through the queues.
+    """
+    # Forked workers start with the RNG states of the parent
+    np.random.seed(seed)
+    random.seed(seed)
+    if generator.augmentation is not None:
+        import imgaug
+        imgaug.seed(seed)
+    while True:
+        task = tasks.get()
+        if task is None:
+            break
+        slot, row, image_id = task
+        try:
+            sample = generator.load_sample(image_id)
+            if sample is None:
+                results.put((slot, row, False))
+                continue
+            image, image_meta, rpn_match, rpn_bbox, gt_class_ids, gt_boxes, gt_masks = sample
+            images, batch_image_meta, batch_rpn_match, batch_rpn_bbox, \
+                batch_gt_class_ids, batch_gt_boxes, batch_gt_masks = slots[slot]
+            batch_image_meta[row] = image_meta
+            batch_rpn_match[row] = rpn_match[:, np.newaxis]
+            batch_rpn_bbox[row] = rpn_bbox
+            images[row] = mold_image(image.astype(np.float32), generator.config)
+            # Slots are reused, clear the instances of the previous batch
+            count = gt_class_ids.shape[0]
+            batch_gt_class_ids[row, :count] = gt_class_ids
+            batch_gt_class_ids[row, count:] = 0
+            batch_gt_boxes[row, :count] = gt_boxes
+            batch_gt_boxes[row, count:] = 0
+            batch_gt_masks[row, :, :, :count] = gt_masks
+            batch_gt_masks[row, :, :, count:] = False
+            results.put((slot, row, True))
+        except Exception:
+            results.put((slot, row, traceback.format_exc()))
+
+
+class ParallelDataGenerator(object):
+    """A DataGenerator that builds batches in a pool of worker processes.
+
+    Workers run load_image_gt(), build_rpn_targets() and mold_image() for one
+    image at a time and write the results straight into a ring of shared
+    memory batch slots. Only slot and image indices go through the queues,
+    so the large arrays are never pickled. The training process picks the
+    images of every epoch, like DataGenerator, and copies finished batches
+    out of the ring for tf.data.
+
+    Batches have a fixed shape, so this only supports the "square" and "crop"
+    resize modes, and neither random_rois nor detection_targets.
+
+    dataset, config, shuffle, augmentation, flip: As in DataGenerator
+    workers: Number of worker processes, default_data_workers() if None
+    queue_size: Number of batch slots in the ring. Workers build up to
+        queue_size - 1 batches ahead of the one being trained on.
+    log_steps: Log the batches per second every this many batches. 0
+        disables it.
+
+    Call close() to stop the workers and free the shared memory.
+    """
+
+    def __init__(self, dataset, config, shuffle=True, augmentation=None,
+                 workers=None, queue_size=None, log_steps=0, flip=0):
+        assert self.supports(config), \
+            "Batches of IMAGE_RESIZE_MODE {} change shape".format(config.IMAGE_RESIZE_MODE)
+        self.generator = DataGenerator(dataset, config, shuffle=False,
+                                       augmentation=augmentation, flip=flip)
+        self.image_ids = np.copy(dataset.image_ids)
+        self.config = config
+        self.shuffle = shuffle
+        self.batch_size = config.BATCH_SIZE
+        self.workers = workers or default_data_workers()
+        # One slot being trained on, one being filled per batch_size workers
+        # and one more so that a finished batch is always waiting.
+        self.queue_size = queue_size or \
+            2 + int(np.ceil(self.workers / float(self.batch_size)))
+        assert self.queue_size >= 2, "At least 2 slots are needed"
+        self.log_steps = log_steps
+
+        # Shape and dtype of each input, as DataGenerator returns them, but
+        # with boolean masks. They're cast to float32 when copied out.
+        if config.USE_MINI_MASK:
+            mask_shape = tuple(config.MINI_MASK_SHAPE)
+        else:
+            mask_shape = tuple(config.IMAGE_SHAPE[:2])
+        B = self.batch_size
+        self.layout = [
+            ((B,) + tuple(config.IMAGE_SHAPE), np.float32),
+            ((B, config.IMAGE_META_SIZE), np.float64),
+            ((B, self.generator.anchors.shape[0], 1), np.int32),
+            ((B, config.RPN_TRAIN_ANCHORS_PER_IMAGE, 4), np.float64),
+            ((B, config.MAX_GT_INSTANCES), np.int32),
+            ((B, config.MAX_GT_INSTANCES, 4), np.int32),
+            ((B,) + mask_shape + (config.MAX_GT_INSTANCES,), np.bool_),
+        ]
+        self.image_index = -1
+        self.processes = []
+
+    @staticmethod
+    def supports(config):
+        """True if batches built with this config all have the same shape."""
+        return config.IMAGE_RESIZE_MODE in ["square", "crop"]
+
+    def __len__(self):
+        return int(np.ceil(len(self.image_ids) / float(self.batch_size)))
+
+    def __iter__(self):
+        return self
+
+    def __call__(self):
+        return self
+
+    def start(self):
+        """Allocates the ring of batch slots and forks the workers. Call it
+        from the main thread before training, it's otherwise called by the
+        first batch request, from a tf.data thread. The workers never call
+        TensorFlow, which isn't safe to use after a fork.
+        """
+        if self.processes:
+            return
+        sizes = [int(np.prod(shape)) * np.dtype(dtype).itemsize
+                 for shape, dtype in self.layout]
+        self.fit_queue_size(sum(sizes))
+        self.memory = []
+        self.slots = []
+        for _ in range(self.queue_size):
+            memory = shared_memory.SharedMemory(create=True, size=sum(sizes))
+            arrays = []
+            offset = 0
+            for (shape, dtype), size in zip(self.layout, sizes):
+                arrays.append(np.ndarray(shape, dtype=dtype, buffer=memory.buf,
+                                         offset=offset))
+                offset += size
+            self.memory.append(memory)
+            self.slots.append(arrays)
+
+        # Workers inherit the slots mapped above and the dataset, so that
+        # nothing large is pickled.
+        mp_context = multiprocessing.get_context("fork")
+        self.tasks = mp_context.Queue()
+        self.results = mp_context.Queue()
+        seed = np.random.randint(2**31 - self.workers)
+        for i in range(self.workers):
+            process = mp_context.Process(
+                target=_data_worker, daemon=True,
+                args=(self.generator, self.slots, self.tasks, self.results, seed + i))
+            process.start()
+            self.processes.append(process)
+
+        # Slots are filled in order, and handed out in the same order
+        self.pending = collections.deque()
+        self.remaining = [0] * self.queue_size
+        for slot in range(self.queue_size):
+            self.schedule(slot)
+
+        self.batches = 0
+        self.wait_time = 0
+        self.log_time = time.perf_counter()
+
+    def fit_queue_size(self, slot_size):
+        """Shrinks queue_size to the slots that fit in /dev/shm, which backs
+        shared memory on Linux. Containers get 64 MB there unless a memory
+        volume is mounted, and a worker writing past it dies of SIGBUS
+        instead of failing to allocate.
+        """
+        if not os.path.isdir("/dev/shm"):
+            return
+        free = shutil.disk_usage("/dev/shm").free
+        if free >= slot_size * self.queue_size:
+            return
+        if free < slot_size * 2:
+            raise RuntimeError(
+                "/dev/shm has {:.0f} MB free, the data workers need at least {:.0f} MB "
+                "for 2 batch slots. Mount a larger memory volume at /dev/shm or lower "
+                "BATCH_SIZE.".format(free / 2**20, slot_size * 2 / 2**20))
+        queue_size = int(free // slot_size)
+        print("/dev/shm has {:.0f} MB free, shrinking the data queue from {} to {} batch slots".format(
+            free / 2**20, self.queue_size, queue_size))
+        self.queue_size = queue_size
+
+    def next_image_id(self):
+        # Increment index to pick next image. Shuffle if at the start of an epoch.
+        self.image_index = (self.image_index + 1) % len(self.image_ids)
+        if self.shuffle and self.image_index == 0:
+            np.random.shuffle(self.image_ids)
+        return self.image_ids[self.image_index]
+
+    def schedule(self, slot):
+        """Sends the images of the next batch to the workers."""
+        for row in range(self.batch_size):
+            self.tasks.put((slot, row, self.next_image_id()))
+        self.remaining[slot] = self.batch_size
+        self.pending.append(slot)
+
+    def wait(self, slot):
+        """Collects worker replies until the given slot is filled."""
+        while self.remaining[slot] > 0:
+            try:
+                done, row, status = self.results.get(timeout=10)
+            except queue.Empty:
+                dead = [p.exitcode for p in self.processes if not p.is_alive()]
+                if dead:
+                    raise RuntimeError(
+                        "Data worker exited with code {}".format(dead[0]))
+                continue
+            if status is True:
+                self.remaining[done] -= 1
+            elif status is False:
+                # No instances in that image, try the next one
+                self.tasks.put((done, row, self.next_image_id()))
+            else:
+                raise RuntimeError("Data worker failed:\n" + status)
+
+    def __next__(self):
+        self.start()
+        start = time.perf_counter()
+        slot = self.pending.popleft()
+        self.wait(slot)
+        self.wait_time += time.perf_counter() - start
+
+        # tf.data may keep a reference to the arrays it's given, so copy the
+        # batch out before the slot is filled again.
+        inputs = [np.array(array, dtype=np.float32 if dtype == np.bool_ else dtype)
+                  for array, (_, dtype) in zip(self.slots[slot], self.layout)]
+        self.schedule(slot)
+
+        self.batches += 1
+        if self.log_steps and self.batches % self.log_steps == 0:
+            now = time.perf_counter()
+            elapsed = now - self.log_time
+            log("Data pipeline: {:.2f} batches/s, waited for workers {:.0f}% of the time".format(
+                self.log_steps / elapsed, 100 * self.wait_time / elapsed))
+            self.log_time = now
+            self.wait_time = 0
+        return (tuple(inputs), 1.1)
+
+    def close(self):
+        """Stops the workers and frees the shared memory."""
+        if not self.processes:
+            return
+        for process in self.processes:
+            process.terminate()
+        for process in self.processes:
+            process.join()
+        self.processes = []
+        # Workers were terminated, don't wait on the tasks they left behind
+        for q in (self.tasks, self.results):
+            q.cancel_join_thread()
+            q.close()
+        self.slots = []
+        for memory in self.memory:
+            memory.close()
+            memory.unlink()
+        self.memory = []
         
 
 
@@ -2256,9 +2600,11 @@ class MaskRCNN(object):
             "*epoch*", "{epoch:04d}")
 
     def train(self, train_dataset, val_dataset, learning_rate, epochs, layers,
-              augmentation=None, custom_callbacks=None, no_augmentation_sources=None):
+              augmentation=None, custom_callbacks=None, no_augmentation_sources=None,
+              flip=0):
         """Train the model.
-        train_dataset, val_dataset: Training and validation Dataset objects.
+        train_dataset, val_dataset: Training and validation Dataset objects, or
+            tf.data.Datasets of batches, see tfrecord_data.build_dataset().
         learning_rate: The learning rate to train with
         epochs: Number of training epochs. Note that previous training epochs
                 are considered to be done alreay, so this actually determines
@@ -2288,6 +2634,9 @@ class MaskRCNN(object):
         no_augmentation_sources: Optional. List of sources to exclude for
             augmentation. A source is string that identifies a dataset and is
             defined in the Dataset class.
+        flip: Probability of flipping training images right/left, see
+            DataGenerator. Unlike augmentation, it keeps TARGET_CACHE_DIR
+            in use.
         """
         assert self.mode == "training", "Create model in training mode."
         layer_id = layers
@@ -2340,10 +2689,38 @@ class MaskRCNN(object):
             tf.TensorShape([None, None, None, None]),
         ), tf.TensorShape([]))
 
-        train_generator = tf.data.Dataset.from_generator(DataGenerator(train_dataset, self.config, shuffle=True,
-                                         augmentation=augmentation), output_types=data_spec, output_shapes=data_shapes)
-        if len(DataGenerator(val_dataset, self.config)) > 0 :
+        # Data workers are forked, which Windows doesn't support
+        if os.name == 'nt':
+            workers = 0
+        elif self.config.DATA_WORKERS is None:
+            workers = default_data_workers()
+        else:
+            workers = self.config.DATA_WORKERS
+
+        train_data = None
+        if isinstance(train_dataset, tf.data.Dataset):
+            # Already batched, e.g. by tfrecord_data.build_dataset()
+            assert augmentation is None and not flip, "Augment tf.data inputs in their pipeline"
+            train_generator = train_dataset
+        else:
+            if workers > 0 and ParallelDataGenerator.supports(self.config):
+                train_data = ParallelDataGenerator(train_dataset, self.config, shuffle=True,
+                                                   augmentation=augmentation, workers=workers,
+                                                   queue_size=self.config.DATA_QUEUE_SIZE,
+                                                   log_steps=self.config.DATA_LOG_STEPS,
+                                                   flip=flip)
+            else:
+                train_data = DataGenerator(train_dataset, self.config, shuffle=True,
+                                           augmentation=augmentation, flip=flip)
+            train_generator = tf.data.Dataset.from_generator(train_data, output_types=data_spec, output_shapes=data_shapes)
+            # Copy the next batch out of the generator while training on this one
+            train_generator = train_generator.prefetch(1)
+        if isinstance(val_dataset, tf.data.Dataset):
+            val_generator = val_dataset
+        elif len(DataGenerator(val_dataset, self.config)) > 0 :
             val_generator = tf.data.Dataset.from_generator(DataGenerator(val_dataset, self.config, shuffle=True), output_types=data_spec, output_shapes=data_shapes)
+        elif isinstance(train_dataset, tf.data.Dataset):
+            val_generator = train_dataset
         else:
             val_generator = tf.data.Dataset.from_generator(DataGenerator(train_dataset, self.config, shuffle=True), output_types=data_spec, output_shapes=data_shapes)
 
@@ -2383,27 +2760,25 @@ class MaskRCNN(object):
         self.set_trainable(layers)
         self.compile(learning_rate, self.config.LEARNING_MOMENTUM)
 
-        # Work-around for Windows: Keras fails on Windows when using
-        # multiprocessing workers. See discussion here:
-        # https://github.com/matterport/Mask_RCNN/issues/13#issuecomment-353124009
-        if os.name == 'nt':
-            workers = 0
-        else:
-            workers = multiprocessing.cpu_count()
-
-        self.keras_model.fit(
-            train_generator,
-            initial_epoch=self.epoch,
-            epochs=epochs,
-            steps_per_epoch=self.config.STEPS_PER_EPOCH,
-            callbacks=callbacks,
-            validation_data=val_generator,
-            validation_steps=self.config.VALIDATION_STEPS,
-            max_queue_size=100,
-            workers=workers,
-            use_multiprocessing=True,
-            verbose=0
-        )
+        # Keras ignores its workers for tf.data inputs, the training batches
+        # come from the ParallelDataGenerator workers instead.
+        try:
+            if isinstance(train_data, ParallelDataGenerator):
+                # Fork from this thread rather than a tf.data one
+                train_data.start()
+            self.keras_model.fit(
+                train_generator,
+                initial_epoch=self.epoch,
+                epochs=epochs,
+                steps_per_epoch=self.config.STEPS_PER_EPOCH,
+                callbacks=callbacks,
+                validation_data=val_generator,
+                validation_steps=self.config.VALIDATION_STEPS,
+                verbose=0
+            )
+        finally:
+            if isinstance(train_data, ParallelDataGenerator):
+                train_data.close()
         self.epoch = max(self.epoch, epochs)
 
     def mold_inputs(self, images):
@@ -0,0 +1,399 @@
+"""
+Mask R-CNN
+Training input pipeline that reads the TFRecords written by
+create_coco_tf_record.py (albumentations-preprocessing workflow).
+
+Every step runs in tf.data map stages, so batches are built without Python
+in the training loop. The records must hold the instance masks, which
+create_coco_tf_record.py only writes with --include_masks (main.py
+--include_masks in the preprocessing workflow).
+
+Usage:
+
+    train_data = tfrecord_data.build_dataset(
+        "/data/tfrecord/train.tfrecord-*", config,
+        tfrecord_data.class_map(dataset_train),
+        tfrecord_data.image_map(dataset_train), flip=0.5)
+    model.train(train_data, dataset_val, ...)
+
+Licensed under the MIT License (see LICENSE for details)
+"""
+
+import numpy as np
+import tensorflow as tf
+
+from mrcnn import utils
+from mrcnn import model as modellib
+
+AUTOTUNE = tf.data.experimental.AUTOTUNE
+
+# Images whose training targets are built at once. Each holds the IoUs of
+# all the anchors with all its instances, hundreds of MB for large images
+# with many instances, too many to run one per CPU.
+TARGET_PARALLEL_CALLS = 2
+
+FEATURES = {
+    "image/encoded": tf.io.FixedLenFeature([], tf.string),
+    "image/source_id": tf.io.FixedLenFeature([], tf.string),
+    "image/object/class/label": tf.io.VarLenFeature(tf.int64),
+    "image/object/is_crowd": tf.io.VarLenFeature(tf.int64),
+    "image/object/mask": tf.io.VarLenFeature(tf.string),
+}
+
+
+def class_map(dataset):
+    """Maps the category IDs stored in the records to the class IDs of a
+    prepared Dataset, as OnepanelDataset.load_mask() does.
+
+    Returns: dict of {category ID: class ID}, without the background.
+    """
+    return {info["id"]: class_id
+            for class_id, info in enumerate(dataset.class_info) if class_id > 0}
+
+
+def image_map(dataset):
+    """Maps the COCO image IDs stored in the records as source IDs to the
+    image IDs of a prepared Dataset, which DataGenerator puts in image_meta.
+
+    Returns: dict of {COCO image ID: image ID}.
+    """
+    return {info["id"]: image_id
+            for image_id, info in enumerate(dataset.image_info)}
+
+
+def check_masks(file_pattern):
+    """Raises ValueError unless the first record matching file_pattern holds
+    instance masks, rather than failing once training has started.
+    """
+    files = sorted(tf.io.gfile.glob(file_pattern))
+    if not files:
+        raise ValueError("No TFRecords match {}".format(file_pattern))
+    # model.py disables eager execution, so no tf.data iteration here
+    for serialized in tf.compat.v1.io.tf_record_iterator(files[0]):
+        example = tf.train.Example.FromString(serialized)
+        if "image/object/mask" not in example.features.feature:
+            raise ValueError(
+                "{} has no instance masks, write the TFRecords with "
+                "--include_masks".format(files[0]))
+        break
+
+
+############################################################
+#  Pipeline Stages
+############################################################
+
+def decode_example(serialized, class_table, image_table):
+    """Parses a record and decodes its image.
+
+    class_table: [max category ID + 1] class ID of every category ID.
+        Instances of other categories get class ID 0 and are dropped later,
+        crowds get negative class IDs.
+    image_table: ([N] sorted COCO image IDs, [N] their image IDs), ending
+        with a -1 entry. Images missing from the Dataset get image ID -1.
+    """
+    features = tf.io.parse_single_example(serialized, FEATURES)
+    labels = tf.sparse.to_dense(features["image/object/class/label"])
+    is_crowd = tf.sparse.to_dense(features["image/object/is_crowd"])
+    max_label = class_table.shape[0] - 1
+    class_ids = tf.gather(class_table, tf.clip_by_value(labels, 0, max_label))
+    class_ids = tf.where(labels > max_label, tf.zeros_like(class_ids), class_ids)
+    class_ids = tf.where(is_crowd > 0, -class_ids, class_ids)
+    # The accurate DCT decodes JPEGs to the same pixels as Dataset.load_image()
+    encoded = features["image/encoded"]
+    image = tf.cond(
+        tf.io.is_jpeg(encoded),
+        lambda: tf.io.decode_jpeg(encoded, channels=3, dct_method="INTEGER_ACCURATE"),
+        lambda: tf.io.decode_image(encoded, channels=3, expand_animations=False))
+    return {
+        "image_id": lookup_image_id(
+            image_table, tf.strings.to_number(features["image/source_id"], tf.int64)),
+        "image": image,
+        "class_ids": class_ids,
+        "masks": tf.sparse.to_dense(features["image/object/mask"]),
+    }
+
+
+def lookup_image_id(image_table, source_id):
+    """Image ID of a COCO image ID as float64, see decode_example(). Sorted
+    constants rather than a tf.lookup table, which is stateful and can't be
+    captured by the datasets of graph mode.
+    """
+    coco_ids, image_ids = image_table
+    i = tf.minimum(tf.searchsorted(coco_ids, [source_id])[0], tf.size(coco_ids) - 1)
+    image_id = tf.where(tf.equal(coco_ids[i], source_id), image_ids[i], -1)
+    return tf.cast(image_id, tf.float64)
+
+
+def rasterize_masks(example):
+    """Decodes the PNG instance masks into [height, width, instances] bool."""
+    class_ids = example["class_ids"]
+    encoded = example["masks"]
+    assert_masks = tf.debugging.assert_equal(
+        tf.size(encoded), tf.size(class_ids),
+        message="Records need instance masks, write them with --include_masks")
+    with tf.control_dependencies([assert_masks]):
+        keep = tf.where(tf.not_equal(class_ids, 0))[:, 0]
+    masks = tf.map_fn(lambda png: tf.io.decode_png(png, channels=1)[:, :, 0],
+                      tf.gather(encoded, keep), fn_output_signature=tf.uint8)
+    example = dict(example)
+    example["class_ids"] = tf.gather(class_ids, keep)
+    example["masks"] = tf.transpose(masks, [1, 2, 0]) > 0
+    return example
+
+
+def resize_example(example, config, flip):
+    """Resizes and pads the image and masks like utils.resize_image() and
+    utils.resize_mask() in "square" mode, then flips them left/right with
+    probability flip. Drops the instances left without mask pixels.
+    """
+    image = example["image"]
+    masks = example["masks"]
+    shape = tf.shape(image)
+    h = tf.cast(shape[0], tf.float64)
+    w = tf.cast(shape[1], tf.float64)
+
+    # Scale up but not down, and not past the max dim
+    scale = tf.constant(1, tf.float64)
+    if config.IMAGE_MIN_DIM:
+        scale = tf.maximum(scale, config.IMAGE_MIN_DIM / tf.minimum(h, w))
+    if config.IMAGE_MIN_SCALE:
+        scale = tf.maximum(scale, config.IMAGE_MIN_SCALE)
+    image_max = tf.maximum(h, w)
+    scale = tf.where(tf.round(image_max * scale) > config.IMAGE_MAX_DIM,
+                     config.IMAGE_MAX_DIM / image_max, scale)
+    size = tf.cast(tf.round(tf.stack([h, w]) * scale), tf.int32)
+
+    # Bilinear for the image, truncated back to uint8 values, nearest for masks
+    image = tf.cast(tf.cast(tf.image.resize(image, size), tf.uint8), tf.float32)
+    masks = tf.image.resize(tf.cast(masks, tf.uint8), size, method="nearest")
+
+    # Pad to a square of max dim
+    max_dim = config.IMAGE_MAX_DIM
+    top_pad = (max_dim - size[0]) // 2
+    left_pad = (max_dim - size[1]) // 2
+    image = tf.image.pad_to_bounding_box(image, top_pad, left_pad, max_dim, max_dim)
+    masks = tf.image.pad_to_bounding_box(masks, top_pad, left_pad, max_dim, max_dim)
+    window = tf.stack([top_pad, left_pad, size[0] + top_pad, size[1] + left_pad])
+
+    if flip:
+        flipped = tf.random.uniform([]) < flip
+        image = tf.cond(flipped, lambda: tf.image.flip_left_right(image), lambda: image)
+        masks = tf.cond(flipped, lambda: tf.image.flip_left_right(masks), lambda: masks)
+
+    # Some instances can be too small to survive the resizing
+    keep = tf.where(tf.reduce_any(masks > 0, axis=[0, 1]))[:, 0]
+    example = dict(example)
+    example.update({
+        "image": image,
+        "masks": tf.gather(masks, keep, axis=2) > 0,
+        "class_ids": tf.gather(example["class_ids"], keep),
+        "original_shape": shape,
+        "window": window,
+        "scale": scale,
+    })
+    return example
+
+
+def has_instances(example):
+    """Images without instances are skipped, as in DataGenerator."""
+    return tf.reduce_any(example["class_ids"] > 0)
+
+
+def extract_bboxes_graph(masks):
+    """utils.extract_bboxes() of non empty masks [height, width, instances].
+
+    Returns: [instances, (y1, x1, y2, x2)] int32, with y2 and x2 outside.
+    """
+    rows = tf.cast(tf.reduce_any(masks, axis=1), tf.int32)
+    cols = tf.cast(tf.reduce_any(masks, axis=0), tf.int32)
+    height = tf.shape(rows, out_type=tf.int64)[0]
+    width = tf.shape(cols, out_type=tf.int64)[0]
+    y1 = tf.argmax(rows, axis=0)
+    x1 = tf.argmax(cols, axis=0)
+    y2 = height - tf.argmax(tf.reverse(rows, [0]), axis=0)
+    x2 = width - tf.argmax(tf.reverse(cols, [0]), axis=0)
+    return tf.cast(tf.stack([y1, x1, y2, x2], axis=1), tf.int32)
+
+
+def minimize_masks_graph(boxes, masks, mini_shape):
+    """utils.minimize_mask(): crops every mask to its box and resizes it to
+    mini_shape with bilinear interpolation.
+    """
+    def minimize(i):
+        y1, x1, y2, x2 = tf.unstack(boxes[i])
+        m = tf.cast(masks[y1:y2, x1:x2, i:i + 1], tf.float32)
+        return tf.image.resize(m, mini_shape)[:, :, 0] >= 0.5
+    mini_masks = tf.map_fn(minimize, tf.range(tf.shape(boxes)[0]),
+                           fn_output_signature=tf.bool)
+    return tf.transpose(mini_masks, [1, 2, 0])
+
+
+def overlaps_graph(boxes1, boxes2):
+    """utils.compute_overlaps() of [N1, 4] and [N2, 4] boxes, broadcasting
+    instead of tiling, since boxes1 are all the anchors.
+    """
+    b1 = tf.expand_dims(boxes1, 1)
+    y1 = tf.maximum(b1[..., 0], boxes2[:, 0])
+    x1 = tf.maximum(b1[..., 1], boxes2[:, 1])
+    y2 = tf.minimum(b1[..., 2], boxes2[:, 2])
+    x2 = tf.minimum(b1[..., 3], boxes2[:, 3])
+    intersection = tf.maximum(y2 - y1, 0) * tf.maximum(x2 - x1, 0)
+    area1 = (boxes1[:, 2] - boxes1[:, 0]) * (boxes1[:, 3] - boxes1[:, 1])
+    area2 = (boxes2[:, 2] - boxes2[:, 0]) * (boxes2[:, 3] - boxes2[:, 1])
+    union = tf.expand_dims(area1, 1) + area2 - intersection
+    return intersection / union
+
+
+def build_rpn_targets_graph(anchors, gt_class_ids, gt_boxes, config):
+    """modellib.build_rpn_targets() for one image, with the same matching
+    rules and random subsampling.
+
+    anchors: [num_anchors, (y1, x1, y2, x2)] float32
+    gt_class_ids: [num_gt_boxes] Integer class IDs, negative for crowds.
+    gt_boxes: [num_gt_boxes, (y1, x1, y2, x2)]
+
+    Returns:
+    rpn_match: [N] (int32) matches between anchors and GT boxes.
+               1 = positive anchor, -1 = negative anchor, 0 = neutral
+    rpn_bbox: [RPN_TRAIN_ANCHORS_PER_IMAGE, (dy, dx, log(dh), log(dw))] Anchor bbox deltas.
+    """
+    gt_boxes = tf.cast(gt_boxes, tf.float32)
+    crowd_boxes = tf.boolean_mask(gt_boxes, gt_class_ids < 0)
+    gt_boxes = tf.boolean_mask(gt_boxes, gt_class_ids > 0)
+
+    # Anchors that overlap crowds are neither positive nor negative. Without
+    # crowds the max is -inf.
+    crowd_iou_max = tf.reduce_max(overlaps_graph(anchors, crowd_boxes), axis=1)
+    no_crowd_bool = crowd_iou_max < 0.001
+
+    # Match anchors to GT boxes
+    overlaps = overlaps_graph(anchors, gt_boxes)
+    anchor_iou_argmax = tf.argmax(overlaps, axis=1)
+    anchor_iou_max = tf.reduce_max(overlaps, axis=1)
+    # 1. Negative anchors first, so they get overwritten by positives.
+    # 2. Anchors with the highest IoU of each GT box, ties included.
+    # 3. Anchors with IoU >= 0.7.
+    gt_iou_max = tf.reduce_max(overlaps, axis=0)
+    best_anchor = tf.reduce_any(tf.equal(overlaps, gt_iou_max), axis=1)
+    rpn_match = tf.where((anchor_iou_max < 0.3) & no_crowd_bool, -1, 0)
+    rpn_match = tf.where(best_anchor | (anchor_iou_max >= 0.7), 1, rpn_match)
+
+    # Subsample to balance positive and negative anchors, positives up to
+    # half of the anchors per image.
+    def subsample(rpn_match, value, limit):
+        ids = tf.where(tf.equal(rpn_match, value))
+        extra = tf.maximum(tf.shape(ids)[0] - limit, 0)
+        ids = tf.random.shuffle(ids)[:extra]
+        return tf.tensor_scatter_nd_update(rpn_match, ids, tf.zeros([extra], tf.int32))
+    rpn_match = subsample(rpn_match, 1, config.RPN_TRAIN_ANCHORS_PER_IMAGE // 2)
+    num_positive = tf.reduce_sum(tf.cast(tf.equal(rpn_match, 1), tf.int32))
+    rpn_match = subsample(rpn_match, -1,
+                          config.RPN_TRAIN_ANCHORS_PER_IMAGE - num_positive)
+
+    # Deltas of the positive anchors, in anchor order, zero padded
+    ids = tf.where(tf.equal(rpn_match, 1))[:, 0]
+    deltas = utils.box_refinement_graph(
+        tf.gather(anchors, ids),
+        tf.gather(gt_boxes, tf.gather(anchor_iou_argmax, ids)))
+    deltas /= config.RPN_BBOX_STD_DEV
+    rpn_bbox = tf.pad(deltas, [[0, config.RPN_TRAIN_ANCHORS_PER_IMAGE - tf.shape(ids)[0]],
+                               [0, 0]])
+    return rpn_match, rpn_bbox
+
+
+def build_targets(example, config, anchors, active_class_ids):
+    """Builds the inputs of the training model for one image, as
+    DataGenerator does, with the same dtypes.
+    """
+    masks = example["masks"]
+    class_ids = tf.cast(example["class_ids"], tf.int32)
+    boxes = extract_bboxes_graph(masks)
+    if config.USE_MINI_MASK:
+        masks = minimize_masks_graph(boxes, masks, config.MINI_MASK_SHAPE)
+
+    rpn_match, rpn_bbox = build_rpn_targets_graph(anchors, class_ids, boxes, config)
+
+    # If more instances than fits in the array, sub-sample from them.
+    ids = tf.random.shuffle(tf.range(tf.shape(class_ids)[0]))[:config.MAX_GT_INSTANCES]
+    ids = tf.sort(ids)
+    class_ids = tf.gather(class_ids, ids)
+    boxes = tf.gather(boxes, ids)
+    masks = tf.gather(masks, ids, axis=2)
+    padding = config.MAX_GT_INSTANCES - tf.shape(ids)[0]
+
+    image_meta = tf.concat([
+        [example["image_id"]],
+        tf.cast(example["original_shape"], tf.float64),
+        tf.constant(config.IMAGE_SHAPE, tf.float64),
+        tf.cast(example["window"], tf.float64),
+        [example["scale"]],
+        tf.constant(active_class_ids, tf.float64),
+    ], axis=0)
+    image = example["image"] - tf.constant(config.MEAN_PIXEL, tf.float32)
+    return (image,
+            image_meta,
+            tf.expand_dims(rpn_match, 1),
+            tf.cast(rpn_bbox, tf.float64),
+            tf.pad(class_ids, [[0, padding]]),
+            tf.pad(boxes, [[0, padding], [0, 0]]),
+            tf.pad(tf.cast(masks, tf.float32), [[0, 0], [0, 0], [0, padding]]))
+
+
+############################################################
+#  Dataset
+############################################################
+
+def build_dataset(file_pattern, config, class_map, image_map, shuffle=True,
+                  flip=0, shuffle_buffer=256):
+    """Builds the training batches of MaskRCNN.train() from TFRecords.
+
+    file_pattern: Glob of the TFRecord shards, e.g. "tfrecord/train.tfrecord-*"
+    config: The model config object. Only the "square" resize mode is
+        supported, as batches need a fixed shape.
+    class_map: dict of {category ID: class ID}, see class_map()
+    image_map: dict of {COCO image ID: image ID}, see image_map(). image_meta
+        holds the image ID, as with DataGenerator.
+    shuffle: If True, shuffles the shards and the records
+    flip: Probability of flipping images left/right, in place of the
+        imgaug Fliplr augmentation.
+    shuffle_buffer: Number of records to shuffle at once
+
+    Returns: A repeated tf.data.Dataset of (inputs, 1.1), the inputs as
+    DataGenerator returns them.
+    """
+    assert config.IMAGE_RESIZE_MODE == "square", \
+        "TFRecord input needs IMAGE_RESIZE_MODE square"
+    check_masks(file_pattern)
+    class_table = np.zeros([max(class_map) + 1], dtype=np.int64)
+    class_table[list(class_map.keys())] = list(class_map.values())
+    coco_ids = sorted(image_map)
+    image_table = (tf.constant(coco_ids + [np.iinfo(np.int64).max], tf.int64),
+                   tf.constant([image_map[i] for i in coco_ids] + [-1], tf.int64))
+    active_class_ids = np.zeros([config.NUM_CLASSES], dtype=np.int32)
+    active_class_ids[[0] + list(class_map.values())] = 1
+    backbone_shapes = modellib.compute_backbone_shapes(config, config.IMAGE_SHAPE)
+    anchors = utils.generate_pyramid_anchors(config.RPN_ANCHOR_SCALES,
+                                             config.RPN_ANCHOR_RATIOS,
+                                             backbone_shapes,
+                                             config.BACKBONE_STRIDES,
+                                             config.RPN_ANCHOR_STRIDE)
+    anchors = tf.constant(anchors, tf.float32)
+
+    files = tf.data.Dataset.list_files(file_pattern, shuffle=shuffle)
+    dataset = files.interleave(tf.data.TFRecordDataset, num_parallel_calls=AUTOTUNE)
+    if shuffle:
+        dataset = dataset.shuffle(shuffle_buffer)
+    dataset = dataset.repeat()
+    dataset = dataset.map(lambda serialized: decode_example(serialized, class_table, image_table),
+                          num_parallel_calls=AUTOTUNE)
+    dataset = dataset.filter(has_instances)
+    dataset = dataset.map(rasterize_masks, num_parallel_calls=AUTOTUNE)
+    dataset = dataset.map(lambda example: resize_example(example, config, flip),
+                          num_parallel_calls=AUTOTUNE)
+    dataset = dataset.filter(has_instances)
+    dataset = dataset.map(
+        lambda example: build_targets(example, config, anchors, active_class_ids),
+        num_parallel_calls=TARGET_PARALLEL_CALLS)
+    dataset = dataset.batch(config.BATCH_SIZE, drop_remainder=True)
+    dataset = dataset.map(lambda *inputs: (inputs, tf.constant(1.1)))
+    return dataset.prefetch(AUTOTUNE)
@@ -9,6 +9,9 @@ Written by Waleed Abdulla
 
 import sys
 import os
+import io
+import json
+import hashlib
 import logging
 import math
 import random
@@ -23,9 +26,22 @@ import shutil
 import warnings
 from distutils.version import LooseVersion
 
+try:
+    from turbojpeg import TurboJPEG, TJPF_RGB
+    _turbojpeg = TurboJPEG()
+except (ImportError, OSError, RuntimeError):
+    # PyTurboJPEG is optional, skimage decodes everything without it.
+    # Keep these fallbacks in sync with albumentations-preprocessing's
+    # image_codec, which has the same TurboJPEG fast path.
+    _turbojpeg = None
+
 # URL from which to download the latest COCO trained weights
 COCO_MODEL_URL = "https://github.com/matterport/Mask_RCNN/releases/download/v2.0/mask_rcnn_coco.h5"
 
+# Up to this many boxes, compute_candidate_overlaps() computes all the IoUs
+# rather than building a BoxIndex
+DENSE_OVERLAPS_MAX_BOXES = 20000
+
 
 ############################################################
 #  Bounding Boxes
@@ -97,6 +113,129 @@ def compute_overlaps(boxes1, boxes2):
     return overlaps
 
 
+class BoxIndex(object):
+    """Spatial index of a set of boxes, to find the ones near a given box
+    without scanning all of them.
+
+    Boxes are grouped in levels of similar size, powers of two apart like
+    the levels of generate_pyramid_anchors(). Each level is a grid whose
+    cells are as large as the largest box of the level, so a box only
+    reaches into the cell after the one it starts in. The boxes of a level
+    are sorted by cell, a row of cells is a contiguous slice.
+
+    boxes: [N, (y1, x1, y2, x2)]. Build the index once and reuse it, e.g.
+        for the anchors of a DataGenerator.
+    """
+
+    def __init__(self, boxes):
+        self.boxes = boxes
+        # Contiguous coordinates, boxes[:, i] is strided
+        self.y1, self.x1, self.y2, self.x2 = np.ascontiguousarray(boxes.T)
+        self.areas = (self.y2 - self.y1) * (self.x2 - self.x1)
+        sizes = np.maximum(self.y2 - self.y1, self.x2 - self.x1)
+        box_levels = np.floor(np.log2(np.maximum(sizes, 1))).astype(np.int64)
+        self.levels = []
+        for level in np.unique(box_levels):
+            ix = np.where(box_levels == level)[0]
+            cell = max(float(np.max(sizes[ix])), 1.)
+            origin_y = float(np.min(self.y1[ix]))
+            origin_x = float(np.min(self.x1[ix]))
+            rows = np.floor((self.y1[ix] - origin_y) / cell).astype(np.int64)
+            cols = np.floor((self.x1[ix] - origin_x) / cell).astype(np.int64)
+            num_rows, num_cols = rows.max() + 1, cols.max() + 1
+            cells = rows * num_cols + cols
+            order = np.argsort(cells, kind="stable")
+            self.levels.append({
+                "ix": ix[order],
+                # Boxes of cell c are ix[cell_starts[c]:cell_starts[c + 1]]
+                "cell_starts": np.searchsorted(
+                    cells[order], np.arange(num_rows * num_cols + 1)),
+                "cell": cell, "origin": (origin_y, origin_x),
+                "shape": (num_rows, num_cols),
+                "min_area": np.min(self.areas[ix]),
+                "max_area": np.max(self.areas[ix]),
+            })
+
+    def query(self, box, area_ratio=0):
+        """Returns the sorted indices of the boxes that intersect box and
+        whose area is within area_ratio of the area of box.
+        """
+        box_area = (box[2] - box[0]) * (box[3] - box[1])
+        slices = []
+        for level in self.levels:
+            # Skip levels of boxes all too large or too small
+            if (level["max_area"] < box_area * area_ratio or
+                    level["min_area"] * area_ratio > box_area):
+                continue
+            cell = level["cell"]
+            num_rows, num_cols = level["shape"]
+            origin_y, origin_x = level["origin"]
+            # Boxes that intersect box start in these cells, give or take
+            # a cell for rounding
+            row1 = max(int(np.floor((box[0] - origin_y) / cell)) - 2, 0)
+            row2 = min(int(np.floor((box[2] - origin_y) / cell)) + 1, num_rows - 1)
+            col1 = max(int(np.floor((box[1] - origin_x) / cell)) - 2, 0)
+            col2 = min(int(np.floor((box[3] - origin_x) / cell)) + 1, num_cols - 1)
+            if row1 > row2 or col1 > col2:
+                continue
+            cell_starts = level["cell_starts"]
+            for row in range(row1, row2 + 1):
+                slices.append(level["ix"][
+                    cell_starts[row * num_cols + col1]:
+                    cell_starts[row * num_cols + col2 + 1]])
+        if not slices:
+            return np.zeros([0], np.int64)
+        ix = np.sort(np.concatenate(slices))
+        # Exact tests on the candidates
+        ix = ix[(self.y1[ix] < box[2]) & (self.y2[ix] > box[0]) &
+                (self.x1[ix] < box[3]) & (self.x2[ix] > box[1])]
+        if area_ratio > 0:
+            ix = ix[(self.areas[ix] * area_ratio <= box_area) &
+                    (box_area * area_ratio <= self.areas[ix])]
+        return ix
+
+
+def compute_candidate_overlaps(boxes1, boxes2, threshold=0, index=None):
+    """Computes IoU overlaps between two sets of boxes, only for the pairs
+    that can have an IoU >= threshold: boxes that intersect and whose areas
+    are within threshold of each other. All other pairs have an IoU below
+    threshold, or of 0 with the default threshold.
+    boxes1, boxes2: [N, (y1, x1, y2, x2)].
+    index: BoxIndex of boxes1. Without one, all IoUs of small sets are
+        computed and an index is built for larger ones.
+
+    For better performance, pass the largest set first and the smaller second.
+
+    Returns:
+    ix1, ix2: [K] indices of the candidate pairs in boxes1 and boxes2,
+        sorted by ix2.
+    overlaps: [K] bit identical to compute_overlaps(boxes1, boxes2)[ix1, ix2].
+    """
+    # The IoU is at most the ratio of the smaller area to the larger one.
+    # Loosened a bit so that rounding never drops a pair at the threshold.
+    area_ratio = threshold * (1 - 1e-6)
+    if index is None and boxes1.shape[0] <= DENSE_OVERLAPS_MAX_BOXES:
+        # Few boxes, not worth an index
+        overlaps = compute_overlaps(boxes1, boxes2)
+        ix2, ix1 = np.where(overlaps.T >= area_ratio if threshold > 0
+                            else overlaps.T > 0)
+        return ix1, ix2, overlaps[ix1, ix2]
+    if index is None:
+        index = BoxIndex(boxes1)
+    area2 = (boxes2[:, 2] - boxes2[:, 0]) * (boxes2[:, 3] - boxes2[:, 1])
+
+    ix1, ix2, overlaps = [], [], []
+    for i in range(boxes2.shape[0]):
+        ix = index.query(boxes2[i], area_ratio)
+        ix1.append(ix)
+        ix2.append(np.full(ix.shape, i))
+        overlaps.append(compute_iou(boxes2[i], boxes1[ix], area2[i],
+                                    index.areas[ix]))
+    if not overlaps:
+        return np.zeros([0], np.int64), np.zeros([0], np.int64), np.zeros([0])
+    return np.concatenate(ix1), np.concatenate(ix2), np.concatenate(overlaps)
+
+
 def compute_overlaps_masks(masks1, masks2):
     """Computes IoU overlaps between two sets of masks.
     masks1, masks2: [Height, Width, instances]
@@ -206,13 +345,14 @@ def box_refinement_graph(box, gt_box):
     return result
 
 
-def box_refinement(box, gt_box):
+def box_refinement(box, gt_box, dtype=np.float32):
     """Compute refinement needed to transform box to gt_box.
     box and gt_box are [N, (y1, x1, y2, x2)]. (y2, x2) is
     assumed to be outside the box.
+    dtype: precision of the computation.
     """
-    box = box.astype(np.float32)
-    gt_box = gt_box.astype(np.float32)
+    box = box.astype(dtype)
+    gt_box = gt_box.astype(dtype)
 
     height = box[:, 2] - box[:, 0]
     width = box[:, 3] - box[:, 1]
@@ -236,6 +376,32 @@ def box_refinement(box, gt_box):
 #  Dataset
 ############################################################
 
+def read_image(path, pack=None):
+    """Read an image file into a [H, W, C] uint8 array.
+
+    JPEGs are decoded to RGB with libjpeg-turbo when PyTurboJPEG is
+    installed, which is several times faster than skimage.io.imread.
+    pack: The {"file", "offset", "length"} entry of an image that the
+        preprocessing workflow appended to a pack file (--pack_augmented).
+        path is then the pack file and the image is read from that range.
+    """
+    # Mirrors ImageCodec.decode in albumentations-preprocessing/image_codec.py,
+    # update both when changing the fast path or its fallbacks.
+    if pack is not None:
+        with open(path, "rb") as f:
+            f.seek(pack["offset"])
+            data = f.read(pack["length"])
+        is_jpeg = data[:2] == b"\xff\xd8"
+    else:
+        is_jpeg = path.lower().endswith((".jpg", ".jpeg"))
+    if _turbojpeg is not None and is_jpeg:
+        if pack is None:
+            with open(path, "rb") as f:
+                data = f.read()
+        return _turbojpeg.decode(data, pixel_format=TJPF_RGB)
+    return skimage.io.imread(path if pack is None else io.BytesIO(data))
+
+
 class Dataset(object):
     """The base class for dataset classes.
     To use it, create a new class that adds functions specific to the dataset
@@ -356,7 +522,8 @@ class Dataset(object):
         """Load the specified image and return a [H,W,3] Numpy array.
         """
         # Load image
-        image = skimage.io.imread(self.image_info[image_id]['path'])
+        image = read_image(self.image_info[image_id]['path'],
+                           pack=self.image_info[image_id].get('pack'))
         # If grayscale. Convert to RGB for consistency.
         if image.ndim != 3:
             image = skimage.color.gray2rgb(image)
@@ -384,6 +551,96 @@ class Dataset(object):
         class_ids = np.empty([0], np.int32)
         return mask, class_ids
 
+    def target_cache_key(self, image_id):
+        """Return a string that changes whenever the image or its masks do,
+        to cache the training targets of the image. See TargetCache.
+
+        Override for your dataset. Returns None by default: not cached.
+        """
+        return None
+
+
+class TargetCache(object):
+    """On-disk cache of the training targets of images, as load_image_gt()
+    computes them without augmentation: the resized image, class IDs,
+    bounding boxes and (mini) masks. Images with a cached entry are loaded
+    without decoding the image or any mask.
+
+    Entries are keyed by the target_cache_key() of the image and a hash of
+    the config values and dataset classes the targets depend on, so changing
+    any of them doesn't read stale targets. Images are stored as .npy files
+    and memory-mapped, the other targets compressed with the masks packed to
+    bits.
+
+    cache_dir: Root directory of the cache, can be shared between runs.
+    """
+
+    # Config values the targets depend on
+    CONFIG_KEYS = ["IMAGE_RESIZE_MODE", "IMAGE_MIN_DIM", "IMAGE_MAX_DIM",
+                   "IMAGE_MIN_SCALE", "USE_MINI_MASK", "MINI_MASK_SHAPE"]
+
+    def __init__(self, cache_dir, config, dataset):
+        assert config.IMAGE_RESIZE_MODE != "crop", \
+            "Random crops can't be cached"
+        self.dataset = dataset
+        key = {name: getattr(config, name) for name in self.CONFIG_KEYS}
+        key["classes"] = [(c["source"], c["id"]) for c in dataset.class_info]
+        digest = hashlib.sha1(json.dumps(key, sort_keys=True, default=str)
+                              .encode("utf8")).hexdigest()[:16]
+        self.cache_dir = os.path.join(cache_dir, digest)
+        os.makedirs(self.cache_dir, exist_ok=True)
+
+    def paths(self, image_id):
+        """Return the image and targets paths of the image, or None if the
+        dataset doesn't support caching."""
+        key = self.dataset.target_cache_key(image_id)
+        if key is None:
+            return None
+        name = hashlib.sha1(key.encode("utf8")).hexdigest()
+        return (os.path.join(self.cache_dir, name + ".npy"),
+                os.path.join(self.cache_dir, name + ".npz"))
+
+    def load(self, image_id):
+        """Return the cached targets of the image as a dict, or None.
+        Keys: image, original_shape, window, scale, class_ids, bbox, mask.
+        """
+        paths = self.paths(image_id)
+        if paths is None or not os.path.exists(paths[1]):
+            return None
+        image_path, targets_path = paths
+        with np.load(targets_path) as f:
+            targets = {name: f[name] for name in f.files}
+        mask_shape = tuple(targets.pop("mask_shape"))
+        targets["mask"] = np.unpackbits(
+            targets["mask"], count=int(np.prod(mask_shape))
+        ).reshape(mask_shape).astype(bool)
+        # Back to Python values, image_meta has their types
+        targets["original_shape"] = tuple(targets["original_shape"].tolist())
+        targets["window"] = tuple(targets["window"].tolist())
+        targets["scale"] = targets["scale"].item()
+        targets["image"] = np.load(image_path, mmap_mode="r")
+        return targets
+
+    def save(self, image_id, image, original_shape, window, scale, class_ids,
+             bbox, mask):
+        paths = self.paths(image_id)
+        if paths is None:
+            return
+        image_path, targets_path = paths
+        # Write to temporary files and rename, concurrent readers never see
+        # partial entries. The targets file is written last, it marks the
+        # entry complete.
+        tmp_suffix = ".{}.tmp".format(os.getpid())
+        with open(image_path + tmp_suffix, "wb") as f:
+            np.save(f, image)
+        os.replace(image_path + tmp_suffix, image_path)
+        with open(targets_path + tmp_suffix, "wb") as f:
+            np.savez_compressed(f, original_shape=np.array(original_shape),
+                                window=np.array(window), scale=np.array(scale),
+                                class_ids=class_ids, bbox=bbox,
+                                mask=np.packbits(mask), mask_shape=np.array(mask.shape))
+        os.replace(targets_path + tmp_suffix, targets_path)
+
 
 def resize_image(image, min_dim=None, max_dim=None, min_scale=None, mode="square"):
     """Resizes an image keeping the aspect ratio unchanged.